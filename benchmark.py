@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from comparison import read_cl_files, combine_files, prepare_base, build_merged_output, reorder_output_columns, attach_key_columns
+from cube import lot_statistics
+from diagnostics import StageRecorder, peak_rss_bytes
+from excel_export import write_comparison_workbook
+from plots import build_plot_frame, build_cl_figure
+from polars_engine import polars_comparison
+
+# In pipeline order; every stage times its own work, so the stages add up to the total
+STAGES = [
+    "parse", "align", "normalization", "duplicates", "outer_merge", "presence", "sort", "pass_fail",
+    "base_prepare", "base_merge", "lot_stats", "excel_write", "plot_build",
+]
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000]
+DEFAULT_EXPANSION_MIX = {"": 1.0, "1": 0.5, "2": 0.5}
+
+
+def parse_expansion_mix(text):
+    # "blank=1,1=0.5,2=0.5" -> {"": 1.0, "1": 0.5, "2": 0.5}
+    mix = {}
+    for part in text.split(","):
+        name, _, share = part.partition("=")
+        name = name.strip()
+        mix["" if name.lower() == "blank" else name] = float(share)
+    return mix
+
+
+def _spec_numbers(spec_ids):
+    spec_ids = pd.Series(spec_ids)
+    return (
+        (spec_ids // 10000 + 1).astype(str) + "."
+        + (spec_ids // 100 % 100 + 1).astype(str) + "."
+        + (spec_ids % 100 + 1).astype(str)
+    )
+
+
+def _cl_rows(spec_ids, rng, expansion_mix, n_categories):
+    # Each spec gets the blank/numbered expansions with the probabilities in expansion_mix
+    expansions = list(expansion_mix)
+    present = rng.random((len(spec_ids), len(expansions))) < np.array([expansion_mix[e] for e in expansions])
+    present[~present.any(axis=1), 0] = True
+    spec_idx, exp_idx = np.nonzero(present)
+    spec_ids = np.asarray(spec_ids)[spec_idx]
+    return pd.DataFrame({
+        "spec_id": spec_ids,
+        "spec_number": _spec_numbers(spec_ids).to_numpy(),
+        "spec_id_expansion": np.array(expansions, dtype=object)[exp_idx],
+        "spec_item_category": ("Category " + pd.Series(spec_ids % n_categories).astype(str)).to_numpy(),
+        "spec_item_old_name": ("Item " + pd.Series(spec_ids).astype(str)).to_numpy(),
+    })
+
+
+def _cl_csv_frame(rows, rng, fail_rate):
+    n = len(rows)
+    # Limits are a deterministic function of the spec so every file agrees on them
+    center = (rows["spec_id"].to_numpy() % 97) - 48.0
+    width = 1.0 + (rows["spec_id"].to_numpy() % 13)
+    lo, hi = center - width, center + width
+    spread = width * rng.uniform(0.2, 0.9, n)
+    typ = center + rng.normal(0, width * 0.1, n)
+    cl_min = typ - spread
+    cl_max = typ + spread
+    failing = rng.random(n) < fail_rate
+    cl_max[failing] = hi[failing] + rng.uniform(0.1, 1.0, failing.sum())
+
+    frame = pd.DataFrame({
+        "spec_number": rows["spec_number"].to_numpy(),
+        "spec_id_expansion": rows["spec_id_expansion"].to_numpy(),
+        "spec_item_category": rows["spec_item_category"].to_numpy(),
+        "spec_item_old_name": rows["spec_item_old_name"].to_numpy(),
+        "requirement": "spec",
+        "cm_summary": cl_min.round(3),
+        "cm_summary_typ": typ.round(3),
+        "cm_summary_max": cl_max.round(3),
+        "limits": lo.round(3),
+        "limits_typ": center.round(3),
+        "limits_max": hi.round(3),
+        "notes": "",
+    })
+    # Real exports carry a second header row of sub-labels, with "Compliance" above the CL block
+    sub_header = pd.DataFrame([["", "", "", "", "Compliance", "Min", "Typ", "Max", "Min", "Typ", "Max", ""]], columns=frame.columns)
+    frame = pd.concat([sub_header, frame], ignore_index=True)
+    # The columns next to cm_summary/limits are unnamed in the exports
+    frame.columns = [
+        "spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name", "requirement",
+        "cm_summary", "", "", "limits", "", "", "notes",
+    ]
+    return frame
+
+
+def generate_cl_files(directory, n_rows, n_files=2, overlap=0.9, expansion_mix=None, n_categories=20, fail_rate=0.02, seed=0):
+    expansion_mix = expansion_mix or DEFAULT_EXPANSION_MIX
+    rng = np.random.default_rng(seed)
+    rows_per_spec = max(sum(expansion_mix.values()), 1.0)
+    n_specs = int(np.ceil(n_rows / rows_per_spec))
+
+    base_rows = _cl_rows(np.arange(n_specs), rng, expansion_mix, n_categories).iloc[:n_rows]
+    paths = []
+    next_spec = n_specs
+    for i in range(n_files):
+        if i == 0:
+            rows = base_rows
+        else:
+            # `overlap` of file 1's keys reappear, the rest are specs file 1 does not have
+            shared = base_rows[rng.random(len(base_rows)) < overlap]
+            n_new = max(len(base_rows) - len(shared), 0)
+            new_specs = np.arange(next_spec, next_spec + int(np.ceil(n_new / rows_per_spec)))
+            next_spec += len(new_specs)
+            new_rows = _cl_rows(new_specs, rng, expansion_mix, n_categories).iloc[:n_new]
+            rows = pd.concat([shared, new_rows], ignore_index=True).sort_values("spec_id", kind="stable")
+        path = os.path.join(directory, f"cl_{n_rows}_{i + 1}.csv")
+        _cl_csv_frame(rows, rng, fail_rate).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def time_comparison(paths, custom_names=None, skip=(), trace_memory=False):
+    custom_names = custom_names or [f"File {i + 1}" for i in range(len(paths))]
+    timer = StageRecorder(trace_memory=trace_memory, log=False)
+
+    with timer("parse") as stage:
+        dataframes = read_cl_files(paths)
+        stage["rows"] = sum(len(df) for df in dataframes)
+    cube = combine_files(dataframes, custom_names, timer=timer)
+    with timer("base_prepare"):
+        base_df = prepare_base(dataframes[0])
+    merged_output = build_merged_output(base_df, cube, timer=timer)
+    if "lot_stats" not in skip:
+        with timer("lot_stats") as stage:
+            lot_stats, _ = lot_statistics(cube)
+            merged_output = attach_key_columns(merged_output, cube, lot_stats)
+            stage["rows"] = cube.n_keys
+    merged_output = reorder_output_columns(merged_output, custom_names)
+
+    if "excel_write" not in skip:
+        with timer("excel_write") as stage:
+            write_comparison_workbook(merged_output, custom_names)
+            stage["rows"] = len(merged_output)
+
+    if "plot_build" not in skip:
+        with timer("plot_build") as stage:
+            category = cube.keys["spec_item_category"].dropna().iloc[0]
+            filtered_cube = cube.take(np.flatnonzero((cube.keys["spec_item_category"] == category).to_numpy()))
+            plot_frame = build_plot_frame(filtered_cube, ["Minimum", "Typical", "Maximum"])
+            build_cl_figure(plot_frame, filtered_cube, f"CL Comparison for Spec Item Category {category}",
+                            {"Minimum": True, "Typical": True, "Maximum": True})
+            stage["rows"] = len(plot_frame)
+
+    stages = {stage: round(timer.stages[stage]["seconds"], 4) for stage in STAGES if stage in timer.stages}
+    stages["total"] = round(timer.total_seconds(), 4)
+    result = {
+        "stages": stages,
+        "rows": {stage: timer.stages[stage]["rows"] for stage in STAGES if stage in timer.stages},
+        "combined_rows": cube.n_keys,
+        "output_rows": len(merged_output),
+        "output_columns": merged_output.shape[1],
+    }
+    if trace_memory:
+        result["peak_mb"] = {stage: round(timer.stages[stage]["peak_mb"], 2) for stage in STAGES if stage in timer.stages}
+    return result
+
+
+def _pandas_merged_output(paths, custom_names):
+    dataframes = read_cl_files(paths)
+    cube = combine_files(dataframes, custom_names)
+    return build_merged_output(prepare_base(dataframes[0], copy=False), cube)
+
+
+def _polars_merged_output(paths, custom_names):
+    cube, base_df, _ = polars_comparison(paths, custom_names)
+    return build_merged_output(base_df, cube)
+
+
+# CSV files -> merged_output, end to end, per engine
+ENGINE_RUNS = {"pandas": _pandas_merged_output, "Polars": _polars_merged_output}
+
+
+def time_engines(paths, engines, custom_names=None):
+    # Seconds per engine, pandas included as the reference for the speedups
+    custom_names = custom_names or [f"File {i + 1}" for i in range(len(paths))]
+    seconds = {}
+    for engine in ["pandas"] + [e for e in engines if e != "pandas"]:
+        start = time.perf_counter()
+        ENGINE_RUNS[engine](paths, custom_names)
+        seconds[engine] = round(time.perf_counter() - start, 4)
+    return seconds
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(rows_list, n_files, overlap, expansion_mix, repeat=1, skip=(), data_dir=None, seed=0, trace_memory=False,
+                   engines=()):
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = data_dir or tmp
+        os.makedirs(directory, exist_ok=True)
+        for n_rows in rows_list:
+            paths = generate_cl_files(directory, n_rows, n_files, overlap, expansion_mix, seed=seed)
+            results = [time_comparison(paths, skip=skip, trace_memory=trace_memory) for _ in range(repeat)]
+            # Keep the fastest repetition per stage to damp scheduler noise
+            best = {stage: min(r["stages"][stage] for r in results) for stage in results[0]["stages"]}
+            runs.append({
+                "rows": n_rows,
+                "files": n_files,
+                "overlap": overlap,
+                "expansion_mix": expansion_mix,
+                "stages": best,
+                "stage_rows": results[0]["rows"],
+                "combined_rows": results[0]["combined_rows"],
+                "output_rows": results[0]["output_rows"],
+                "output_columns": results[0]["output_columns"],
+            })
+            if trace_memory:
+                runs[-1]["peak_mb"] = results[0]["peak_mb"]
+            print(f"{n_rows:>9} rows: " + ", ".join(f"{k}={v:.3f}s" for k, v in best.items()), flush=True)
+            if engines:
+                timings = [time_engines(paths, engines) for _ in range(repeat)]
+                fastest = {engine: min(t[engine] for t in timings) for engine in timings[0]}
+                runs[-1]["engines"] = fastest
+                runs[-1]["speedup"] = {
+                    engine: round(fastest["pandas"] / seconds, 2) for engine, seconds in fastest.items() if engine != "pandas"
+                }
+                print(f"{'engines':>14}: " + ", ".join(
+                    f"{engine}={seconds:.3f}s" + (f" ({runs[-1]['speedup'][engine]:.2f}x)" if engine != "pandas" else "")
+                    for engine, seconds in fastest.items()
+                ), flush=True)
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "engines": list(engines),
+            "platform": platform.platform(),
+            "peak_rss_mb": None if peak_rss_bytes() is None else round(peak_rss_bytes() / 1024 / 1024, 1),
+        },
+        "runs": runs,
+    }
+
+
+def find_regressions(current, baseline, tolerance=0.2, min_seconds=0.05):
+    previous = {(run["rows"], run["files"]): run["stages"] for run in baseline["runs"]}
+    regressions = []
+    for run in current["runs"]:
+        old = previous.get((run["rows"], run["files"]))
+        if old is None:
+            continue
+        for stage, seconds in run["stages"].items():
+            before = old.get(stage)
+            if before is not None and seconds > min_seconds and seconds > before * (1 + tolerance):
+                regressions.append({"rows": run["rows"], "files": run["files"], "stage": stage, "before": before, "after": seconds})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CL comparison pipeline on synthetic CL files.")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="rows per file, one run per value")
+    parser.add_argument("--files", type=int, default=2, help="number of CL files to compare")
+    parser.add_argument("--overlap", type=float, default=0.9, help="share of file 1 keys present in the other files")
+    parser.add_argument("--expansion-mix", type=parse_expansion_mix, default=DEFAULT_EXPANSION_MIX,
+                        help='probability of each spec_id_expansion per spec, e.g. "blank=1,1=0.5,2=0.5"')
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--skip", nargs="*", default=[], choices=["lot_stats", "excel_write", "plot_build"])
+    parser.add_argument("--memory", action="store_true", help="record per-stage peak memory with tracemalloc (slower)")
+    parser.add_argument("--data-dir", help="keep the generated CSVs here instead of a temporary directory")
+    parser.add_argument("--engines", nargs="*", default=[], choices=[e for e in ENGINE_RUNS if e != "pandas"],
+                        help="also time these engines end to end (CSV files to merged output) against pandas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="previous results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown per stage against --baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.rows, args.files, args.overlap, args.expansion_mix, args.repeat, args.skip, args.data_dir, args.seed, args.memory,
+                             args.engines)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['rows']} rows / {r['files']} files, {r['stage']}: {r['before']:.3f}s -> {r['after']:.3f}s")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,466 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from comparison import ComparisonError, DUPLICATE_POLICIES
+from compare_cli import compare_files
+from excel_export import write_comparison_workbook
+
+logger = logging.getLogger("cl_compare.api")
+
+# The in-memory engines; their result frame is kept so every download format comes from one run
+API_ENGINES = ["pandas", "Polars"]
+FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+MAX_FINISHED_JOBS = 32
+COPY_BYTES = 1 << 16
+ROUTE = re.compile(r"^/comparisons(?:/(?P<id>[0-9a-f]+)(?:/result\.(?P<format>\w+))?)?/?$")
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def content_hash(sources, options):
+    # Identical files and options give the same job; paths are hashed by their content
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    for source in sources:
+        if isinstance(source, bytes):
+            digest.update(hashlib.sha256(source).digest())
+            continue
+        file_digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(COPY_BYTES), b""):
+                file_digest.update(block)
+        digest.update(file_digest.digest())
+    return digest.hexdigest()[:20]
+
+
+def parse_options(fields, n_files):
+    # Request fields (JSON values, or lists of form values) -> options of compare_files
+    def value(name, fallback):
+        field = fields.get(name, fallback)
+        return field[0] if isinstance(field, list) and name != "names" else field
+
+    names = fields.get("names") or [f"File {i + 1}" for i in range(n_files)]
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(",")]
+    options = {
+        "names": [str(name) for name in names],
+        "expansion": str(value("expansion", "All")),
+        "duplicates": value("duplicates", "Keep first"),
+        "reference": value("reference", None) or None,
+        "engine": value("engine", "pandas"),
+    }
+    try:
+        options["delta_abs"] = float(value("delta_abs", 0))
+        options["delta_pct"] = float(value("delta_pct", 10))
+    except (TypeError, ValueError):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "delta_abs and delta_pct must be numbers")
+    if n_files < 2:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "compare at least two CL files")
+    if len(options["names"]) != n_files:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "names needs one name per file")
+    if len(set(options["names"])) != n_files:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "names must all differ")
+    if options["duplicates"] not in DUPLICATE_POLICIES:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"duplicates must be one of {DUPLICATE_POLICIES}")
+    if options["engine"] not in API_ENGINES:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"engine must be one of {API_ENGINES}")
+    if options["reference"] is not None and options["reference"] not in options["names"]:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"reference must be one of {options['names']}")
+    return options
+
+
+def parse_multipart(content_type, body):
+    # multipart/form-data -> (uploaded files as bytes in order, {field: [values]})
+    message = BytesParser(policy=default_policy).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    if not message.is_multipart():
+        raise RequestError(HTTPStatus.BAD_REQUEST, "expected multipart/form-data")
+    files, fields = [], {}
+    for part in message.iter_parts():
+        data = part.get_payload(decode=True) or b""
+        if part.get_filename() is not None:
+            files.append(data)
+        else:
+            name = part.get_param("name", header="content-disposition")
+            fields.setdefault(name, []).append(data.decode())
+    return files, fields
+
+
+def parquet_frame(frame):
+    # Object columns as text or missing, as Parquet wants one type per column
+    frame = frame.copy()
+    for col in frame.columns[(frame.dtypes == object).to_numpy()]:
+        values = frame[col]
+        frame[col] = values.where(values.isna(), values.astype(str))
+    return frame
+
+
+class ApiJob:
+    def __init__(self, job_id, options, sources, directory):
+        self.id = job_id
+        self.options = options
+        self.sources = sources
+        self.directory = directory
+        self.status = "queued"
+        self.error = None
+        self.summary = None
+        self.result = None
+        self.outputs = {}
+        self.created = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def describe(self):
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "options": self.options,
+            "created": round(self.created, 3),
+            "finished": None if self.finished is None else round(self.finished, 3),
+        }
+        if self.error is not None:
+            info["error"] = self.error
+        if self.summary is not None:
+            info["summary"] = self.summary
+            info["downloads"] = {fmt: f"/comparisons/{self.id}/result.{fmt}" for fmt in FORMATS}
+        return info
+
+
+def summarize(merged_output, unparsed):
+    return {
+        "rows": len(merged_output),
+        "failed": int((merged_output["Pass or Fail"] == "Fail").sum()),
+        "passed": int((merged_output["Pass or Fail"] == "Pass").sum()),
+        "presence": {str(k): int(v) for k, v in merged_output["File Presence"].value_counts().items()},
+        "columns": [str(col) for col in merged_output.columns],
+        "unparsed": unparsed.to_dict(orient="records"),
+    }
+
+
+class ComparisonService:
+    # Comparison jobs behind the HTTP handler: a bounded queue drained by a fixed number of
+    # worker threads, jobs keyed by the content hash of their files and options, and the
+    # finished results written to a download format on first request.
+
+    def __init__(self, workers=2, queue_size=16, directory=None):
+        self.directory = tempfile.mkdtemp(prefix="cl-api-", dir=directory)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = [
+            threading.Thread(target=self._work, name=f"cl-api-worker-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        # Idle workers stop; busy ones are daemon threads and end with the process
+        for _ in self.workers:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def submit(self, sources, options):
+        # Returns (job, created); an identical queued, running or finished job is returned as it is
+        job_id = content_hash(sources, options)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status not in ["failed", "cancelled"]:
+                return job, False
+            directory = os.path.join(self.directory, f"{job_id}-{uuid.uuid4().hex[:6]}")
+            os.makedirs(directory)
+            paths = []
+            for i, source in enumerate(sources):
+                if isinstance(source, bytes):
+                    path = os.path.join(directory, f"input_{i}.csv")
+                    with open(path, "wb") as f:
+                        f.write(source)
+                    source = path
+                paths.append(source)
+            job = ApiJob(job_id, options, paths, directory)
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "the job queue is full, try again later")
+            replaced = self.jobs.get(job_id)
+            if replaced is not None and replaced.finished is not None:
+                # A job still running after its cancel removes its own directory, see _work
+                shutil.rmtree(replaced.directory, ignore_errors=True)
+            self.jobs[job_id] = job
+            self._evict()
+        return job, True
+
+    def _evict(self):
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        for job in sorted(finished, key=lambda job: job.finished)[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            self.jobs.pop(job.id)
+            shutil.rmtree(job.directory, ignore_errors=True)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.status == "cancelled":
+                    continue
+                job.status = "running"
+            options = job.options
+            outcome = {}
+            try:
+                merged_output, unparsed = compare_files(
+                    job.sources, options["names"], options["expansion"], options["reference"], options["duplicates"],
+                    engine=options["engine"], log=logger.info,
+                )
+                outcome = {"result": merged_output, "summary": summarize(merged_output, unparsed), "status": "done"}
+            except (ComparisonError, ValueError, RuntimeError) as error:
+                outcome = {"error": str(error), "status": "failed"}
+            except Exception as error:
+                logger.exception("comparison %s failed", job.id)
+                outcome = {"error": f"unexpected error: {error}", "status": "failed"}
+            with self.lock:
+                # A job cancelled while it ran publishes nothing
+                if job.status == "running":
+                    for name, value in outcome.items():
+                        setattr(job, name, value)
+                job.finished = time.time()
+                if self.jobs.get(job.id) is not job:
+                    # Replaced by a new submission while it ran
+                    shutil.rmtree(job.directory, ignore_errors=True)
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"no comparison {job_id}")
+        return job
+
+    def cancel(self, job_id):
+        # A queued job is skipped and finished at once; a running one finishes but publishes no
+        # result, and is finished when its worker is done with its files
+        with self.lock:
+            job = self.get(job_id)
+            if job.status == "queued":
+                job.finished = time.time()
+            if job.status in ["queued", "running"]:
+                job.status = "cancelled"
+            self._evict()
+        return job
+
+    def counts(self):
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ["queued", "running", "done", "failed", "cancelled"]}
+
+    def output(self, job, fmt):
+        # Path of the result in `fmt`, written once
+        if fmt not in FORMATS:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"format must be one of {list(FORMATS)}")
+        if job.status != "done":
+            raise RequestError(HTTPStatus.CONFLICT, f"comparison {job.id} is {job.status}")
+        with job.lock:
+            if fmt not in job.outputs:
+                path = os.path.join(job.directory, f"comparison.{fmt}")
+                names = job.options["names"]
+                if fmt == "xlsx":
+                    thresholds = (job.options["delta_abs"], job.options["delta_pct"]) if job.options["reference"] else None
+                    with open(path, "wb") as f:
+                        f.write(write_comparison_workbook(job.result, names, thresholds).getbuffer())
+                else:
+                    try:
+                        parquet_frame(job.result).to_parquet(path, index=False)
+                    except ImportError:
+                        raise RequestError(HTTPStatus.NOT_IMPLEMENTED, "pyarrow is not installed; pip install pyarrow or download xlsx")
+                job.outputs[fmt] = path
+        return job.outputs[fmt]
+
+
+class ComparisonHandler(BaseHTTPRequestHandler):
+    # GET  /health                              queue and job counts
+    # POST /comparisons                         multipart CSV uploads, or JSON {"paths": [...]}, plus options
+    # GET  /comparisons                         every job
+    # GET  /comparisons/<id>                    status, and the JSON summary once done
+    # GET  /comparisons/<id>/result.<format>    the result as xlsx or parquet, streamed
+    # DELETE /comparisons/<id>                  cancel
+    server_version = "CLCompare/1.0"
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def _send_json(self, status, payload, headers=()):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        # At most max_connections requests are served at once; the rest are turned away
+        if not self.server.slots.acquire(blocking=False):
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "too many concurrent requests"}, [("Retry-After", "1")])
+            return
+        try:
+            method()
+        except RequestError as error:
+            headers = [("Retry-After", "5")] if error.status == HTTPStatus.SERVICE_UNAVAILABLE else []
+            self._send_json(error.status, {"error": str(error)}, headers)
+        except ConnectionError:
+            logger.info("%s closed the connection", self.address_string())
+        except (ValueError, TypeError, AttributeError) as error:
+            # A request the checks above did not anticipate, such as a JSON list for the options
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"bad request: {error}"})
+        except Exception as error:
+            logger.exception("%s %s failed", self.command, self.path)
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"unexpected error: {error}"})
+        finally:
+            self.server.slots.release()
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_POST(self):
+        self._handle(self._post)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _route(self):
+        match = ROUTE.match(self.path.split("?")[0])
+        if match is None:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"no route {self.path}")
+        return match["id"], match["format"]
+
+    def _get(self):
+        service = self.server.service
+        if self.path.split("?")[0] == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok", "jobs": service.counts(), "queue_free": service.queue.maxsize - service.queue.qsize()})
+            return
+        job_id, fmt = self._route()
+        if job_id is None:
+            with service.lock:
+                jobs = list(service.jobs.values())
+            self._send_json(HTTPStatus.OK, [job.describe() for job in jobs])
+        elif fmt is None:
+            self._send_json(HTTPStatus.OK, service.get(job_id).describe())
+        else:
+            self._stream(service.output(service.get(job_id), fmt), fmt)
+
+    def _stream(self, path, fmt):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", FORMATS[fmt])
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f'attachment; filename="comparison_grouped.{fmt}"')
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, COPY_BYTES)
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Content-Length must be a number")
+        if length < 0:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Content-Length must not be negative")
+        if length > self.server.max_upload_bytes:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"request body over {self.server.max_upload_bytes // (1024 * 1024)} MB")
+        return self.rfile.read(length)
+
+    def _post(self):
+        job_id, fmt = self._route()
+        if job_id is not None:
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, "POST to /comparisons")
+        content_type = self.headers.get("Content-Type", "")
+        body = self._read_body()
+        if content_type.startswith("multipart/form-data"):
+            sources, fields = parse_multipart(content_type, body)
+        elif content_type.startswith("application/json"):
+            try:
+                fields = json.loads(body or b"{}")
+            except ValueError:
+                raise RequestError(HTTPStatus.BAD_REQUEST, "invalid JSON body")
+            if not isinstance(fields, dict) or not isinstance(fields.get("paths", []), list):
+                raise RequestError(HTTPStatus.BAD_REQUEST, 'the JSON body must be an object with a list of "paths"')
+            sources = [str(path) for path in fields.get("paths", [])]
+            missing = [path for path in sources if not os.path.isfile(path)]
+            if missing:
+                raise RequestError(HTTPStatus.BAD_REQUEST, f"no such file: {missing[0]}")
+        else:
+            raise RequestError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "send multipart/form-data uploads or JSON with paths")
+        options = parse_options(fields, len(sources))
+        job, created = self.server.service.submit(sources, options)
+        self._send_json(HTTPStatus.ACCEPTED if created else HTTPStatus.OK, job.describe(),
+                        [("Location", f"/comparisons/{job.id}")])
+
+    def _delete(self):
+        job_id, fmt = self._route()
+        if job_id is None or fmt is not None:
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, "DELETE /comparisons/<id>")
+        self._send_json(HTTPStatus.OK, self.server.service.cancel(job_id).describe())
+
+
+def make_server(host="127.0.0.1", port=8765, workers=2, queue_size=16, max_connections=8, max_upload_mb=512,
+                directory=None):
+    # port=0 picks a free port, see server.server_address
+    server = ThreadingHTTPServer((host, port), ComparisonHandler)
+    server.daemon_threads = True
+    server.service = ComparisonService(workers, queue_size, directory)
+    server.slots = threading.BoundedSemaphore(max_connections)
+    server.max_upload_bytes = max_upload_mb * 1024 * 1024
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve CL comparisons over HTTP for scripts and other tools.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="comparisons run at the same time")
+    parser.add_argument("--queue", type=int, default=16, help="comparisons waiting at most; more are refused with 503")
+    parser.add_argument("--max-connections", type=int, default=8, help="requests served at the same time")
+    parser.add_argument("--max-upload-mb", type=int, default=512, help="largest request body accepted")
+    parser.add_argument("--directory", default=None, help="where uploads and results are kept (default: a temporary directory)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    server = make_server(args.host, args.port, args.workers, args.queue, args.max_connections, args.max_upload_mb,
+                         args.directory)
+    host, port = server.server_address[:2]
+    print(f"Serving CL comparisons on http://{host}:{port}/comparisons")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
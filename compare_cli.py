@@ -0,0 +1,242 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from comparison import (
+    read_cl_files, missing_required_columns, prepare_file, join_files, prepare_base, build_merged_output, unparsed_report,
+    filter_expansion, reorder_output_columns, attach_key_columns, DUPLICATE_POLICIES, MAX_ROWS_ENV,
+    worst_case_view, cube_output, check_memory_budget, MEMORY_BUDGET_ENV, DEFAULT_MEMORY_BUDGET_MB, ENGINES
+)
+from cube import WORST_CASE, delta_columns
+from limits import NO_MATCH_WARNING, prepare_limits, apply_limits
+from history import HISTORY_DB_ENV, ResultsStore
+from reconcile import DEFAULT_SIMILARITY, propose_renames, rename_mapping, apply_renames
+from diagnostics import peak_rss_bytes
+from excel_export import write_comparison_workbook, write_comparison_stream
+from profiling import PROFILE_ENV, PROFILERS, profile_run, profiler_from_env
+from sql_engine import SQL_MEMORY_ENV, SQLComparison
+from polars_engine import polars_comparison
+from partitioned import PartitionedComparison
+
+
+def _log(message):
+    print(message, file=sys.stderr)
+
+
+def compare_files(paths, custom_names, expansion_filter="All", reference=None, duplicate_policy="Keep first",
+                  max_rows=None, reconcile_similarity=None, memory_budget_mb=None, compact_values=False,
+                  engine="pandas", log=_log, limits=None, history=None):
+    # The comparison run_comparison writes out. Returns (merged_output, unparsed_report); the
+    # renames accepted by reconcile_similarity are passed to log. limits is a limits-only .csv
+    # that supplies the limits and the output rows instead of the first file. history is a
+    # ResultsStore the full result is appended to.
+    table = None
+    if limits is not None:
+        prepared_limits = prepare_limits(limits)
+        if prepared_limits["missing"]:
+            raise ValueError(f'Missing column "{prepared_limits["missing"][0]}" in the limits file.')
+        table = prepared_limits["table"]
+
+    if engine == "Polars":
+        # Only the selected expansion is read; the worst case needs all of them. With a limits
+        # file, keys no CL file has are added afterwards, so every expansion is read.
+        cube, base_df, unparsed = polars_comparison(paths, custom_names, duplicate_policy,
+                                                    "All" if expansion_filter == WORST_CASE or table is not None
+                                                    else expansion_filter, max_rows=max_rows)
+        unparsed = unparsed_report(unparsed, custom_names)
+        if table is not None:
+            cube, base_df, unparsed = _with_limits(cube, table, unparsed, log)
+        _save_history(history, cube, paths, log)
+        return _result_frame(cube, base_df, custom_names, expansion_filter, reference), unparsed
+
+    dataframes = read_cl_files(paths)
+    missing = missing_required_columns(dataframes)
+    if missing:
+        raise ValueError(f'Missing column "{missing[0]}" in one of the files.')
+
+    prepared = [prepare_file(df, i) for i, df in enumerate(dataframes)]
+    unparsed = unparsed_report([unparsed for _, _, unparsed in prepared], custom_names)
+    aligned = [aligned for aligned, _, _ in prepared]
+    if reconcile_similarity is not None:
+        # No review step here: every proposed rename is accepted and listed
+        proposals = propose_renames(aligned, custom_names, reconcile_similarity)
+        for _, row in proposals.iterrows():
+            log(f'Renamed in {row["File"]}: "{row["Name in file"]}" -> "{row["Matched name"]}" ({row["Similarity"]})')
+        aligned = apply_renames(aligned, rename_mapping(proposals, custom_names))
+    dtype = np.float32 if compact_values else np.float64
+    check_memory_budget(aligned, len(dataframes[0]), dtype, memory_budget_mb)
+    cube = join_files(aligned, custom_names,
+                      duplicate_policy=duplicate_policy, max_rows=max_rows, dtype=dtype)
+    base_df = prepare_base(dataframes[0], copy=False)
+    if table is not None:
+        cube, base_df, unparsed = _with_limits(cube, table, unparsed, log)
+    _save_history(history, cube, paths, log)
+    merged_output = _result_frame(cube, base_df, custom_names, expansion_filter, reference)
+    return merged_output, unparsed
+
+
+def _with_limits(cube, table, unparsed, log):
+    cube, matched = apply_limits(cube, table)
+    if not matched:
+        log(f"Warning: {NO_MATCH_WARNING}")
+    return cube, table.base, pd.concat([unparsed, unparsed_report([table.unparsed], ["Limits"])], ignore_index=True)
+
+
+def _save_history(history, cube, paths, log):
+    if history is not None:
+        sources = [os.path.basename(path) if isinstance(path, (str, os.PathLike)) else getattr(path, "name", name)
+                   for path, name in zip(paths, cube.names)]
+        log(f"Saved as run {history.save_run(cube, sources)} in {history.path}")
+
+
+def _result_frame(cube, base_df, custom_names, expansion_filter, reference):
+    if expansion_filter == WORST_CASE:
+        cube = worst_case_view(cube)
+        merged_output = cube_output(cube)
+    else:
+        merged_output = build_merged_output(base_df, cube)
+    if reference is not None:
+        merged_output = attach_key_columns(merged_output, cube, delta_columns(cube, reference))
+    merged_output = filter_expansion(merged_output, expansion_filter)
+    return reorder_output_columns(merged_output, custom_names, marker="compliance")
+
+
+def log_unparsed(unparsed, log=_log):
+    for _, row in unparsed.iterrows():
+        log(f'Warning: {row["Unparseable cells"]} unparseable cells in {row["Column"]}, e.g. {row["Examples"]}')
+
+
+def run_comparison(paths, custom_names, expansion_filter="All", output="comparison_grouped.xlsx",
+                   reference=None, delta_thresholds=(0, 10), duplicate_policy="Keep first", max_rows=None,
+                   reconcile_similarity=None, memory_budget_mb=None, compact_values=False, engine="pandas", limits=None,
+                   history=None):
+    merged_output, unparsed = compare_files(paths, custom_names, expansion_filter, reference, duplicate_policy, max_rows,
+                                            reconcile_similarity, memory_budget_mb, compact_values, engine, limits=limits,
+                                            history=history)
+    log_unparsed(unparsed)
+    with open(output, "wb") as f:
+        f.write(write_comparison_workbook(merged_output, custom_names, delta_thresholds if reference is not None else None).getbuffer())
+    return merged_output
+
+
+def run_sql_comparison(paths, custom_names, expansion_filter="All", output="comparison_grouped.xlsx",
+                       duplicate_policy="Keep first", max_rows=0, memory_limit=None):
+    # Out-of-core run: the result is written from the database batch by batch.
+    # Returns (rows, failing rows).
+    comparison = SQLComparison(paths, custom_names, duplicate_policy, max_rows or 0, memory_limit).run()
+    try:
+        log_unparsed(comparison.unparsed)
+        if output.lower().endswith(".parquet"):
+            comparison.write_parquet(output, expansion_filter)
+        else:
+            _, columns = comparison.result(expansion_filter)
+            write_comparison_stream(comparison.batches(expansion_filter), columns,
+                                    comparison.column_widths(expansion_filter), custom_names, output)
+        return comparison.row_count(expansion_filter), comparison.failed_count(expansion_filter)
+    finally:
+        comparison.close()
+
+
+def run_partitioned_comparison(paths, custom_names, expansion_filter="All", output="comparison_grouped.xlsx",
+                               reference=None, delta_thresholds=(0, 10), duplicate_policy="Keep first", max_rows=0,
+                               partitions=None, workers=1, memory_budget_mb=None):
+    # Bounded-memory run: the files are split by spec_number and the result is written a
+    # partition at a time. Returns (rows, failing rows).
+    comparison = PartitionedComparison(paths, custom_names, duplicate_policy, max_rows or 0, partitions, workers, reference,
+                                       memory_budget_mb)
+    try:
+        _, columns = comparison.result(expansion_filter)
+        log_unparsed(comparison.unparsed)
+        if output.lower().endswith(".parquet"):
+            comparison.write_parquet(output, expansion_filter)
+        else:
+            write_comparison_stream(comparison.batches(expansion_filter), columns, comparison.column_widths(expansion_filter),
+                                    custom_names, output, delta_thresholds if reference is not None else None)
+        return comparison.row_count(expansion_filter), comparison.failed_count(expansion_filter)
+    finally:
+        comparison.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare CL files without the Streamlit UI and write the Excel comparison.")
+    parser.add_argument("files", nargs="+", help="CL .csv files; the first one supplies the limits and the base rows")
+    parser.add_argument("--limits", default=None, metavar="CSV",
+                        help="limits-only .csv (key columns and the three columns starting at limits) that supplies the "
+                             "limits and the output rows instead of the first file")
+    parser.add_argument("--history", nargs="?", const="", default=None, metavar="DB",
+                        help=f"append the result to the SQLite history of lots (default: {HISTORY_DB_ENV} or cl_history.sqlite "
+                             "next to this script)")
+    parser.add_argument("--names", nargs="+", help="custom name per file (default: File 1, File 2, ...)")
+    parser.add_argument("--expansion", default="All",
+                        help=f'"All", "Blank", "{WORST_CASE}" or one spec_id_expansion value such as "1"')
+    parser.add_argument("--output", default="comparison_grouped.xlsx",
+                        help="Excel file to write; with --engine DuckDB or Partitioned a .parquet path writes Parquet instead")
+    parser.add_argument("--engine", choices=ENGINES, default="pandas",
+                        help="pandas compares in memory; Polars runs the same comparison as a lazy query; DuckDB runs it as SQL "
+                             "and spills to disk; Partitioned splits the files by spec_number and compares one part at a time")
+    parser.add_argument("--sql-memory", default=None, metavar="LIMIT",
+                        help=f'memory limit of the DuckDB engine such as "4GB" (default: {SQL_MEMORY_ENV} or 80%% of RAM)')
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="number of spec_number partitions of the Partitioned engine (default: one per million rows)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the Partitioned engine")
+    parser.add_argument("--duplicates", choices=DUPLICATE_POLICIES, default="Keep first",
+                        help="how to treat spec keys repeated within a file")
+    parser.add_argument("--max-rows", type=int, default=None,
+                        help=f"refuse inputs with more rows in total than this (default: {MAX_ROWS_ENV} or 5,000,000; 0 = no limit)")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help=f"refuse comparisons estimated to need more memory than this (default: {MEMORY_BUDGET_ENV} or {DEFAULT_MEMORY_BUDGET_MB}; 0 = no limit; per partition with --engine Partitioned)")
+    parser.add_argument("--float32", action="store_true", help="store CL values as float32 (7 significant digits) to halve their memory")
+    parser.add_argument("--reconcile", type=float, nargs="?", const=DEFAULT_SIMILARITY, default=None, metavar="SIMILARITY",
+                        help=f"match renamed spec_item_old_name values to the first file's names (default similarity {DEFAULT_SIMILARITY})")
+    parser.add_argument("--reference", help="custom name of the file the other files are reported as deltas from")
+    parser.add_argument("--delta-abs", type=float, default=0, help="highlight absolute changes above this (0 = off)")
+    parser.add_argument("--delta-pct", type=float, default=10, help="highlight relative changes above this %% (0 = off)")
+    parser.add_argument("--profile", choices=PROFILERS, default=None,
+                        help=f"profile the run and write a trace next to --output (or set {PROFILE_ENV})")
+    args = parser.parse_args(argv)
+
+    custom_names = args.names or [f"File {i + 1}" for i in range(len(args.files))]
+    if len(custom_names) != len(args.files):
+        parser.error("--names needs one name per file")
+    if len(set(custom_names)) != len(custom_names):
+        parser.error("--names must all differ")
+    if args.reference is not None and args.reference not in custom_names:
+        parser.error(f"--reference must be one of {custom_names}")
+
+    if args.engine == "DuckDB" and (args.reference is not None or args.reconcile is not None):
+        parser.error("--reference and --reconcile need the pandas engine")
+    if args.engine in ["Polars", "Partitioned"] and (args.reconcile is not None or args.float32):
+        parser.error("--reconcile and --float32 need the pandas engine")
+    if args.engine in ["DuckDB", "Partitioned"] and (args.limits is not None or args.history is not None):
+        parser.error("--limits and --history need the pandas or Polars engine")
+
+    profiler = args.profile or profiler_from_env()
+    with profile_run(profiler, os.path.splitext(args.output)[0]) as run_profiler:
+        if args.engine == "DuckDB":
+            rows, failed = run_sql_comparison(args.files, custom_names, args.expansion, args.output,
+                                              args.duplicates, args.max_rows, args.sql_memory)
+        elif args.engine == "Partitioned":
+            rows, failed = run_partitioned_comparison(args.files, custom_names, args.expansion, args.output,
+                                                      args.reference, (args.delta_abs, args.delta_pct), args.duplicates,
+                                                      args.max_rows, args.partitions, args.workers, args.memory_budget)
+        else:
+            merged_output = run_comparison(args.files, custom_names, args.expansion, args.output,
+                                           args.reference, (args.delta_abs, args.delta_pct), args.duplicates, args.max_rows,
+                                           args.reconcile, args.memory_budget, args.float32, args.engine, args.limits,
+                                           None if args.history is None else ResultsStore(args.history or None))
+            rows, failed = len(merged_output), int((merged_output["Pass or Fail"] == "Fail").sum())
+
+    print(f"{rows} rows written to {args.output} ({failed} failing)")
+    peak = peak_rss_bytes()
+    if peak:
+        print(f"Peak RSS: {peak / 1024 / 1024:,.0f} MB")
+    if run_profiler is not None:
+        print(f"Profile written to {run_profiler.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
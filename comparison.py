@@ -0,0 +1,437 @@
+import os
+import re
+from bisect import bisect_left, bisect_right
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+from parsing import parse_numeric
+
+from cube import (
+    KEY_COLUMNS, LIMIT_COLUMNS, LOT_STAT_COLUMNS, VALUE_TYPES, WORST_CASE, build_cube, collapse_expansions, evaluate,
+    presence_labels, key_value
+)
+
+REQUIRED_COLUMNS = ["spec_number", "cm_summary", "limits", "spec_item_category", "spec_item_old_name"]
+DUPLICATE_POLICIES = ["Keep first", "Worst case", "Reject"]
+ENGINES = ["pandas", "Polars", "DuckDB", "Partitioned"]
+MAX_ROWS_ENV = "CL_COMPARE_MAX_ROWS"
+DEFAULT_MAX_ROWS = 5_000_000
+MEMORY_BUDGET_ENV = "CL_COMPARE_MEMORY_MB"
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+
+class ComparisonError(ValueError):
+    pass
+
+
+def read_cl_files(files):
+    dataframes = []
+    for file in files:
+        if hasattr(file, "seek"):
+            file.seek(0)
+        dataframes.append(pd.read_csv(file))
+    return dataframes
+
+
+def missing_required_columns(dataframes):
+    return [col for df in dataframes for col in REQUIRED_COLUMNS if col not in df.columns]
+
+
+def align_file(df, index):
+    # Keys, the three CL columns starting at cm_summary and, for the first file, the three
+    # limit columns starting at limits. CL columns get their file name when the cube is built.
+    idx_cm_summary = df.columns.tolist().index("cm_summary")
+    idx_limits = df.columns.tolist().index("limits")
+
+    cl_columns = df.columns[idx_cm_summary: idx_cm_summary + 3].tolist()
+
+    if index == 0:
+        limit_columns = df.columns[idx_limits: idx_limits + 3].tolist()
+        limit_data = df[limit_columns]
+        limit_data.columns = LIMIT_COLUMNS
+        columns = pd.concat([df[KEY_COLUMNS], limit_data, df[cl_columns]], axis=1)
+        columns.columns = KEY_COLUMNS + LIMIT_COLUMNS + VALUE_TYPES
+    else:
+        columns = df[KEY_COLUMNS + cl_columns].copy()
+        columns.columns = KEY_COLUMNS + VALUE_TYPES
+    return columns
+
+
+def coerce_numeric(df, columns):
+    # Parses the columns in place (units, SI prefixes, thousands separators, see parsing.py).
+    # Returns {column: (count, first few originals)} for cells that look numeric but could not be read.
+    unparsed = {}
+    for col in columns:
+        values, bad = parse_numeric(df[col])
+        if bad.any():
+            unparsed[col] = (int(bad.sum()), df[col][bad].astype(str).head(5).tolist())
+        df[col] = values
+    return unparsed
+
+
+def unparsed_report(unparsed_by_file, custom_names):
+    rows = []
+    for name, unparsed in zip(custom_names, unparsed_by_file):
+        for col, (count, examples) in unparsed.items():
+            rows.append({
+                "File": name,
+                "Column": f"{col}_{name}" if col in VALUE_TYPES else col,
+                "Unparseable cells": count,
+                "Examples": ", ".join(examples),
+            })
+    return pd.DataFrame(rows, columns=["File", "Column", "Unparseable cells", "Examples"])
+
+
+def clean_spec_id(val):
+    try:
+        f = float(val)
+        if f.is_integer():
+            return str(int(f))  # turn 1.0 → "1"
+        else:
+            return str(f)       # leave as "1.5"
+    except:
+        return "" if pd.isna(val) or str(val).strip().lower() == "nan" else str(val).strip()
+
+
+def normalize_expansion(series):
+    return series.astype(str).str.strip().replace("nan", "").apply(clean_spec_id)
+
+
+def sort_order(keys):
+    # Blank expansion first within each spec_number, then the numbered expansions
+    order = pd.DataFrame({
+        "spec_number": keys["spec_number"].to_numpy(),
+        "has_expansion": (keys["spec_id_expansion"] != "").to_numpy(),
+        "spec_id_expansion": keys["spec_id_expansion"].to_numpy(),
+    })
+    return order.sort_values(["spec_number", "has_expansion", "spec_id_expansion"], kind="stable").index.to_numpy()
+
+
+def expansion_options(expansions):
+    # Radio options from the data: All, Blank if present, each expansion in natural order,
+    # then the computed worst case across expansions
+    def natural(value):
+        try:
+            return (0, float(value), value)
+        except ValueError:
+            return (1, 0.0, value)
+
+    values = pd.unique(expansions)
+    options = ["All"] + (["Blank"] if "" in values else [])
+    options += sorted((v for v in values if v != ""), key=natural)
+    return options + [WORST_CASE]
+
+
+def expansion_mask(expansions, expansion_filter):
+    if expansion_filter in ["All", WORST_CASE]:
+        return np.ones(len(expansions), dtype=bool)
+    value = "" if expansion_filter == "Blank" else expansion_filter
+    return (expansions == value).to_numpy()
+
+
+def filter_expansion(df, expansion_filter):
+    if expansion_filter in ["All", WORST_CASE]:
+        return df
+    return df[expansion_mask(df["spec_id_expansion"], expansion_filter)]
+
+
+def filter_cube_expansion(cube, expansion_filter):
+    if expansion_filter in ["All", WORST_CASE]:
+        return cube
+    return cube.take(np.flatnonzero(expansion_mask(cube.keys["spec_id_expansion"], expansion_filter)))
+
+
+def natural_key(label):
+    # "1.9" < "1.10" < "1.10a": dotted/alphanumeric parts compared as numbers where they are numbers
+    parts = re.findall(r"\d+|[^\d.\-_\s]+", str(label).strip().lower())
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in parts)
+
+
+def spec_number_index(spec_numbers):
+    # Sorted natural keys of the distinct spec numbers and each key's rank among them (-1 for blanks),
+    # so range and prefix filters become two bisections and an integer comparison
+    codes, uniques = pd.factorize(spec_numbers)
+    labels = [str(value) for value in uniques]
+    sort_keys = [natural_key(label) for label in labels]
+    order = sorted(range(len(labels)), key=sort_keys.__getitem__)
+    rank_of_code = np.empty(len(labels), dtype=np.int64)
+    rank_of_code[order] = np.arange(len(labels))
+    ranks = np.full(len(codes), -1, dtype=np.int64)
+    ranks[codes >= 0] = rank_of_code[codes[codes >= 0]]
+    return [labels[i] for i in order], [sort_keys[i] for i in order], ranks
+
+
+def spec_range_mask(index, start, stop):
+    _, sort_keys, ranks = index
+    lo = bisect_left(sort_keys, natural_key(start)) if str(start).strip() else 0
+    hi = bisect_right(sort_keys, natural_key(stop)) if str(stop).strip() else len(sort_keys)
+    return (ranks >= lo) & (ranks < hi)
+
+
+def spec_prefix_mask(index, prefix):
+    # Prefix by parts: "1.1" matches 1.1 and 1.1.x but not 1.10
+    _, sort_keys, ranks = index
+    key = natural_key(prefix)
+    if not key:
+        return ranks >= 0
+    lo = bisect_left(sort_keys, key)
+    hi = bisect_left(sort_keys, key + ((2, 0, ""),))
+    return (ranks >= lo) & (ranks < hi)
+
+
+def output_columns_to_move(columns, custom_names):
+    columns_to_move = [col for col in ["File Presence"] + LIMIT_COLUMNS if col in columns]
+    for name in custom_names:
+        for col in [f"Minimum_{name}", f"Typical_{name}", f"Maximum_{name}"]:
+            if col in columns:
+                columns_to_move.append(col)
+    for name in custom_names:
+        for value_type in VALUE_TYPES:
+            for col in [f"{value_type}_Delta_{name}", f"{value_type}_Delta%_{name}"]:
+                if col in columns:
+                    columns_to_move.append(col)
+    for col in ["Pass or Fail", "Why Failed"] + LOT_STAT_COLUMNS:
+        if col in columns:
+            columns_to_move.append(col)
+    return columns_to_move
+
+
+def reorder_output_columns(merged_output, custom_names, marker="compliance"):
+    # The first data row carries sub-headers; CL columns are moved right after the one reading `marker`.
+    columns_to_move = output_columns_to_move(merged_output.columns, custom_names)
+
+    second_row = merged_output.iloc[0] if len(merged_output) > 0 else None
+    marker_column_name = None
+    if second_row is not None:
+        for col in merged_output.columns:
+            if str(second_row[col]).strip().lower() == marker:
+                marker_column_name = col
+                break
+
+    if marker_column_name:
+        col_list = merged_output.columns.tolist()
+        idx = col_list.index(marker_column_name) + 1
+
+        for col in columns_to_move:
+            if col in col_list:
+                col_list.remove(col)
+
+        reordered_cols = col_list[:idx] + columns_to_move + col_list[idx:]
+        merged_output = merged_output[reordered_cols]
+    return merged_output
+
+
+def key_hashes(df):
+    # One uint64 per row for the four-column key, so duplicate checks scan a single array
+    return pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False)
+
+
+def key_text(keys):
+    # The composite key as text, the same whether a column was read as int, float or text
+    text = pd.DataFrame({col: keys[col].map(key_value).to_numpy() for col in KEY_COLUMNS})
+    text["spec_id_expansion"] = normalize_expansion(text["spec_id_expansion"]).to_numpy()
+    return text
+
+
+def key_text_hashes(keys):
+    # key_hashes of the key text, for matching keys between files read with different dtypes
+    return key_hashes(key_text(keys)).to_numpy()
+
+
+def duplicate_key_count(df):
+    # Rows whose key already appeared earlier in the same file
+    return int(key_hashes(df).duplicated().sum())
+
+
+def max_rows_from_env():
+    return int(os.environ.get(MAX_ROWS_ENV, DEFAULT_MAX_ROWS))
+
+
+def check_row_limit(total_rows, max_rows=None):
+    max_rows = max_rows_from_env() if max_rows is None else max_rows
+    if max_rows and total_rows > max_rows:
+        raise ComparisonError(
+            f"{total_rows:,} rows across the files exceed the limit of {max_rows:,} (set {MAX_ROWS_ENV} to change it)."
+        )
+
+
+def check_duplicates(duplicates, custom_names, duplicate_policy="Keep first"):
+    if duplicate_policy == "Reject" and any(duplicates):
+        files = ", ".join(f'"{name}" ({count:,} repeated)' for name, count in zip(custom_names, duplicates) if count)
+        raise ComparisonError(f"Repeated spec keys in {files}. Remove them or choose another duplicate policy.")
+
+
+def check_inputs(aligned, custom_names, duplicate_policy="Keep first", max_rows=None):
+    # Stop before the join: the row guard bounds the work, "Reject" refuses repeated keys.
+    # Returns the number of repeated-key rows per file.
+    check_row_limit(sum(len(df) for df in aligned), max_rows)
+    duplicates = [duplicate_key_count(df) for df in aligned]
+    check_duplicates(duplicates, custom_names, duplicate_policy)
+    return duplicates
+
+
+def memory_budget_from_env():
+    return int(os.environ.get(MEMORY_BUDGET_ENV, DEFAULT_MEMORY_BUDGET_MB))
+
+
+def estimate_memory_mb(aligned, base_rows=0, dtype=np.float64):
+    # Rough size of one comparison: the aligned inputs, the cube (CL values, presence flags and
+    # per-key columns) and the merged output over the base rows, which is mostly float64
+    n_files = len(aligned)
+    total_rows = sum(len(df) for df in aligned)
+    inputs = sum(int(df.memory_usage(deep=True).sum()) for df in aligned)
+    cube = total_rows * (n_files * 3 * np.dtype(dtype).itemsize + n_files + 24 + 3 * 8)
+    merged = base_rows * ((n_files * 3 + 3) * 8 + 32)
+    return (inputs + cube + merged) / (1024 * 1024)
+
+
+def check_memory_budget(aligned, base_rows=0, dtype=np.float64, budget_mb=None):
+    budget_mb = memory_budget_from_env() if budget_mb is None else budget_mb
+    estimate = estimate_memory_mb(aligned, base_rows, dtype)
+    if budget_mb and estimate > budget_mb:
+        raise ComparisonError(
+            f"This comparison needs about {estimate:,.0f} MB, over the budget of {budget_mb:,} MB per run "
+            f"(set {MEMORY_BUDGET_ENV} to change it, or compare fewer or smaller files)."
+        )
+    return estimate
+
+
+def untimed(stage):
+    return nullcontext({})
+
+
+def prepare_file(df, index):
+    # Everything that only depends on this one upload: validation, alignment, key
+    # normalization and numeric parsing. Returns (aligned, missing_columns, unparsed).
+    missing = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing:
+        return None, missing, {}
+    aligned = align_file(df, index)
+    aligned["spec_id_expansion"] = normalize_expansion(aligned["spec_id_expansion"])
+    unparsed = coerce_numeric(aligned, (LIMIT_COLUMNS if index == 0 else []) + VALUE_TYPES)
+    return aligned, [], unparsed
+
+
+def prepare_base(base_df, copy=True):
+    # copy=False normalizes a frame nothing else holds on to in place
+    if copy:
+        base_df = base_df.copy()
+    base_df["spec_id_expansion"] = normalize_expansion(base_df["spec_id_expansion"])
+    return base_df
+
+
+def prepare_upload(file, index, timer=untimed):
+    # Per-upload work the app runs in the background as soon as a file arrives
+    with timer("parse") as stage:
+        df = read_cl_files([file])[0]
+        stage["rows"] = len(df)
+    with timer("align") as stage:
+        aligned, missing, unparsed = prepare_file(df, index)
+        stage["rows"] = 0 if aligned is None else len(aligned)
+    base_df = None
+    if index == 0 and not missing:
+        with timer("base_prepare"):
+            base_df = prepare_base(df, copy=False)
+    duplicates = duplicate_key_count(aligned) if aligned is not None else 0
+    return {
+        "aligned": aligned, "base": base_df, "missing": missing, "rows": len(df), "duplicates": duplicates,
+        "unparsed": unparsed,
+    }
+
+
+def join_files(aligned, custom_names, timer=untimed, duplicate_policy="Keep first", max_rows=None, dtype=np.float64):
+    # The part of the comparison that needs every file: key alignment into the CL cube,
+    # presence, ordering and Pass/Fail, all as array operations
+    with timer("duplicates") as stage:
+        duplicates = check_inputs(aligned, custom_names, duplicate_policy, max_rows)
+        stage["rows"] = sum(duplicates)
+    with timer("outer_merge") as stage:
+        cube = build_cube(aligned, custom_names, worst_case=duplicate_policy == "Worst case", dtype=dtype)
+        stage["rows"] = cube.n_keys
+    with timer("presence") as stage:
+        cube.columns["File Presence"] = presence_labels(cube.present)
+        stage["rows"] = cube.n_keys
+    with timer("sort") as stage:
+        cube = cube.reorder(sort_order(cube.keys))
+        stage["rows"] = cube.n_keys
+    with timer("pass_fail") as stage:
+        add_pass_fail(cube)
+        stage["rows"] = cube.n_keys
+    return cube
+
+
+def add_pass_fail(cube):
+    failed, why = evaluate(cube)
+    cube.columns["Pass or Fail"] = np.where(failed, "Fail", "Pass").astype(object)
+    cube.columns["Why Failed"] = why
+    return cube
+
+
+def worst_case_view(cube):
+    # Worst case across expansions as its own cube, labelled and evaluated like the full one
+    view = collapse_expansions(cube)
+    view.columns["File Presence"] = presence_labels(view.present)
+    return add_pass_fail(view)
+
+
+def cube_output(cube):
+    # Result frame straight from a cube, for views without base rows, in the column order
+    # build_merged_output gives the result columns
+    frame = cube.to_frame(extra_columns=["Pass or Fail", "Why Failed"])
+    frame.insert(2, "File Presence", cube.columns["File Presence"])
+    return frame
+
+
+def combine_files(dataframes, custom_names, timer=untimed, duplicate_policy="Keep first", max_rows=None):
+    # `timer(stage)` is a context manager wrapped around each pipeline stage; it yields a
+    # dict the stage fills with the row count it produced (see diagnostics.StageRecorder)
+    with timer("align") as stage:
+        aligned = [align_file(df, i) for i, df in enumerate(dataframes)]
+        stage["rows"] = sum(len(df) for df in aligned)
+    with timer("normalization"):
+        for i, df in enumerate(aligned):
+            df["spec_id_expansion"] = normalize_expansion(df["spec_id_expansion"])
+            coerce_numeric(df, (LIMIT_COLUMNS if i == 0 else []) + VALUE_TYPES)
+    return join_files(aligned, custom_names, timer, duplicate_policy, max_rows)
+
+
+def build_merged_output(base_df, cube, timer=untimed):
+    # base_df is the first upload normalized with prepare_base. Its rows line up with
+    # cube.base_index, so the results are gathered per row instead of merged on the keys.
+    with timer("base_merge") as stage:
+        rows = cube.base_index
+        results = cube.value_frame(rows)
+        results.insert(0, "File Presence", cube.columns["File Presence"][rows])
+        results["Pass or Fail"] = cube.columns["Pass or Fail"][rows]
+        results["Why Failed"] = cube.columns["Why Failed"][rows]
+        results.index = base_df.index
+        merged_output = pd.concat([base_df, results], axis=1)
+        stage["rows"] = len(merged_output)
+    return merged_output
+
+
+def attach_key_columns(merged_output, cube, columns):
+    # Per-key arrays of the full (unfiltered) cube onto the rows of build_merged_output
+    rows = cube.base_index
+    return merged_output.assign(**{col: values[rows] for col, values in columns.items()})
+
+
+def delta_flags(df, custom_names, abs_threshold=0, pct_threshold=0):
+    # Delta column -> bool array of changes beyond either threshold; a threshold of 0 is off.
+    # Both the absolute and the relative cell of a pair are flagged together.
+    flags = {}
+    with np.errstate(invalid="ignore"):
+        for name in custom_names:
+            for value_type in VALUE_TYPES:
+                delta_col, pct_col = f"{value_type}_Delta_{name}", f"{value_type}_Delta%_{name}"
+                if delta_col not in df.columns or pct_col not in df.columns:
+                    continue
+                changed = np.zeros(len(df), dtype=bool)
+                if abs_threshold:
+                    changed |= np.abs(df[delta_col].to_numpy(dtype=float)) > abs_threshold
+                if pct_threshold:
+                    changed |= np.abs(df[pct_col].to_numpy(dtype=float)) > pct_threshold
+                flags[delta_col] = flags[pct_col] = changed
+    return flags
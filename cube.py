@@ -0,0 +1,303 @@
+from dataclasses import dataclass, field, replace
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"]
+LIMIT_COLUMNS = ["Minimum_Limits1", "Typical_Limits1", "Maximum_Limits1"]
+VALUE_TYPES = ["Minimum", "Typical", "Maximum"]
+MIN, TYP, MAX = 0, 1, 2
+GROUP_COLUMNS = ["spec_number", "spec_item_category", "spec_item_old_name"]
+WORST_CASE = "Worst case"
+LOT_STAT_COLUMNS = ["Lots", "Lot Mean", "Lot Sigma", "Lot Min", "Lot Max", "Lot Spread", "Cpk", "Outlier Lots"]
+OUTLIER_THRESHOLDS = {"MAD": 3.5, "z-score": 3.0}
+
+
+@dataclass
+class CLCube:
+    # CL comparison state as dense arrays:
+    #   keys     DataFrame of the composite key, one row per spec key
+    #   values   float (n_keys, n_files, 3), Minimum/Typical/Maximum per file, NaN where absent
+    #   limits   float (n_keys, 3), Minimum/Typical/Maximum limits
+    #   present  bool (n_keys, n_files), whether the key occurs in the file at all
+    #   base_index  key position of every row of the first file, in file order
+    keys: pd.DataFrame
+    values: np.ndarray
+    limits: np.ndarray
+    present: np.ndarray
+    names: list
+    base_index: np.ndarray = None
+    columns: dict = field(default_factory=dict)
+
+    @property
+    def n_keys(self):
+        return len(self.keys)
+
+    @property
+    def n_files(self):
+        return len(self.names)
+
+    def cl_columns(self):
+        return [f"{value_type}_{name}" for name in self.names for value_type in VALUE_TYPES]
+
+    def take(self, positions):
+        # Sub-cube of the given key positions; base_index only applies to the full cube
+        positions = np.asarray(positions)
+        return CLCube(
+            keys=self.keys.iloc[positions].reset_index(drop=True),
+            values=self.values[positions],
+            limits=self.limits[positions],
+            present=self.present[positions],
+            names=self.names,
+            columns={col: values[positions] for col, values in self.columns.items()},
+        )
+
+    def reorder(self, order):
+        cube = self.take(order)
+        if self.base_index is not None:
+            new_position = np.empty(len(order), dtype=np.int64)
+            new_position[order] = np.arange(len(order))
+            cube.base_index = new_position[self.base_index]
+        return cube
+
+    def with_columns(self, columns):
+        # The same cube with more per-key columns; the arrays are shared, the columns dict is
+        # new, so a cube held by a cache or a finished job is left as it is
+        return replace(self, columns={**self.columns, **columns})
+
+    def value_frame(self, rows=None):
+        # Limit and CL columns, optionally gathered for the given key positions
+        rows = slice(None) if rows is None else rows
+        data = {col: self.limits[rows, i] for i, col in enumerate(LIMIT_COLUMNS)}
+        for f, name in enumerate(self.names):
+            for t, value_type in enumerate(VALUE_TYPES):
+                data[f"{value_type}_{name}"] = widen(self.values[rows, f, t])
+        return pd.DataFrame(data)
+
+    def to_frame(self, extra_columns=None, values=True):
+        # Wide frame as the app and export display it: keys, limits, per-file CL columns, then extras
+        frame = pd.concat([self.keys, self.value_frame()], axis=1) if values else self.keys.copy()
+        for col in extra_columns if extra_columns is not None else self.columns:
+            frame[col] = self.columns[col]
+        return frame
+
+    def margins(self):
+        # Positive = inside the limit. (n_keys, n_files) each
+        with np.errstate(invalid="ignore"):
+            return {
+                "Minimum": widen(self.values[:, :, MIN]) - self.limits[:, None, MIN],
+                "Maximum": self.limits[:, None, MAX] - widen(self.values[:, :, MAX]),
+            }
+
+
+def widen(values, digits=7):
+    # Values of a float32 cube back as float64 at the precision float32 holds, so 0.1f reads
+    # as 0.1 again in comparisons, statistics and the output. float64 input is returned as is.
+    if values.dtype == np.float64:
+        return values
+    values = values.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        scale = 10.0 ** (digits - 1 - np.floor(np.log10(np.abs(values))))
+        rounded = np.round(values * scale) / scale
+    return np.where(np.isfinite(rounded), rounded, values)
+
+
+def key_value(value):
+    # One key part as text: whole numbers without ".0", blanks as "". Text is only stripped, so
+    # "1.10" stays apart from "1.1".
+    if isinstance(value, (float, np.floating)):
+        return "" if np.isnan(value) else str(int(value)) if value.is_integer() else str(value)
+    return "" if value is None or value is pd.NA else str(value).strip()
+
+
+def composite_key_codes(frames, key_columns=KEY_COLUMNS):
+    # One integer code per distinct key across all frames, numbered in order of first appearance.
+    # Columns are factorized one at a time and folded pairwise so the codes never overflow.
+    # Values are told apart by their key_value, so 1 read as int, 1.0 as float and "1" as text
+    # are one key, as a file with a text spec_number elsewhere is read as object.
+    stacked = {col: pd.concat([df[col] for df in frames], ignore_index=True) for col in key_columns}
+    codes = None
+    for col in key_columns:
+        raw_codes, uniques = pd.factorize(stacked[col], use_na_sentinel=False)
+        text_codes, _ = pd.factorize(pd.Series(uniques, dtype=object).map(key_value))
+        col_codes = text_codes[raw_codes]
+        if codes is None:
+            codes = col_codes.astype(np.int64)
+        else:
+            codes, _ = pd.factorize(codes * (int(col_codes.max(initial=0)) + 1) + col_codes)
+            codes = codes.astype(np.int64)
+    bounds = np.cumsum([0] + [len(df) for df in frames])
+    return [codes[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])], stacked
+
+
+def build_cube(aligned, names, limit_columns=LIMIT_COLUMNS, value_columns=VALUE_TYPES, worst_case=False,
+               dtype=np.float64):
+    # aligned: one frame per file with KEY_COLUMNS and the three value columns; the first also
+    # carries the limit columns. Repeated keys within a file keep their first row, or with
+    # worst_case their lowest Minimum and highest Maximum. dtype=np.float32 halves the CL values;
+    # read them through widen().
+    file_codes, stacked = composite_key_codes(aligned)
+    all_codes = np.concatenate(file_codes) if file_codes else np.empty(0, dtype=np.int64)
+    n_keys = int(all_codes.max(initial=-1)) + 1
+
+    _, first_rows = np.unique(all_codes, return_index=True)
+    keys = pd.DataFrame({col: stacked[col].to_numpy()[first_rows] for col in KEY_COLUMNS})
+
+    values = np.full((n_keys, len(aligned), len(value_columns)), np.nan, dtype=dtype)
+    present = np.zeros((n_keys, len(aligned)), dtype=bool)
+    limits = np.full((n_keys, len(limit_columns)), np.nan)
+    for f, (df, codes) in enumerate(zip(aligned, file_codes)):
+        # Assigning in reverse lets the first occurrence of a repeated key win
+        values[codes[::-1], f] = df[value_columns].to_numpy(dtype=float)[::-1]
+        present[codes, f] = True
+        if worst_case and len(codes):
+            extremes = df[[value_columns[MIN], value_columns[MAX]]].groupby(codes).agg(["min", "max"])
+            values[extremes.index, f, MIN] = extremes[(value_columns[MIN], "min")].to_numpy(dtype=float)
+            values[extremes.index, f, MAX] = extremes[(value_columns[MAX], "max")].to_numpy(dtype=float)
+        if f == 0:
+            limits[codes[::-1]] = df[limit_columns].to_numpy(dtype=float)[::-1]
+
+    return CLCube(keys=keys, values=values, limits=limits, present=present, names=list(names),
+                  base_index=file_codes[0] if file_codes else None)
+
+
+def collapse_expansions(cube):
+    # One key per spec_number/category/old name across its expansions, per file the lowest
+    # Minimum and highest Maximum. Typical values and the limits come from the group's first
+    # key, which is the blank expansion once the cube is sorted.
+    if cube.n_keys == 0:
+        return cube.take(np.arange(0))
+    (codes,), _ = composite_key_codes([cube.keys], GROUP_COLUMNS)
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    values = cube.values[order]
+
+    collapsed = values[starts].copy()
+    collapsed[:, :, MIN] = np.fmin.reduceat(values[:, :, MIN], starts, axis=0)
+    collapsed[:, :, MAX] = np.fmax.reduceat(values[:, :, MAX], starts, axis=0)
+
+    keys = cube.keys.iloc[order[starts]].reset_index(drop=True)
+    keys["spec_id_expansion"] = WORST_CASE
+    return CLCube(
+        keys=keys, values=collapsed, limits=cube.limits[order[starts]],
+        present=np.logical_or.reduceat(cube.present[order], starts, axis=0), names=cube.names,
+        # The view has no base rows of its own; each output row is one collapsed key
+        base_index=np.arange(len(starts)),
+    )
+
+
+def presence_labels(present):
+    # Same wording as before: all files, a single file, or the list of files, encoded per bit pattern
+    n_files = present.shape[1]
+    patterns = present.astype(np.int64) @ (1 << np.arange(n_files, dtype=np.int64))
+    unique_patterns, inverse = np.unique(patterns, return_inverse=True)
+    labels = []
+    for pattern in unique_patterns:
+        found_in_files = [str(i + 1) for i in range(n_files) if pattern >> i & 1]
+        if len(found_in_files) == n_files:
+            labels.append("Found in all files")
+        elif not found_in_files:
+            # Only a separate limits source has keys no file has
+            labels.append("Not found in any uploaded file")
+        elif len(found_in_files) == 1:
+            labels.append(f"Only found in uploaded file {found_in_files[0]}")
+        else:
+            labels.append(f"Found in files: {', '.join(found_in_files)}")
+    return np.array(labels, dtype=object)[inverse.reshape(-1)]
+
+
+def file_failures(cube):
+    # Minimum below Minimum_Limits1, Maximum above Maximum_Limits1, or Typical outside both bounds,
+    # as bool (n_keys, n_files) each
+    typ = widen(cube.values[:, :, TYP])
+    with np.errstate(invalid="ignore"):
+        min_fail = widen(cube.values[:, :, MIN]) < cube.limits[:, None, MIN]
+        max_fail = widen(cube.values[:, :, MAX]) > cube.limits[:, None, MAX]
+        typ_fail = (typ < cube.limits[:, None, MIN]) & (typ > cube.limits[:, None, MAX])
+    return min_fail, max_fail, typ_fail
+
+
+def evaluate(cube):
+    # Returns (failed, why) per key; reasons are listed per file in the order the Excel has always used
+    min_fail, max_fail, typ_fail = file_failures(cube)
+    failed = min_fail.any(axis=1) | max_fail.any(axis=1) | typ_fail.any(axis=1)
+
+    why = np.full(cube.n_keys, "", dtype=object)
+    rows = np.flatnonzero(failed)
+    reasons = np.full(len(rows), "", dtype=object)
+    for f, name in enumerate(cube.names):
+        for mask, reason in [
+            (min_fail[rows, f], f"Minimum_{name} < Minimum_Limits1"),
+            (max_fail[rows, f], f"Maximum_{name} > Maximum_Limits1"),
+            (typ_fail[rows, f], f"Typical_{name} outside both limit bounds"),
+        ]:
+            reasons = np.where(mask, np.where(reasons == "", reason, reasons + ", " + reason), reasons)
+    why[rows] = reasons
+    return failed, why
+
+
+def _row_median(x, count):
+    # nanmedian along axis 1 via one sort (NaN sorts last); much faster than np.nanmedian
+    ordered = np.sort(x, axis=1)
+    rows = np.arange(len(x))
+    lower = ordered[rows, np.maximum(count - 1, 0) // 2]
+    upper = ordered[rows, np.minimum(count // 2, x.shape[1] - 1)]
+    return np.where(count > 0, (lower + upper) / 2, np.nan)
+
+
+def lot_statistics(cube, value_type="Typical", method="MAD", threshold=None):
+    # One reduction over the file axis per statistic, for the chosen value type of every lot.
+    # Cpk = min(USL - mean, mean - LSL) / 3 sigma, using whichever limit exists.
+    # Outlier lots: |x - mean| / sigma (z-score) or 0.6745 |x - median| / MAD above threshold.
+    threshold = OUTLIER_THRESHOLDS[method] if threshold is None else threshold
+    x = widen(cube.values[:, :, VALUE_TYPES.index(value_type)])
+    valid = ~np.isnan(x)
+    count = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(valid, x, 0.0).sum(axis=1) / count
+        squares = np.where(valid, (x - mean[:, None]) ** 2, 0.0).sum(axis=1)
+        sigma = np.where(count > 1, np.sqrt(squares / (count - 1)), np.nan)
+        lot_min = np.where(count > 0, np.where(valid, x, np.inf).min(axis=1), np.nan)
+        lot_max = np.where(count > 0, np.where(valid, x, -np.inf).max(axis=1), np.nan)
+        cpk = np.fmin(cube.limits[:, MAX] - mean, mean - cube.limits[:, MIN]) / (3 * sigma)
+        cpk[~(sigma > 0)] = np.nan
+
+        if method == "z-score":
+            spread = sigma
+            score = np.abs(x - mean[:, None]) / sigma[:, None]
+        else:
+            median = _row_median(x, count)
+            spread = _row_median(np.abs(x - median[:, None]), count)
+            score = 0.6745 * np.abs(x - median[:, None]) / spread[:, None]
+        # Without spread, as when most lots share one value, the lots are not scored, the way cpk
+        # needs sigma > 0; a single differing lot would otherwise be infinitely far out
+        score[~(spread > 0)] = np.nan
+        outliers = score > threshold
+
+    outlier_lots = np.full(cube.n_keys, "", dtype=object)
+    rows = np.flatnonzero(outliers.any(axis=1))
+    names = np.full(len(rows), "", dtype=object)
+    for f, name in enumerate(cube.names):
+        names = np.where(outliers[rows, f], np.where(names == "", name, names + ", " + name), names)
+    outlier_lots[rows] = names
+
+    columns = dict(zip(LOT_STAT_COLUMNS, [count, mean, sigma, lot_min, lot_max, lot_max - lot_min, cpk, outlier_lots]))
+    return columns, outliers
+
+
+def delta_columns(cube, reference):
+    # Every other file minus the reference file, absolute and relative to |reference| in %
+    ref = cube.names.index(reference)
+    values = widen(cube.values)
+    base = values[:, ref, None, :]
+    diff = values - base
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.where(base != 0, diff / np.abs(base) * 100, np.nan)
+    columns = {}
+    for f, name in enumerate(cube.names):
+        if f == ref:
+            continue
+        for t, value_type in enumerate(VALUE_TYPES):
+            columns[f"{value_type}_Delta_{name}"] = diff[:, f, t]
+            columns[f"{value_type}_Delta%_{name}"] = pct[:, f, t]
+    return columns
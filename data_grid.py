@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+PAGE_SIZES = [100, 200, 500]
+HIGHLIGHT_CSS = "background-color: #FFEB9C; color: #9C5700"
+
+
+def filter_positions(df, column=None, text="", fail_only=False):
+    mask = np.ones(len(df), dtype=bool)
+    if fail_only and "Pass or Fail" in df.columns:
+        mask &= (df["Pass or Fail"] == "Fail").to_numpy()
+    if column and text:
+        mask &= df[column].astype(str).str.contains(text, case=False, regex=False, na=False).to_numpy()
+    return np.flatnonzero(mask)
+
+
+def sort_positions(df, positions, sort_by=None, ascending=True):
+    if not sort_by:
+        return positions
+    values = df[sort_by].iloc[positions].reset_index(drop=True)
+    try:
+        order = values.sort_values(ascending=ascending, kind="stable", na_position="last").index.to_numpy()
+    except TypeError:
+        # Mixed text/number columns (sub-header rows) sort as text
+        order = values.astype(str).sort_values(ascending=ascending, kind="stable").index.to_numpy()
+    return positions[order]
+
+
+def page_count(n_rows, page_size):
+    return max(1, -(-n_rows // page_size))
+
+
+def render_data_grid(df, key, token=None, highlight=None):
+    # Only the visible page is handed to st.dataframe; filtering, sorting and paging run here.
+    # `token` identifies the underlying data so the sort order can be reused across reruns.
+    # `highlight(page)` may return {column: bool array} for cells to mark on the visible page.
+    controls = st.columns([2, 1, 2, 2])
+    sort_by = controls[0].selectbox("Sort by", ["(file order)"] + df.columns.tolist(), key=f"{key}_sort")
+    sort_by = None if sort_by == "(file order)" else sort_by
+    ascending = controls[1].radio("Order", ["Asc", "Desc"], key=f"{key}_order", horizontal=False) == "Asc"
+    filter_column = controls[2].selectbox("Filter column", ["(none)"] + df.columns.tolist(), key=f"{key}_filter_col")
+    filter_column = None if filter_column == "(none)" else filter_column
+    filter_text = controls[3].text_input("Contains", key=f"{key}_filter_text", disabled=filter_column is None)
+
+    options = st.columns([2, 1, 1])
+    fail_only = options[0].checkbox("Show only Fail rows", key=f"{key}_fail_only", disabled="Pass or Fail" not in df.columns)
+    page_size = options[1].selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_page_size")
+
+    cache_key = f"{key}_positions"
+    view = (token, sort_by, ascending, filter_column, filter_text, fail_only)
+    cached = st.session_state.get(cache_key)
+    if token is not None and cached is not None and cached[0] == view:
+        positions = cached[1]
+    else:
+        positions = sort_positions(df, filter_positions(df, filter_column, filter_text, fail_only), sort_by, ascending)
+        st.session_state[cache_key] = (view, positions)
+        st.session_state[f"{key}_page"] = 1
+
+    n_pages = page_count(len(positions), page_size)
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = options[2].number_input("Page", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+    start = (page - 1) * page_size
+    page_rows = df.iloc[positions[start:start + page_size]]
+    flags = highlight(page_rows) if highlight is not None else {}
+    if flags:
+        page_rows = page_rows.style.apply(
+            lambda col: np.where(flags[col.name], HIGHLIGHT_CSS, ""), subset=list(flags)
+        )
+    st.dataframe(page_rows)
+    shown = f"{start + 1}–{min(start + page_size, len(positions))}" if len(positions) else "0"
+    st.caption(f"Rows {shown} of {len(positions)}" + (f" (filtered from {len(df)})" if len(positions) != len(df) else "") + f" · page {page} of {n_pages}")
+
+
+def render_sql_grid(comparison, expansion_filter, key):
+    # Paging for a result that stays out of memory, in the DuckDB database (sql_engine.SQLComparison)
+    # or in pickled partitions (partitioned.PartitionedComparison); only the visible page is fetched
+    options = st.columns([2, 1, 1])
+    fail_only = options[0].checkbox("Show only Fail rows", key=f"{key}_fail_only")
+    page_size = options[1].selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_page_size")
+    n_rows = comparison.row_count(expansion_filter)
+    n_shown = comparison.failed_count(expansion_filter) if fail_only else n_rows
+
+    n_pages = page_count(n_shown, page_size)
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = options[2].number_input("Page", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+    start = (page - 1) * page_size
+    st.dataframe(comparison.page(expansion_filter, start, page_size, fail_only), hide_index=True)
+    shown = f"{start + 1}–{min(start + page_size, n_shown)}" if n_shown else "0"
+    st.caption(f"Rows {shown} of {n_shown}" + (f" (filtered from {n_rows})" if n_shown != n_rows else "") + f" · page {page} of {n_pages}")
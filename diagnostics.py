@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger("cl_compare.diagnostics")
+
+MB = 1024 * 1024
+# tracemalloc is one tracer for the whole process: traced stages take turns, so no stage resets
+# another's peak, and the tracer stays on once started, as stopping it would end any other trace
+_TRACE_LOCK = threading.RLock()
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class StageRecorder:
+    # Usable wherever comparison.py accepts `timer`: recorder(stage) is a context manager
+    # yielding a dict the stage may fill with {"rows": n}. Repeated stage names accumulate.
+
+    def __init__(self, trace_memory=False, log=True):
+        self.trace_memory = trace_memory
+        self.log = log
+        self.run_id = uuid.uuid4().hex[:8]
+        self.cache_hit = False
+        self.stages = {}
+
+    def __call__(self, stage):
+        return self._record(stage)
+
+    @contextmanager
+    def _record(self, stage):
+        if not self.trace_memory:
+            with self._measure(stage) as info:
+                yield info
+            return
+        with _TRACE_LOCK:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            with self._measure(stage, traced=True) as info:
+                yield info
+
+    @contextmanager
+    def _measure(self, stage, traced=False):
+        # With traced, the peak counts every thread's allocations during the stage, so it is
+        # the process-wide peak above the memory traced when the stage began
+        info = {}
+        if traced:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        rss_before = current_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - traced_before if traced else None
+            rss_after = current_rss_bytes()
+            rss_delta = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+            self.add(stage, seconds, peak, rss_delta, info.get("rows"))
+
+    def add(self, stage, seconds, peak=None, rss_delta=None, rows=None):
+        # peak and rss_delta in bytes
+        record = self.stages.setdefault(stage, {
+            "stage": stage, "seconds": 0.0, "peak_mb": None, "rss_delta_mb": None, "rows": None, "calls": 0
+        })
+        record["seconds"] += seconds
+        record["calls"] += 1
+        if peak is not None:
+            record["peak_mb"] = max(record["peak_mb"] or 0.0, peak / MB)
+        if rss_delta is not None:
+            record["rss_delta_mb"] = (record["rss_delta_mb"] or 0.0) + rss_delta / MB
+        if rows is not None:
+            record["rows"] = rows
+        if self.log:
+            logger.info(json.dumps({
+                "event": "stage",
+                "run_id": self.run_id,
+                "stage": stage,
+                "seconds": round(seconds, 6),
+                "peak_mb": None if peak is None else round(peak / MB, 3),
+                "rss_delta_mb": None if rss_delta is None else round(rss_delta / MB, 3),
+                "rows": rows,
+                "cache_hit": self.cache_hit,
+            }))
+
+    def mark_cache_hit(self, cache_hit):
+        self.cache_hit = cache_hit
+        if self.log:
+            logger.info(json.dumps({"event": "run", "run_id": self.run_id, "cache_hit": cache_hit}))
+
+    def to_frame(self):
+        frame = pd.DataFrame(list(self.stages.values()), columns=["stage", "seconds", "peak_mb", "rss_delta_mb", "rows", "calls"])
+        return frame.rename(columns={
+            "stage": "Stage", "seconds": "Wall time (s)", "peak_mb": "Peak traced memory, whole process (MB)",
+            "rss_delta_mb": "RSS change (MB)", "rows": "Rows", "calls": "Calls",
+        })
+
+    def total_seconds(self):
+        return sum(record["seconds"] for record in self.stages.values())
+
+
+def configure_logging(level=logging.INFO):
+    # Streamlit leaves the root logger at WARNING; give the diagnostics logger its own handler
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
@@ -0,0 +1,147 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.styles import PatternFill, Font
+from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+
+from comparison import delta_flags
+
+GREEN_FILL = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
+RED_FILL = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+GREEN_FONT = Font(color="006100")
+RED_FONT = Font(color="9C0006")
+AMBER_FILL = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
+AMBER_FONT = Font(color="9C5700")
+
+NO_STYLE, GREEN, RED, AMBER = 0, 1, 2, 3
+
+
+def _values(df, col):
+    return pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+
+
+def cell_styles(merged_output, custom_names, delta_thresholds=None):
+    # Column position -> per-row style code, computed for whole columns at once
+    n = len(merged_output)
+    columns = merged_output.columns
+    nan = np.full(n, np.nan)
+    min_limit = _values(merged_output, "Minimum_Limits1") if "Minimum_Limits1" in columns else nan
+    max_limit = _values(merged_output, "Maximum_Limits1") if "Maximum_Limits1" in columns else nan
+    styles = {}
+
+    if "Pass or Fail" in columns:
+        passed = merged_output["Pass or Fail"].to_numpy() == "Pass"
+        styles[columns.get_loc("Pass or Fail")] = np.where(passed, GREEN, RED)
+
+    with np.errstate(invalid="ignore"):
+        for name in custom_names:
+            for value_type, limit, ok in [
+                ("Minimum", min_limit, lambda cl, lim: cl >= lim),
+                ("Maximum", max_limit, lambda cl, lim: cl <= lim),
+            ]:
+                col = f"{value_type}_{name}"
+                if col not in columns:
+                    continue
+                cl = _values(merged_output, col)
+                has_cl = ~np.isnan(cl)
+                codes = np.where(has_cl, GREEN, NO_STYLE)
+                codes[has_cl & ~np.isnan(limit) & ~ok(cl, limit)] = RED
+                styles[columns.get_loc(col)] = codes
+
+            col = f"Typical_{name}"
+            if col in columns:
+                typ = _values(merged_output, col)
+                outside_both = (typ < min_limit) & (typ > max_limit)
+                styles[columns.get_loc(col)] = np.where(np.isnan(typ), NO_STYLE, np.where(outside_both, RED, GREEN))
+
+    if delta_thresholds is not None:
+        # (absolute, percent) change thresholds of delta mode
+        for col, changed in delta_flags(merged_output, custom_names, *delta_thresholds).items():
+            styles[columns.get_loc(col)] = np.where(changed, AMBER, NO_STYLE)
+    return styles
+
+
+def column_widths(merged_output):
+    # Longest text of each column's non-empty cells (header included) plus padding
+    widths = []
+    for position, col in enumerate(merged_output.columns):
+        values = merged_output.iloc[:, position]
+        non_empty = values.to_numpy(dtype=object).astype(bool)
+        lengths = values[non_empty].astype(str).str.len()
+        longest = max(int(lengths.max()) if len(lengths) else 0, len(str(col)) if col else 0)
+        widths.append(longest + 2)
+    return widths
+
+
+def comparison_sheet(columns, widths, title="Comparison"):
+    # Write-only workbook: rows are streamed out instead of kept as cell objects
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.freeze_panes = "A2"
+    for position, width in enumerate(widths):
+        ws.column_dimensions[get_column_letter(position + 1)].width = width
+    ws.append(list(columns))
+    return wb, ws
+
+
+def append_styled_rows(ws, frame, styles):
+    # Only the coloured cells are created as cells of their own
+    formats = {GREEN: (GREEN_FILL, GREEN_FONT), RED: (RED_FILL, RED_FONT), AMBER: (AMBER_FILL, AMBER_FONT)}
+    styles = list(styles.items())
+    for row_idx, row in enumerate(frame.itertuples(index=False, name=None)):
+        row = list(row)
+        for col_idx, codes in styles:
+            code = codes[row_idx]
+            if code != NO_STYLE:
+                cell = WriteOnlyCell(ws, value=row[col_idx])
+                cell.fill, cell.font = formats[code]
+                row[col_idx] = cell
+        ws.append(row)
+
+
+def _saved(wb, output=None, name="comparison_grouped.xlsx"):
+    final_output = BytesIO() if output is None else output
+    wb.save(final_output)
+    if output is None:
+        final_output.seek(0)
+        final_output.name = name
+    return final_output
+
+
+def write_comparison_workbook(merged_output, custom_names, delta_thresholds=None):
+    wb, ws = comparison_sheet(merged_output.columns, column_widths(merged_output))
+    append_styled_rows(ws, merged_output, cell_styles(merged_output, custom_names, delta_thresholds))
+    return _saved(wb)
+
+
+def write_comparison_stream(frames, columns, widths, custom_names, output=None, delta_thresholds=None):
+    # Same sheet from an iterable of row batches, e.g. pages of an out-of-core result; the
+    # styles only look at their own row, so each batch is styled on its own. output is a path
+    # or file object, by default a BytesIO that is returned.
+    wb, ws = comparison_sheet(columns, widths)
+    for frame in frames:
+        append_styled_rows(ws, frame, cell_styles(frame, custom_names, delta_thresholds))
+    return _saved(wb, output)
+
+
+def change_styles(changes):
+    # Flips in red or green, other changes in amber, and the statuses on both sides coloured
+    columns = changes.columns
+    change = changes["Change"].astype(str)
+    styles = {columns.get_loc("Change"): np.where(
+        change.str.startswith("Pass → Fail"), RED, np.where(change.str.startswith("Fail → Pass"), GREEN, AMBER)
+    )}
+    for col in ["Pass or Fail before", "Pass or Fail now"]:
+        status = changes[col].to_numpy()
+        styles[columns.get_loc(col)] = np.where(status == "Pass", GREEN, np.where(status == "Fail", RED, NO_STYLE))
+    return styles
+
+
+def write_changes_workbook(changes, title="Changes"):
+    # The rows of history.run_changes only, on one sheet
+    wb, ws = comparison_sheet(changes.columns, column_widths(changes), title)
+    append_styled_rows(ws, changes, change_styles(changes))
+    return _saved(wb, name="comparison_changes.xlsx")
@@ -0,0 +1,64 @@
+import os
+
+import streamlit as st
+
+from comparison import prepare_upload
+from limits import prepare_limits
+
+GOLDEN_DIR_ENV = "CL_COMPARE_GOLDEN_DIR"
+UPLOAD_OPTION = "Upload a file"
+
+
+def golden_directory():
+    # Pinned reference files are the .csv files kept here on the server
+    return os.environ.get(GOLDEN_DIR_ENV, os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden"))
+
+
+def pinned_references(directory=None):
+    # Display name -> path, in name order
+    directory = directory or golden_directory()
+    if not os.path.isdir(directory):
+        return {}
+    return {
+        os.path.splitext(name)[0]: os.path.join(directory, name)
+        for name in sorted(os.listdir(directory)) if name.lower().endswith(".csv")
+    }
+
+
+@st.cache_resource(show_spinner="Loading the pinned reference...", max_entries=8)
+def prepared_reference(path, version):
+    # Parsed, aligned and normalized once per process and shared by every session, keyed by
+    # the file's modification time so a replaced file is read again. The frames are only ever
+    # read from: the comparison copies before it changes anything.
+    prepared = prepare_upload(path, 0)
+    # Nothing is parsed for the comparisons that use it, so there are no stages to report
+    prepared["stages"] = {}
+    return prepared
+
+
+@st.cache_resource(show_spinner="Indexing the pinned limits...", max_entries=8)
+def prepared_limits(path, version):
+    # The same file as a separate limits source, indexed by key once per process
+    return prepare_limits(path)
+
+
+class PinnedReference:
+    # Stands in for the UploadedFile of file 1. The pandas engine gets the shared prepared
+    # copy; the engines that read the raw file get its bytes.
+
+    def __init__(self, name, path):
+        stat = os.stat(path)
+        self.name = name
+        self.path = path
+        self.size = stat.st_size
+        self.file_id = f"pinned:{path}:{stat.st_mtime_ns}"
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def prepared(self):
+        return prepared_reference(self.path, self.file_id)
+
+    def limits(self):
+        return prepared_limits(self.path, self.file_id)
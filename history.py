@@ -0,0 +1,284 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from comparison import clean_spec_id, sort_order, key_hashes, key_value, key_text
+from cube import KEY_COLUMNS, LIMIT_COLUMNS, VALUE_TYPES, MIN, TYP, MAX, file_failures, widen
+
+HISTORY_DB_ENV = "CL_COMPARE_HISTORY_DB"
+DEFAULT_HISTORY_LOTS = 200
+DEFAULT_TREND_POINTS = 500
+
+# One row per lot (compared file) and spec key, clustered by spec so the history of one spec is
+# a range scan. Keys are stored once in specs as normalized text.
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY, created_at TEXT NOT NULL, note TEXT NOT NULL DEFAULT '',
+        specs INTEGER NOT NULL, failed INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS lots (
+        lot_id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL REFERENCES runs (run_id), position INTEGER NOT NULL,
+        name TEXT NOT NULL, source TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS lots_run ON lots (run_id)",
+    """CREATE TABLE IF NOT EXISTS specs (
+        spec_id INTEGER PRIMARY KEY, spec_number TEXT NOT NULL, spec_id_expansion TEXT NOT NULL,
+        spec_item_category TEXT NOT NULL, spec_item_old_name TEXT NOT NULL,
+        UNIQUE (spec_number, spec_id_expansion, spec_item_category, spec_item_old_name))""",
+    "CREATE INDEX IF NOT EXISTS specs_category ON specs (spec_item_category)",
+    """CREATE TABLE IF NOT EXISTS results (
+        spec_id INTEGER NOT NULL REFERENCES specs (spec_id), lot_id INTEGER NOT NULL REFERENCES lots (lot_id),
+        minimum REAL, typical REAL, maximum REAL, minimum_limit REAL, typical_limit REAL, maximum_limit REAL,
+        minimum_margin REAL, maximum_margin REAL, failed INTEGER NOT NULL,
+        PRIMARY KEY (spec_id, lot_id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS results_lot ON results (lot_id)",
+]
+_KEY_SQL = ", ".join(KEY_COLUMNS)
+# Per spec key across the lots of a run, as compared between runs
+SUMMARY_COLUMNS = VALUE_TYPES + ["Minimum margin", "Maximum margin"]
+
+
+def history_path():
+    return os.environ.get(HISTORY_DB_ENV, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cl_history.sqlite"))
+
+
+class ResultsStore:
+    # Comparison results kept across runs in one SQLite file, for lot-over-lot queries. Every
+    # call opens its own connection, so a store can be shared by threads and Streamlit sessions.
+
+    def __init__(self, path=None):
+        self.path = path or history_path()
+        with closing(self._connect()) as con, con:
+            con.execute("PRAGMA journal_mode = WAL")
+            for statement in SCHEMA:
+                con.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save_run(self, cube, sources=None, note=""):
+        # Appends every file of the cube as a lot: its CL values, the limits, margins and whether
+        # the file fails the spec. Keys without a spec_number (the sub-header row) are skipped.
+        # Returns the new run_id.
+        sources = sources or cube.names
+        keys = key_text(cube.keys)
+        keep = np.flatnonzero(keys["spec_number"].to_numpy() != "")
+        keys = keys.iloc[keep]
+        values = widen(cube.values[keep])
+        limits = cube.limits[keep]
+        margins = {name: margin[keep] for name, margin in cube.margins().items()}
+        failed = np.logical_or.reduce([fail[keep] for fail in file_failures(cube)])
+        present = cube.present[keep]
+
+        with closing(self._connect()) as con, con:
+            created_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            run_id = con.execute(
+                "INSERT INTO runs (created_at, note, specs, failed) VALUES (?, ?, ?, ?)",
+                (created_at, note, len(keys), int(failed.any(axis=1).sum())),
+            ).lastrowid
+            lot_ids = [
+                con.execute("INSERT INTO lots (run_id, position, name, source) VALUES (?, ?, ?, ?)",
+                            (run_id, f, str(name), str(source))).lastrowid
+                for f, (name, source) in enumerate(zip(cube.names, sources))
+            ]
+
+            con.execute(f"CREATE TEMP TABLE incoming (position INTEGER PRIMARY KEY, {_KEY_SQL})")
+            con.executemany("INSERT INTO incoming VALUES (?, ?, ?, ?, ?)",
+                            zip(range(len(keys)), *(keys[col].tolist() for col in KEY_COLUMNS)))
+            con.execute(f"INSERT OR IGNORE INTO specs ({_KEY_SQL}) SELECT {_KEY_SQL} FROM incoming")
+            spec_ids = np.empty(len(keys), dtype=np.int64)
+            for position, spec_id in con.execute(f"SELECT position, spec_id FROM incoming JOIN specs USING ({_KEY_SQL})"):
+                spec_ids[position] = spec_id
+            con.execute("DROP TABLE incoming")
+
+            rows, files = np.nonzero(present)
+            con.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                zip(spec_ids[rows].tolist(), np.asarray(lot_ids, dtype=np.int64)[files].tolist(),
+                    *(values[rows, files, t].tolist() for t in (MIN, TYP, MAX)),
+                    *(limits[rows, t].tolist() for t in (MIN, TYP, MAX)),
+                    margins["Minimum"][rows, files].tolist(), margins["Maximum"][rows, files].tolist(),
+                    failed[rows, files].astype(int).tolist()),
+            )
+        return run_id
+
+    def runs(self, limit=50):
+        # The latest runs first, with their lots
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(
+                """SELECT runs.run_id AS "Run", created_at AS "Saved (UTC)", note AS "Note",
+                       group_concat(lots.name || ' (' || lots.source || ')', ', ') AS "Lots",
+                       specs AS "Specs", failed AS "Failing specs"
+                   FROM runs JOIN lots USING (run_id)
+                   GROUP BY runs.run_id ORDER BY runs.run_id DESC LIMIT ?""",
+                con, params=(int(limit),),
+            )
+
+    def _key_filters(self, spec_number=None, spec_id_expansion=None, spec_item_category=None, spec_item_old_name=None):
+        # WHERE clause on specs and its parameters; unset key parts match any value
+        filters = {"spec_number": spec_number, "spec_id_expansion": spec_id_expansion,
+                   "spec_item_category": spec_item_category, "spec_item_old_name": spec_item_old_name}
+        filters = {col: ("" if value == "Blank" else clean_spec_id(value)) if col == "spec_id_expansion" else key_value(value)
+                   for col, value in filters.items() if value is not None}
+        return " AND ".join(f"specs.{col} = ?" for col in filters) or "1", list(filters.values())
+
+    def categories(self):
+        with closing(self._connect()) as con:
+            return [row[0] for row in con.execute("SELECT DISTINCT spec_item_category FROM specs ORDER BY 1")]
+
+    def spec_keys(self, spec_number):
+        # The stored keys of one spec_number: its expansions, categories and old names
+        where, params = self._key_filters(spec_number)
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(f"SELECT {_KEY_SQL} FROM specs WHERE {where} ORDER BY {_KEY_SQL}", con, params=params)
+
+    def trend(self, max_points=DEFAULT_TREND_POINTS, **key):
+        # The matching specs across the stored lots, aggregated in the database into at most
+        # max_points buckets of consecutive lot ids: lowest Minimum, mean Typical and highest
+        # Maximum against the tightest limits, so the extremes survive the downsampling. With one
+        # spec and no more lots than max_points, every point is one lot's own values.
+        where, params = self._key_filters(**key)
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(
+                f"""WITH span AS (SELECT min(lot_id) AS first_id, max(lot_id) - min(lot_id) + 1 AS n FROM lots),
+                   buckets AS (
+                       SELECT min(results.lot_id) AS first_lot, max(results.lot_id) AS last_lot,
+                           count(DISTINCT results.lot_id) AS lots, count(DISTINCT results.spec_id) AS specs,
+                           min(minimum) AS minimum, avg(typical) AS typical, max(maximum) AS maximum,
+                           max(minimum_limit) AS minimum_limit, avg(typical_limit) AS typical_limit,
+                           min(maximum_limit) AS maximum_limit, sum(failed) AS failed
+                       FROM span, specs JOIN results ON results.spec_id = specs.spec_id
+                       WHERE {where}
+                       GROUP BY (results.lot_id - span.first_id) * ? / span.n)
+                   SELECT first_lot AS "Lot", last_lot AS "To lot", runs.created_at AS "Saved (UTC)",
+                       first.name || ' (' || first.source || ')' AS "First lot",
+                       last.name || ' (' || last.source || ')' AS "Last lot",
+                       buckets.lots AS "Lots", buckets.specs AS "Specs", buckets.failed AS "Failing",
+                       minimum AS "Minimum", typical AS "Typical", maximum AS "Maximum",
+                       minimum_limit AS "{LIMIT_COLUMNS[0]}", typical_limit AS "{LIMIT_COLUMNS[1]}",
+                       maximum_limit AS "{LIMIT_COLUMNS[2]}"
+                   FROM buckets
+                   JOIN lots AS first ON first.lot_id = buckets.first_lot
+                   JOIN runs ON runs.run_id = first.run_id
+                   JOIN lots AS last ON last.lot_id = buckets.last_lot
+                   ORDER BY first_lot""",
+                con, params=params + [int(max_points)],
+            )
+
+    def run_summary(self, run_id):
+        # One row per spec key of the run, across its lots: lowest Minimum, mean Typical, highest
+        # Maximum, the worst margins and Pass/Fail, like key_summary gives for a cube
+        with closing(self._connect()) as con:
+            summary = pd.read_sql_query(
+                f"""SELECT {", ".join(f"specs.{col}" for col in KEY_COLUMNS)},
+                       min(minimum) AS "Minimum", avg(typical) AS "Typical", max(maximum) AS "Maximum",
+                       min(minimum_margin) AS "Minimum margin", min(maximum_margin) AS "Maximum margin",
+                       CASE WHEN max(results.failed) THEN 'Fail' ELSE 'Pass' END AS "Pass or Fail"
+                   FROM lots
+                   JOIN results ON results.lot_id = lots.lot_id
+                   JOIN specs ON specs.spec_id = results.spec_id
+                   WHERE lots.run_id = ?
+                   GROUP BY results.spec_id""",
+                con, params=(int(run_id),),
+            )
+        summary[SUMMARY_COLUMNS] = summary[SUMMARY_COLUMNS].astype(float)
+        return summary
+
+    def spec_history(self, spec_number, spec_id_expansion=None, spec_item_category=None, spec_item_old_name=None,
+                     last_lots=DEFAULT_HISTORY_LOTS):
+        # Every stored lot of the matching spec keys, the latest last_lots per key, in the order
+        # they were saved. Unset key parts match any value.
+        where, params = self._key_filters(spec_number, spec_id_expansion, spec_item_category, spec_item_old_name)
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(
+                f"""SELECT * FROM (
+                       SELECT lots.run_id AS "Run", runs.created_at AS "Saved (UTC)", lots.lot_id AS "Lot",
+                           lots.name AS "Name", lots.source AS "Source", {", ".join(f"specs.{col}" for col in KEY_COLUMNS)},
+                           minimum AS "Minimum", typical AS "Typical", maximum AS "Maximum",
+                           minimum_limit AS "{LIMIT_COLUMNS[0]}", typical_limit AS "{LIMIT_COLUMNS[1]}",
+                           maximum_limit AS "{LIMIT_COLUMNS[2]}", minimum_margin AS "Minimum margin",
+                           maximum_margin AS "Maximum margin",
+                           CASE WHEN results.failed THEN 'Fail' ELSE 'Pass' END AS "Pass or Fail",
+                           row_number() OVER (PARTITION BY results.spec_id ORDER BY results.lot_id DESC) AS recent
+                       FROM specs
+                       JOIN results ON results.spec_id = specs.spec_id
+                       JOIN lots ON lots.lot_id = results.lot_id
+                       JOIN runs ON runs.run_id = lots.run_id
+                       WHERE {where})
+                   WHERE recent <= ? ORDER BY "Lot", {_KEY_SQL}""",
+                con, params=params + [int(last_lots)],
+            ).drop(columns="recent")
+
+
+def key_summary(cube):
+    # The cube per spec key as run_summary reads a stored run: the keys a file has, as text,
+    # with the lowest Minimum, mean Typical and highest Maximum across the files, the worst
+    # margins and Pass/Fail
+    keys = key_text(cube.keys)
+    keep = (keys["spec_number"].to_numpy() != "") & cube.present.any(axis=1)
+    values = widen(cube.values[keep])
+    margins = cube.margins()
+    typical = values[:, :, TYP]
+    count = (~np.isnan(typical)).sum(axis=1)
+    failed = np.logical_or.reduce(file_failures(cube)).any(axis=1)[keep]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        summary = {
+            "Minimum": np.fmin.reduce(values[:, :, MIN], axis=1),
+            "Typical": np.where(count > 0, np.nansum(typical, axis=1) / count, np.nan),
+            "Maximum": np.fmax.reduce(values[:, :, MAX], axis=1),
+            "Minimum margin": np.fmin.reduce(margins["Minimum"][keep], axis=1),
+            "Maximum margin": np.fmin.reduce(margins["Maximum"][keep], axis=1),
+        }
+    summary = pd.concat([keys.iloc[np.flatnonzero(keep)].reset_index(drop=True), pd.DataFrame(summary)], axis=1)
+    summary["Pass or Fail"] = np.where(failed, "Fail", "Pass")
+    return summary
+
+
+def run_changes(current, previous, abs_threshold=0, pct_threshold=0):
+    # Hash join of two summaries on the key. Keeps the specs whose Pass/Fail flipped, that are
+    # new or dropped, or where a value or margin appeared, vanished or moved by more than either
+    # threshold (0 = off), in spec order with the before/now values side by side.
+    joined = current.assign(key_hash=key_hashes(current)).merge(
+        previous.assign(key_hash=key_hashes(previous)), on="key_hash", how="outer", suffixes=(" now", " before"),
+        indicator=True
+    )
+    status_now, status_before = joined["Pass or Fail now"].to_numpy(), joined["Pass or Fail before"].to_numpy()
+    side = joined["_merge"].to_numpy()
+    both = side == "both"
+    keep = ~both | (status_now != status_before)
+
+    moved = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for col in SUMMARY_COLUMNS:
+            a, b = joined[f"{col} now"].to_numpy(dtype=float), joined[f"{col} before"].to_numpy(dtype=float)
+            delta = a - b
+            changed = np.isnan(a) != np.isnan(b)
+            if abs_threshold:
+                changed |= np.abs(delta) > abs_threshold
+            if pct_threshold:
+                changed |= np.abs(delta) / np.abs(b) * 100 > pct_threshold
+            moved[col] = both & changed
+            keep |= moved[col]
+            joined[f"{col} Δ"] = delta
+
+    changes = joined[keep].reset_index(drop=True)
+    rows = np.flatnonzero(keep)
+    labels = []
+    for i, row in enumerate(rows):
+        if side[row] != "both":
+            labels.append("New" if side[row] == "left_only" else "Dropped")
+            continue
+        label = f"{status_before[row]} → {status_now[row]}" if status_now[row] != status_before[row] else ""
+        columns = ", ".join(col for col in SUMMARY_COLUMNS if moved[col][row])
+        labels.append(f"{label}; moved: {columns}" if label and columns else label or f"Moved: {columns}")
+    changes["Change"] = labels
+    for col in KEY_COLUMNS:
+        changes[col] = changes[f"{col} now"].fillna(changes[f"{col} before"])
+    changes = changes.iloc[sort_order(changes)].reset_index(drop=True)
+
+    columns = KEY_COLUMNS + ["Change", "Pass or Fail before", "Pass or Fail now"]
+    for col in SUMMARY_COLUMNS:
+        columns += [f"{col} before", f"{col} now", f"{col} Δ"]
+    return changes[columns]
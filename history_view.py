@@ -0,0 +1,65 @@
+import pandas as pd
+import streamlit as st
+
+from cube import VALUE_TYPES
+from history import DEFAULT_TREND_POINTS
+from plots import build_trend_frame, build_trend_figure
+
+ONE_SPEC = "One spec"
+CATEGORY = "A spec item category"
+
+
+def key_label(key):
+    return " · ".join([key["spec_id_expansion"] or "Blank", key["spec_item_category"], key["spec_item_old_name"]])
+
+
+def render_trend(store):
+    # One spec or category across the saved runs. The store does the filtering, aggregation and
+    # downsampling; the browser only gets the points that are drawn.
+    st.header("Trend Across Saved Runs", divider=True)
+    if store.runs(limit=1).empty:
+        st.caption(f"No saved runs in {store.path} yet. Save a comparison to start the history.")
+        return
+
+    scope = st.radio("Plot", [ONE_SPEC, CATEGORY], horizontal=True, key="trend_scope")
+    if scope == ONE_SPEC:
+        spec_number = st.text_input("Spec number", value="", key="trend_spec_number")
+        if not spec_number.strip():
+            st.caption("Enter a spec number to plot its history.")
+            return
+        keys = store.spec_keys(spec_number)
+        if keys.empty:
+            st.warning(f'Spec number "{spec_number}" is not in any saved run.')
+            return
+        choice = st.selectbox("Expansion · category · old name", range(len(keys)),
+                              format_func=lambda i: key_label(keys.iloc[i]), key="trend_spec_key")
+        key = keys.iloc[choice].to_dict()
+        title = f"History of spec {spec_number} ({key_label(key)})"
+    else:
+        category = st.selectbox("Spec item category", store.categories(), key="trend_category")
+        key = {"spec_item_category": category}
+        title = f"History of Spec Item Category {category}"
+
+    controls = st.columns(3)
+    along = controls[0].radio("Along", ["Lots", "Time saved"], horizontal=True, key="trend_along")
+    max_points = controls[1].number_input("Points at most", min_value=50, max_value=5000, value=DEFAULT_TREND_POINTS,
+                                          step=50, key="trend_points")
+    value_types = controls[2].multiselect("Values", VALUE_TYPES, default=VALUE_TYPES, key="trend_values")
+    show_limits = st.checkbox("Show limits", value=True, key="trend_limits")
+
+    trend = store.trend(max_points, **key)
+    if trend.empty or not value_types:
+        st.warning("No data available to plot. Please check your selection.")
+        return
+    trend["Saved (UTC)"] = pd.to_datetime(trend["Saved (UTC)"])
+    if (trend["Lots"] > 1).any() or (trend["Specs"] > 1).any():
+        st.caption(
+            f"{trend['Lots'].sum():,} lots in {len(trend):,} points. Each point is the lowest Minimum, mean Typical and "
+            "highest Maximum of its lots and specs, against the tightest limits among them."
+        )
+    fig = build_trend_figure(
+        build_trend_frame(trend, value_types), trend, title,
+        show_limits={value_type: show_limits for value_type in VALUE_TYPES},
+        x="Lot" if along == "Lots" else "Saved (UTC)"
+    )
+    st.plotly_chart(fig, use_container_width=True)
@@ -0,0 +1,133 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import streamlit as st
+
+from diagnostics import StageRecorder
+
+SESSION_KEY = "comparison_jobs"
+# Finished comparisons kept per session, like the max_entries of a cached function
+MAX_FINISHED_JOBS = 4
+POLL_SECONDS = 0.5
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@st.cache_resource
+def _executor():
+    # Shared by all sessions. Threads rather than processes: the result is a cube and frames
+    # the script uses directly, and the heavy parts are numpy/pandas code that releases the GIL.
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="cl-compare")
+
+
+class ComparisonJob:
+    # One comparison running in the background. Its timer is passed to the pipeline as `timer`,
+    # so every stage boundary reports progress and is where a cancel request takes effect.
+    #   stages  the stage names the run goes through, for the progress bar
+
+    def __init__(self, key, stages):
+        self.key = key
+        self.stages = list(stages)
+        self.recorder = StageRecorder(log=False)
+        self.current = None
+        self.cancelled = threading.Event()
+        self.reported = False
+        self.future = None
+
+    @contextmanager
+    def timer(self, stage):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.current = stage
+        with self.recorder(stage) as info:
+            yield info
+
+    def progress(self):
+        finished = sum(stage in self.recorder.stages for stage in self.stages)
+        return min(finished / max(len(self.stages), 1), 1.0)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+    def ready(self):
+        return self.future.done() and not self.cancelled.is_set()
+
+
+def submit_comparison(key, stages, function, *args, **kwargs):
+    # Runs function(*args, _timer=job.timer, **kwargs) in the background unless this session
+    # already has a job for `key`, finished, running or cancelled (see forget_job). A running
+    # job for other inputs is cancelled, as its result could no longer be shown.
+    jobs = st.session_state.setdefault(SESSION_KEY, {})
+    job = jobs.get(key)
+    if job is not None:
+        return job
+    _make_room(jobs, key)
+    job = ComparisonJob(key, stages)
+    job.future = _executor().submit(function, *args, _timer=job.timer, **kwargs)
+    jobs[key] = job
+    return job
+
+
+def run_inline(key, stages, function, *args, **kwargs):
+    # submit_comparison in the script's own thread, for a profiled run. The finished job is kept
+    # like a background one, so later reruns reuse its result; errors are raised here.
+    jobs = st.session_state.setdefault(SESSION_KEY, {})
+    _make_room(jobs, key)
+    job = ComparisonJob(key, stages)
+    job.future = Future()
+    job.future.set_result(function(*args, _timer=job.timer, **kwargs))
+    jobs[key] = job
+    return job
+
+
+def _make_room(jobs, key):
+    # A running job for other inputs is cancelled, and the oldest finished ones are dropped
+    for other in jobs.values():
+        if other.key != key and not other.future.done():
+            other.cancel()
+    finished = [k for k, other in jobs.items() if other.key != key and other.future.done()]
+    for old in finished[:max(len(finished) - MAX_FINISHED_JOBS + 1, 0)]:
+        jobs.pop(old)
+
+
+def forget_job(key):
+    job = st.session_state.get(SESSION_KEY, {}).pop(key, None)
+    if job is not None:
+        job.cancel()
+
+
+def render_job(job, label="Comparing CL files"):
+    # Progress bar and Cancel button, refreshed on their own until the job is done; then the
+    # whole script reruns and picks up the result
+    if job.cancelled.is_set():
+        st.info("Comparison cancelled.")
+        if st.button("Run the comparison again"):
+            forget_job(job.key)
+            st.rerun()
+        return
+
+    @st.fragment(run_every=POLL_SECONDS)
+    def progress():
+        if job.future.done():
+            st.rerun()
+        stage = job.current or "starting"
+        st.progress(job.progress(), text=f"{label}: {stage.replace('_', ' ')}...")
+        if st.button("Cancel comparison"):
+            job.cancel()
+            st.rerun()
+
+    progress()
+
+
+def merge_job_stages(recorder, job):
+    # The job's stage timings into the run's recorder, the first time its result is shown;
+    # later reruns reuse the result the way a cache hit would
+    recorder.mark_cache_hit(job.reported)
+    if not job.reported:
+        for stage, record in job.recorder.stages.items():
+            recorder.add(stage, record["seconds"], rows=record["rows"])
+    job.reported = True
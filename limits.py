@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from comparison import (
+    read_cl_files, normalize_expansion, coerce_numeric, prepare_base, key_text_hashes, sort_order, add_pass_fail, untimed
+)
+from cube import KEY_COLUMNS, LIMIT_COLUMNS, CLCube, presence_labels
+
+LIMITS_REQUIRED_COLUMNS = ["spec_number", "limits", "spec_item_category", "spec_item_old_name"]
+FILE_1_LIMITS = "File 1"
+UPLOAD_LIMITS = "Upload a limits file"
+NO_MATCH_WARNING = (
+    "No spec key of the limits file matches a key of the CL files, so nothing is checked against its limits. "
+    "Check that both use the same spec numbers, expansions, categories and old names."
+)
+
+
+@dataclass
+class LimitsTable:
+    # A limits source on its own, prepared once and applied to any set of CL files:
+    #   base     the limits file normalized with prepare_base; its rows are the rows of the output
+    #   limits   float (n_rows, 3), Minimum/Typical/Maximum limits per row
+    #   hashes   key_text_hashes of every row, so int, float and text spec numbers match alike
+    #   index    pd.Index of the distinct key hashes -> first_rows, the row each key takes its limits from
+    #   unparsed  limit cells that look numeric but could not be read, as coerce_numeric reports them
+    base: pd.DataFrame
+    limits: np.ndarray
+    hashes: np.ndarray
+    index: pd.Index
+    first_rows: np.ndarray
+    unparsed: dict
+
+    @property
+    def duplicates(self):
+        return len(self.hashes) - len(self.first_rows)
+
+
+def limits_from_frame(df):
+    # The three columns starting at limits, like file 1's, keyed by the normalized composite key.
+    # A CL file works as a limits source too; its CL columns are ignored.
+    idx_limits = df.columns.tolist().index("limits")
+    limit_data = df[KEY_COLUMNS + df.columns[idx_limits: idx_limits + 3].tolist()].copy()
+    limit_data.columns = KEY_COLUMNS + LIMIT_COLUMNS
+    limit_data["spec_id_expansion"] = normalize_expansion(limit_data["spec_id_expansion"])
+    unparsed = coerce_numeric(limit_data, LIMIT_COLUMNS)
+
+    hashes = key_text_hashes(limit_data)
+    first_rows = np.flatnonzero(~pd.Series(hashes).duplicated().to_numpy())
+    return LimitsTable(
+        base=prepare_base(df, copy=False), limits=limit_data[LIMIT_COLUMNS].to_numpy(dtype=float), hashes=hashes,
+        index=pd.Index(hashes[first_rows]), first_rows=first_rows, unparsed=unparsed,
+    )
+
+
+def prepare_limits(file, timer=untimed):
+    # Returns {"table": LimitsTable or None, "missing": [...], "rows": n}
+    with timer("limits_parse") as stage:
+        df = read_cl_files([file])[0]
+        stage["rows"] = len(df)
+    missing = [col for col in LIMITS_REQUIRED_COLUMNS + ["spec_id_expansion"] if col not in df.columns]
+    if missing:
+        return {"table": None, "missing": missing, "rows": len(df)}
+    with timer("limits_index") as stage:
+        table = limits_from_frame(df)
+        stage["rows"] = len(table.index)
+    return {"table": table, "missing": [], "rows": len(df)}
+
+
+def apply_limits(cube, table, timer=untimed):
+    # The cube re-evaluated against the table instead of file 1's limits. Keys of the table no
+    # file has are added without values, and base_index follows the table's rows, so
+    # build_merged_output(table.base, cube) gives one output row per limits row.
+    # Returns (cube, number of limits rows with a spec_number whose key a CL file has).
+    with timer("limits_join") as stage:
+        hashes = key_text_hashes(cube.keys)
+        found = table.index.isin(hashes)
+        extra = table.first_rows[~found]
+        keys = pd.concat([cube.keys, table.base[KEY_COLUMNS].iloc[extra]], ignore_index=True)
+        n_keys = len(keys)
+
+        values = np.full((n_keys,) + cube.values.shape[1:], np.nan, dtype=cube.values.dtype)
+        values[:cube.n_keys] = cube.values
+        present = np.zeros((n_keys, cube.n_files), dtype=bool)
+        present[:cube.n_keys] = cube.present
+
+        all_hashes = np.concatenate([hashes, table.hashes[extra]])
+        matched = table.index.get_indexer(all_hashes)
+        limits = np.full((n_keys, len(LIMIT_COLUMNS)), np.nan)
+        limits[matched >= 0] = table.limits[table.first_rows[matched[matched >= 0]]]
+
+        # Keys that only differ in dtype read as the same text; the first of them takes the rows
+        first = np.flatnonzero(~pd.Series(all_hashes).duplicated().to_numpy())
+        base_index = first[pd.Index(all_hashes[first]).get_indexer(table.hashes)]
+
+        joined = CLCube(keys=keys, values=values, limits=limits, present=present, names=cube.names, base_index=base_index)
+        joined.columns["File Presence"] = presence_labels(joined.present)
+        joined = joined.reorder(sort_order(joined.keys))
+        add_pass_fail(joined)
+        stage["rows"] = joined.n_keys
+
+    has_spec = table.base["spec_number"].iloc[table.first_rows].notna().to_numpy()
+    return joined, int((found & has_spec).sum())
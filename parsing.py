@@ -0,0 +1,54 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# Optional comparison sign, a number with optional thousands separators and exponent, then a unit
+VALUE_PATTERN = re.compile(
+    r"^\s*(?:[<>]=?|[≤≥~≈])?\s*"
+    r"(?P<number>[+\-−]?(?:\d{1,3}(?:,\d{3})+|\d+)?(?:\.\d+)?(?:[eE][+\-]?\d+)?)"
+    r"\s*(?P<unit>[^\d\s]*)\s*$"
+)
+MISSING_TOKENS = {"", "nan", "n/a", "na", "none", "null", "-", "--", "—", "tbd"}
+SI_PREFIXES = {"p": 1e-12, "n": 1e-9, "u": 1e-6, "µ": 1e-6, "μ": 1e-6, "m": 1e-3, "k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9}
+# Prefixes are only applied in front of these, so dB, dBm, %, ppm and the like keep their value
+BASE_UNITS = {"A", "V", "W", "Hz", "s", "F", "H", "Ω", "ohm", "Ohm"}
+# pandas.read_csv's default na_values, for the engines that read the CSV themselves
+CSV_NULLS = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A",
+    "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+
+def unit_scale(unit):
+    if len(unit) > 1 and unit[0] in SI_PREFIXES and unit[1:] in BASE_UNITS:
+        return SI_PREFIXES[unit[0]]
+    return 1.0
+
+
+def parse_numeric(series):
+    # Returns (float array, unparsed mask). Plain numbers go through pd.to_numeric; only the
+    # cells it rejects are matched against VALUE_PATTERN, so clean columns never touch the regex.
+    # Cells without any digit (sub-header labels, "N/A", "TBD") are missing, not unparsed.
+    values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
+    unparsed = np.zeros(len(series), dtype=bool)
+    if series.dtype != object:
+        return values, unparsed
+
+    # Indexed by position so the results go straight back into the arrays
+    positions = np.flatnonzero(np.isnan(values))
+    text = pd.Series(series.to_numpy()[positions], index=positions).dropna().astype(str).str.strip()
+    text = text[text.str.contains(r"\d", regex=True) & ~text.str.lower().isin(MISSING_TOKENS)]
+    if text.empty:
+        return values, unparsed
+
+    matched = text.str.extract(VALUE_PATTERN)
+    number = matched["number"].str.replace(",", "", regex=False).str.replace("−", "-", regex=False)
+    parsed = pd.to_numeric(number, errors="coerce").to_numpy(dtype=float)
+    units = matched["unit"].fillna("")
+    scale = units.map({unit: unit_scale(unit) for unit in units.unique()}).to_numpy(dtype=float)
+
+    positions = text.index.to_numpy()
+    values[positions] = parsed * scale
+    unparsed[positions] = np.isnan(parsed)
+    return values, unparsed
@@ -0,0 +1,368 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from comparison import (
+    REQUIRED_COLUMNS, ComparisonError, check_row_limit, check_duplicates, check_memory_budget, prepare_file,
+    prepare_base, join_files, build_merged_output, filter_expansion, reorder_output_columns, attach_key_columns,
+    worst_case_view, cube_output, duplicate_key_count, normalize_expansion, natural_key, unparsed_report, sort_order
+)
+from cube import WORST_CASE, delta_columns, key_value
+from excel_export import column_widths
+
+PARTITION_TEMP_DIR_ENV = "CL_COMPARE_PARTITION_TEMP_DIR"
+# About this many rows of all files together go into one partition
+DEFAULT_PARTITION_ROWS = 1_000_000
+CHUNK_ROWS = 100_000
+INTEGER_PATTERN = r"\s*[+-]?\d+\s*"
+
+
+def _reader(source):
+    # A path, the bytes of an upload or a file object
+    if isinstance(source, bytes):
+        return BytesIO(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source
+
+
+def partition_labels(spec_numbers):
+    # spec_number text as it is partitioned: numbers as numbers, the way read_csv would type them,
+    # so "1.10" and "1.1" land together. Only ever groups keys more coarsely than the join does.
+    # Numbers are written as key_value, since a chunk with text spec numbers parses 2 as 2.0.
+    numbers = pd.to_numeric(spec_numbers, errors="coerce")
+    return spec_numbers.str.strip().where(numbers.isna(), numbers.map(key_value))
+
+
+def range_partitions(label_counts, n_partitions):
+    # label -> partition number, cutting the labels in natural order into runs of about equal rows,
+    # so the partitions come out in spec_number order
+    labels = sorted(label_counts, key=natural_key)
+    counts = np.array([label_counts[label] for label in labels], dtype=np.int64)
+    before = np.cumsum(counts) - counts
+    parts = np.minimum(before * n_partitions // max(int(counts.sum()), 1), n_partitions - 1)
+    return dict(zip(labels, parts.tolist()))
+
+
+class _ColumnTypes:
+    # Tracks over the chunks of a file which text columns read_csv would have read as int64
+    # or float64, so every partition is typed like the whole file
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.integer = dict.fromkeys(columns, True)
+        self.number = dict.fromkeys(columns, True)
+
+    def update(self, chunk):
+        for col in self.columns:
+            values = chunk[col]
+            filled = values.notna()
+            if not filled.all():
+                self.integer[col] = False
+            if self.number[col] and filled.any():
+                self.number[col] = bool(pd.to_numeric(values[filled], errors="coerce").notna().all())
+            self.integer[col] = self.integer[col] and self.number[col] and bool(values.str.fullmatch(INTEGER_PATTERN).all())
+
+    def dtypes(self):
+        return {
+            col: "int64" if self.integer[col] else "float64" if self.number[col] else str
+            for col in self.columns
+        }
+
+
+def compare_partition(job):
+    # One partition through the pandas pipeline: the per-file pieces are read back with the whole
+    # file's column types, joined and evaluated, and the result is pickled next to them.
+    # Returns what the whole run needs to know without loading the result again.
+    frames = [pd.read_csv(path, dtype=dtypes) for path, dtypes in zip(job["paths"], job["dtypes"])]
+    prepared = [prepare_file(df, i) for i, df in enumerate(frames)]
+    aligned = [aligned for aligned, _, _ in prepared]
+    duplicates = [duplicate_key_count(df) for df in aligned]
+    base_df = prepare_base(frames[0], copy=False)
+    expansion_filter = job["expansion_filter"]
+    if expansion_filter not in ["All", WORST_CASE]:
+        # Keys include the expansion, so other expansions can be dropped before the join
+        aligned = [filter_expansion(df, expansion_filter) for df in aligned]
+        base_df = filter_expansion(base_df, expansion_filter)
+    check_memory_budget(aligned, len(base_df), budget_mb=job["memory_budget_mb"])
+    # "Reject" is decided once every partition has counted its repeated keys
+    duplicate_policy = "Keep first" if job["duplicate_policy"] == "Reject" else job["duplicate_policy"]
+    cube = join_files(aligned, job["names"], duplicate_policy=duplicate_policy, max_rows=0)
+
+    if expansion_filter == WORST_CASE:
+        cube = worst_case_view(cube)
+        result = cube_output(cube)
+    else:
+        result = build_merged_output(base_df, cube)
+    if job["reference"] is not None:
+        result = attach_key_columns(result, cube, delta_columns(cube, job["reference"]))
+    result.reset_index(drop=True).to_pickle(job["output"])
+    return {
+        "rows": len(result),
+        "failed": int((result["Pass or Fail"] == "Fail").sum()),
+        "widths": dict(zip(result.columns, column_widths(result))),
+        "duplicates": duplicates,
+        "unparsed": [unparsed for _, _, unparsed in prepared],
+    }
+
+
+def _merge_unparsed(partitions, n_files):
+    # Per file {column: (count, first few originals)} summed over the partitions
+    merged = [{} for _ in range(n_files)]
+    for unparsed_by_file in partitions:
+        for total, unparsed in zip(merged, unparsed_by_file):
+            for col, (count, examples) in unparsed.items():
+                before, seen = total.get(col, (0, []))
+                total[col] = (before + count, (seen + examples)[:5])
+    return merged
+
+
+def _sorted_runs(output, run_rows):
+    # One partition's result sorted with sort_order and cut into pickled runs of run_rows
+    frame = pd.read_pickle(output)
+    frame = frame.iloc[sort_order(frame)].reset_index(drop=True)
+    runs = []
+    for start in range(0, len(frame), run_rows):
+        runs.append(f"{output}.run{len(runs)}")
+        frame.iloc[start: start + run_rows].reset_index(drop=True).to_pickle(runs[-1])
+    return runs
+
+
+def _merge_runs(runs):
+    # k-way merge of the sorted runs of every partition, one loaded run per partition at a time.
+    # The loaded rows are sorted together with sort_order; everything up to the earliest last row
+    # of a partition with runs left is final, as its later runs only hold rows sorting after it.
+    # Ties keep partition order, like one stable sort of the partitions concatenated.
+    def load(p):
+        if not runs[p]:
+            return None
+        path = runs[p].pop(0)
+        frame = pd.read_pickle(path)
+        os.remove(path)
+        return frame
+
+    buffers = [load(p) for p in range(len(runs))]
+    while any(buffer is not None for buffer in buffers):
+        live = [p for p, buffer in enumerate(buffers) if buffer is not None]
+        lengths = np.array([len(buffers[p]) for p in live])
+        frame = pd.concat([buffers[p] for p in live], ignore_index=True)
+        order = sort_order(frame)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        ends = np.cumsum(lengths)
+        bounds = [rank[end - 1] for p, end in zip(live, ends) if runs[p]]
+        taken = order[: min(bounds) + 1 if bounds else len(order)]
+        yield frame.iloc[taken]
+        kept = np.ones(len(frame), dtype=bool)
+        kept[taken] = False
+        for p, start, end in zip(live, ends - lengths, ends):
+            rest = frame.iloc[start:end][kept[start:end]]
+            buffers[p] = rest if len(rest) else load(p)
+
+
+def _sort_outputs(outputs, partitions):
+    # Partitions come in natural_key order of spec_number, while the pandas worst case sorts
+    # spec_number as a whole with sort_order. The partitions are merged in that order and written
+    # back with each partition's row count, so memory stays at about CHUNK_ROWS merged rows plus
+    # one partition.
+    run_rows = max(CHUNK_ROWS // len(outputs), 1)
+    merged = _merge_runs([_sorted_runs(output, run_rows) for output in outputs])
+    leftover = None
+    for output, p in zip(outputs, partitions):
+        pieces, needed = [], p["rows"]
+        while needed:
+            piece = next(merged) if leftover is None else leftover
+            pieces.append(piece.iloc[:needed])
+            leftover = piece.iloc[needed:] if len(piece) > needed else None
+            needed -= len(pieces[-1])
+        if pieces:
+            rows = pd.concat(pieces, ignore_index=True)
+            rows.to_pickle(output)
+            p["failed"] = int((rows["Pass or Fail"] == "Fail").sum())
+
+
+class PartitionedComparison:
+    # The pandas comparison over huge inputs in bounded memory. Every file is split by
+    # spec_number ranges into temporary CSV partitions; a spec key only ever lands in one
+    # partition, so each partition is joined and evaluated on its own, optionally by several
+    # worker processes, and the results are streamed out partition by partition. Peak memory
+    # follows the partition size rather than the file size.
+    #   sources  one path, bytes or file object per file; the first supplies limits and base rows
+
+    def __init__(self, sources, custom_names, duplicate_policy="Keep first", max_rows=0, partitions=None,
+                 workers=1, reference=None, memory_budget_mb=None, temp_directory=None, chunk_rows=CHUNK_ROWS):
+        # memory_budget_mb bounds each partition, see check_memory_budget
+        self.names = list(custom_names)
+        self.duplicate_policy = duplicate_policy
+        self.workers = workers
+        self.reference = reference
+        self.memory_budget_mb = memory_budget_mb
+        self.directory = tempfile.mkdtemp(prefix="cl-partitions-", dir=temp_directory or os.environ.get(PARTITION_TEMP_DIR_ENV))
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self._lock = threading.Lock()
+        self._results = {}
+        self.unparsed = unparsed_report([], self.names)
+        self._split(sources, max_rows, partitions, chunk_rows)
+
+    def close(self):
+        self._cleanup()
+
+    def _split(self, sources, max_rows, partitions, chunk_rows):
+        # First pass: only spec_number, for the row count and the partition boundaries
+        label_counts = {}
+        total_rows = 0
+        for source in sources:
+            columns = pd.read_csv(_reader(source), nrows=0).columns
+            missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+            if missing:
+                raise ComparisonError(f'Missing column "{missing[0]}" in one of the files.')
+            for chunk in pd.read_csv(_reader(source), usecols=["spec_number"], dtype=str, chunksize=chunk_rows):
+                total_rows += len(chunk)
+                for label, count in partition_labels(chunk["spec_number"].dropna()).value_counts().items():
+                    label_counts[label] = label_counts.get(label, 0) + count
+        if max_rows:
+            check_row_limit(total_rows, max_rows)
+        self.n_partitions = partitions or max(1, -(-total_rows // DEFAULT_PARTITION_ROWS))
+        boundaries = range_partitions(label_counts, self.n_partitions)
+
+        # Second pass: every row as text into its partition, in file order. Blank spec numbers,
+        # such as the sub-header row, go to the first partition so it stays the first row.
+        self.paths, self.dtypes, expansions = [], [], set()
+        for f, source in enumerate(sources):
+            paths = [os.path.join(self.directory, f"file{f}_part{p}.csv") for p in range(self.n_partitions)]
+            types = None
+            for chunk in pd.read_csv(_reader(source), dtype=str, chunksize=chunk_rows):
+                if types is None:
+                    types = _ColumnTypes(chunk.columns.tolist())
+                    for path in paths:
+                        chunk.head(0).to_csv(path, index=False)
+                types.update(chunk)
+                expansions.update(normalize_expansion(pd.Series(chunk["spec_id_expansion"].unique())))
+                parts = partition_labels(chunk["spec_number"]).map(boundaries).fillna(0).astype(np.int64)
+                for p, rows in chunk.groupby(parts.to_numpy(), sort=False):
+                    rows.to_csv(paths[p], mode="a", header=False, index=False)
+            self.paths.append(paths)
+            self.dtypes.append(types.dtypes())
+        self._expansions = pd.Series(sorted(expansions), dtype=object)
+
+    def expansions(self):
+        return self._expansions
+
+    def _jobs(self, expansion_filter, directory):
+        for p in range(self.n_partitions):
+            yield {
+                "paths": [paths[p] for paths in self.paths],
+                "dtypes": self.dtypes,
+                "names": self.names,
+                "duplicate_policy": self.duplicate_policy,
+                "expansion_filter": expansion_filter,
+                "reference": self.reference,
+                "memory_budget_mb": self.memory_budget_mb,
+                "output": os.path.join(directory, f"result{p}.pkl"),
+            }
+
+    def result(self, expansion_filter="All"):
+        # Evaluated once per filter into pickled partitions; returns (summary, columns in display order)
+        with self._lock:
+            if expansion_filter not in self._results:
+                self._results[expansion_filter] = self._evaluate(expansion_filter)
+            summary = self._results[expansion_filter]
+        return summary, summary["columns"]
+
+    def _evaluate(self, expansion_filter):
+        directory = tempfile.mkdtemp(prefix="result-", dir=self.directory)
+        jobs = list(self._jobs(expansion_filter, directory))
+        if self.workers > 1:
+            # Spawned, so the workers do not inherit the threads of the process that starts them
+            with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                partitions = list(pool.map(compare_partition, jobs))
+        else:
+            partitions = [compare_partition(job) for job in jobs]
+        totals = [sum(counts) for counts in zip(*(p["duplicates"] for p in partitions))]
+        check_duplicates(totals, self.names, self.duplicate_policy)
+        self.unparsed = unparsed_report(_merge_unparsed([p["unparsed"] for p in partitions], len(self.names)), self.names)
+
+        outputs = [job["output"] for job in jobs]
+        if expansion_filter == WORST_CASE:
+            _sort_outputs(outputs, partitions)
+        columns = list(pd.read_pickle(outputs[0]).columns)
+        first = next((output for output, p in zip(outputs, partitions) if p["rows"]), None)
+        if first is not None:
+            columns = reorder_output_columns(pd.read_pickle(first), self.names, marker="compliance").columns.tolist()
+        widths = {}
+        for p in partitions:
+            for col, width in p["widths"].items():
+                widths[col] = max(widths.get(col, 0), width)
+        return {
+            "columns": columns,
+            "widths": [widths.get(col, len(str(col)) + 2) for col in columns],
+            "outputs": outputs,
+            "rows": [p["rows"] for p in partitions],
+            "failed": [p["failed"] for p in partitions],
+        }
+
+    def row_count(self, expansion_filter="All"):
+        summary, _ = self.result(expansion_filter)
+        return sum(summary["rows"])
+
+    def failed_count(self, expansion_filter="All"):
+        summary, _ = self.result(expansion_filter)
+        return sum(summary["failed"])
+
+    def column_widths(self, expansion_filter="All"):
+        summary, _ = self.result(expansion_filter)
+        return summary["widths"]
+
+    def _load(self, output, columns, fail_only=False):
+        frame = pd.read_pickle(output)[columns]
+        return frame[frame["Pass or Fail"] == "Fail"] if fail_only else frame
+
+    def batches(self, expansion_filter="All", fail_only=False):
+        # The result one partition at a time, in spec_number order
+        summary, columns = self.result(expansion_filter)
+        for output, rows in zip(summary["outputs"], summary["failed" if fail_only else "rows"]):
+            if rows:
+                yield self._load(output, columns, fail_only)
+
+    def page(self, expansion_filter="All", offset=0, limit=1000, fail_only=False):
+        # Only the partitions the page overlaps are loaded
+        summary, columns = self.result(expansion_filter)
+        pieces, start = [], 0
+        for output, rows in zip(summary["outputs"], summary["failed" if fail_only else "rows"]):
+            if rows and start + rows > offset and start < offset + limit:
+                frame = self._load(output, columns, fail_only)
+                pieces.append(frame.iloc[max(offset - start, 0): offset + limit - start])
+            start += rows
+        return pd.concat(pieces, ignore_index=True) if pieces else pd.DataFrame(columns=columns)
+
+    def write_parquet(self, path, expansion_filter="All"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("pyarrow is not installed; pip install pyarrow or write Excel")
+        summary, columns = self.result(expansion_filter)
+        writer = None
+        try:
+            for output in summary["outputs"]:
+                frame = self._load(output, columns)
+                if writer is None:
+                    # Text columns as strings even where a partition has none of them filled
+                    schema = pa.schema([
+                        (col, pa.string() if frame[col].dtype == object else pa.from_numpy_dtype(frame[col].dtype))
+                        for col in frame.columns
+                    ])
+                    writer = pq.ParquetWriter(path, schema)
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+        return path
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from cube import VALUE_TYPES, TYP, widen
+
+VALUE_TYPE_DASH = {"Minimum": "dot", "Typical": "solid", "Maximum": "dash"}
+LIMIT_LINES = {
+    "Minimum": ("Minimum_Limits1", "Minimum Limit", "purple"),
+    "Typical": ("Typical_Limits1", "Typical Limit", "orange"),
+    "Maximum": ("Maximum_Limits1", "Maximum Limit", "brown"),
+}
+ID_COLUMNS = ["spec_number", "spec_item_category", "spec_item_old_name"]
+
+
+def typical_deviation(cube):
+    # Typical CL minus Typical limit, absolute and relative, one column pair per file
+    limit = cube.limits[:, TYP]
+    dev = widen(cube.values[:, :, TYP]) - limit[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dev_pct = np.where(limit[:, None] != 0, dev / np.abs(limit)[:, None] * 100, np.nan)
+    out = {}
+    for f, name in enumerate(cube.names):
+        out[f"Typical_Dev_{name}"] = dev[:, f]
+        out[f"Typical_Dev%_{name}"] = dev_pct[:, f]
+    return pd.DataFrame(out)
+
+
+def typical_deviation_summary(deviation, custom_names):
+    rows = []
+    for name in custom_names:
+        col = f"Typical_Dev_{name}"
+        if col not in deviation.columns:
+            continue
+        dev = deviation[col].to_numpy(dtype=float)
+        valid = ~np.isnan(dev)
+        abs_dev = np.abs(dev[valid])
+        rows.append({
+            "File": name,
+            "Specs with Typical": int(valid.sum()),
+            "Mean Deviation": dev[valid].mean() if valid.any() else np.nan,
+            "Max |Deviation|": abs_dev.max() if valid.any() else np.nan,
+            "Mean |Deviation| %": np.nanmean(np.abs(deviation[f"Typical_Dev%_{name}"].to_numpy(dtype=float)[valid])) if valid.any() else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+
+def build_plot_frame(cube, value_types=("Minimum", "Maximum")):
+    # Long-format plot data stacked straight from the cube: file-major, then value type,
+    # so no melt of a wide frame and no per-row lambda to recover file and value type.
+    types = [VALUE_TYPES.index(value_type) for value_type in value_types]
+    n = cube.n_keys
+    k = cube.n_files * len(types)
+    frame = {col: np.tile(cube.keys[col].to_numpy(), k) for col in ID_COLUMNS}
+    # (n_keys, n_files, types) -> (n_files, types, n_keys) flattened
+    frame["Value"] = widen(cube.values[:, :, types].transpose(1, 2, 0).reshape(-1))
+    frame["File"] = pd.Categorical.from_codes(np.repeat(np.arange(cube.n_files), len(types) * n), categories=list(cube.names))
+    frame["Value Type"] = pd.Categorical.from_codes(
+        np.tile(np.repeat(types, n), cube.n_files).astype(int),
+        categories=VALUE_TYPES
+    )
+    # Only a Typical value has a deviation from the Typical limit
+    is_typical = np.tile(np.repeat(np.asarray(types) == TYP, n), cube.n_files)
+    frame["Deviation from Typical"] = np.where(is_typical, frame["Value"] - np.tile(cube.limits[:, TYP], k), np.nan)
+    return pd.DataFrame(frame)
+
+
+def build_cl_figure(plot_frame, cube, title, show_limits):
+    hover_data = ["spec_number", "Value", "File", "Value Type"]
+    if "Deviation from Typical" in plot_frame.columns:
+        hover_data.append("Deviation from Typical")
+    palette = px.colors.qualitative.Plotly
+    fig = px.line(
+        plot_frame,
+        x="spec_number",
+        y="Value",
+        color="File",
+        line_dash="Value Type",
+        markers=True,
+        hover_data=hover_data,
+        color_discrete_map={name: palette[i % len(palette)] for i, name in enumerate(cube.names)},
+        line_dash_map=VALUE_TYPE_DASH,
+        category_orders={"File": list(cube.names), "Value Type": VALUE_TYPES},
+        title=title
+    )
+
+    for t, value_type in enumerate(VALUE_TYPES):
+        _, label, color = LIMIT_LINES[value_type]
+        if show_limits.get(value_type):
+            fig.add_trace(go.Scatter(
+                x=cube.keys["spec_number"],
+                y=cube.limits[:, t],
+                mode='lines+markers',
+                name=label,
+                line=dict(color=color, dash='dash')
+            ))
+
+    fig.update_layout(
+        xaxis_title="Spec Number",
+        yaxis_title="CL Value",
+        legend_title="File / Value Type",
+        xaxis_tickangle=45,
+        height=600
+    )
+    return fig
+
+
+def build_trend_frame(trend, value_types=VALUE_TYPES):
+    # ResultsStore.trend in long format, one row per point and value type; at most a few
+    # thousand rows as the store has already downsampled
+    id_columns = [col for col in trend.columns if col not in VALUE_TYPES]
+    frame = trend.melt(id_vars=id_columns, value_vars=list(value_types), var_name="Value Type", value_name="Value")
+    frame["Value Type"] = pd.Categorical(frame["Value Type"], categories=VALUE_TYPES)
+    return frame
+
+
+def build_trend_figure(plot_frame, trend, title, show_limits, x="Lot"):
+    # Same styling as build_cl_figure, along lots or time instead of spec numbers
+    fig = px.line(
+        plot_frame,
+        x=x,
+        y="Value",
+        line_dash="Value Type",
+        markers=True,
+        hover_data=["First lot", "Last lot", "Lots", "Specs", "Failing", "Value Type"],
+        color_discrete_sequence=px.colors.qualitative.Plotly,
+        line_dash_map=VALUE_TYPE_DASH,
+        category_orders={"Value Type": VALUE_TYPES},
+        title=title
+    )
+
+    for value_type in VALUE_TYPES:
+        column, label, color = LIMIT_LINES[value_type]
+        if show_limits.get(value_type):
+            fig.add_trace(go.Scatter(
+                x=trend[x],
+                y=trend[column],
+                mode='lines+markers',
+                name=label,
+                line=dict(color=color, dash='dash')
+            ))
+
+    fig.update_layout(
+        xaxis_title="Saved (UTC)" if x == "Saved (UTC)" else "Stored lot",
+        yaxis_title="CL Value",
+        legend_title="Value Type",
+        xaxis_tickangle=45,
+        height=600
+    )
+    return fig
@@ -0,0 +1,328 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from comparison import (
+    REQUIRED_COLUMNS, ComparisonError, check_row_limit, check_duplicates, max_rows_from_env
+)
+from cube import CLCube, KEY_COLUMNS, LIMIT_COLUMNS, VALUE_TYPES, WORST_CASE
+from parsing import VALUE_PATTERN, SI_PREFIXES, BASE_UNITS, CSV_NULLS
+
+try:
+    import polars as pl
+except ImportError:  # optional engine
+    pl = None
+
+# Spec keys are numbered across files as file * FILE_STRIDE + row, so first appearance orders them
+FILE_STRIDE = 1 << 40
+# CSV column types come from this many rows; a later cell that does not fit makes the run start
+# over with types from the whole file
+SCHEMA_SAMPLE_ROWS = 10_000
+
+
+def scan_source(source, infer_schema_length=SCHEMA_SAMPLE_ROWS):
+    # Lazy scan of one upload: a path (.csv or .parquet) or the raw bytes. CSV headers are named
+    # as pandas names them.
+    if isinstance(source, bytes):
+        if source[:4] == b"PAR1":
+            return pl.read_parquet(BytesIO(source)).lazy()
+        header = pd.read_csv(BytesIO(source), nrows=0).columns.tolist()
+    elif source.lower().endswith(".parquet"):
+        return pl.scan_parquet(source)
+    else:
+        header = pd.read_csv(source, nrows=0).columns.tolist()
+    return pl.scan_csv(source, infer_schema_length=infer_schema_length, null_values=CSV_NULLS, new_columns=header)
+
+
+def parse_values(column, dtype):
+    # parse_numeric as an expression: plain numbers first, then units and separators via
+    # VALUE_PATTERN for text holding a digit. NaN counts as missing.
+    if dtype.is_numeric():
+        return pl.col(column).cast(pl.Float64).fill_nan(None)
+    text = pl.col(column).cast(pl.String).str.strip_chars()
+    plain = text.cast(pl.Float64, strict=False)
+    # Only the cells the plain cast rejects reach the regex; the rest are null there
+    rest = pl.when(plain.is_null()).then(text)
+    parts = pl.when(rest.str.contains(r"\d")).then(rest).str.extract_groups(VALUE_PATTERN.pattern)
+    number = (
+        parts.struct.field("number")
+        .str.replace_all(",", "", literal=True).str.replace_all("−", "-", literal=True)
+        .cast(pl.Float64, strict=False)
+    )
+    unit = parts.struct.field("unit")
+    scale = (
+        pl.when((unit.str.len_chars() > 1) & unit.str.slice(1).is_in(list(BASE_UNITS)))
+        .then(unit.str.slice(0, 1).replace_strict(SI_PREFIXES, default=1.0, return_dtype=pl.Float64))
+        .otherwise(1.0)
+    )
+    return pl.coalesce(plain.fill_nan(None), number * scale)
+
+
+def unparsed_cells(column):
+    # The cells parse_numeric reports: text holding a digit that parse_values leaves missing
+    text = pl.col(column).cast(pl.String).str.strip_chars()
+    return text.str.contains(r"\d").fill_null(False) & parse_values(column, pl.String).is_null()
+
+
+def normalize_expansion(column="spec_id_expansion"):
+    # comparison.normalize_expansion: 1.0 -> "1", 1.5 -> "1.5", blanks -> ""
+    text = pl.col(column).cast(pl.String).str.strip_chars()
+    number = text.cast(pl.Float64, strict=False)
+    return (
+        pl.when(text.is_null() | text.is_in(["", "nan"])).then(pl.lit(""))
+        .when(number.is_null()).then(text)
+        .when(number == number.round()).then(number.cast(pl.Int64).cast(pl.String))
+        .otherwise(number.cast(pl.String))
+        .alias(column)
+    )
+
+
+def key_types(schemas):
+    # A key column stays numeric only if it is numeric in every file, as the keys have to match,
+    # and integer only if it is integer in every file, as read_csv and the pandas merge keep it
+    types = {}
+    for col in KEY_COLUMNS:
+        if col == "spec_id_expansion":
+            continue
+        if all(schema[col].is_integer() for schema in schemas):
+            types[col] = pl.Int64
+        elif all(schema[col].is_numeric() for schema in schemas):
+            types[col] = pl.Float64
+        else:
+            types[col] = pl.String
+    return types
+
+
+def key_expressions(types):
+    return [normalize_expansion() if col == "spec_id_expansion" else pl.col(col).cast(types[col]) for col in KEY_COLUMNS]
+
+
+def key_filter(expansion_filter="All", categories=None):
+    # Conditions on the key only, so they hold per file and are pushed down into every scan
+    conditions = []
+    if expansion_filter not in ["All", WORST_CASE]:
+        conditions.append(pl.col("spec_id_expansion") == ("" if expansion_filter == "Blank" else expansion_filter))
+    if categories is not None:
+        # As text, the way key_options lists them
+        conditions.append(pl.col("spec_item_category").cast(pl.String).is_in(list(categories)))
+    return pl.all_horizontal(conditions) if conditions else None
+
+
+def value_columns(schema, index):
+    # align_file's [(column in the file, name)]: for the first file the limits from `limits` on,
+    # then the three CL columns from cm_summary on
+    columns = list(schema)
+    pairs = []
+    if index == 0:
+        limit_start = columns.index("limits")
+        pairs += zip(columns[limit_start: limit_start + 3], LIMIT_COLUMNS)
+    cl_start = columns.index("cm_summary")
+    return pairs + list(zip(columns[cl_start: cl_start + 3], VALUE_TYPES))
+
+
+def file_frame(frame, schema, index, types):
+    # align_file + normalization: keys and the parsed limit and CL columns. r is the row in the file.
+    selected = [parse_values(col, schema[col]).alias(name) for col, name in value_columns(schema, index)]
+    return frame.with_row_index("r").select([pl.lit(index).alias("f"), pl.col("r")] + key_expressions(types) + selected)
+
+
+def unparsed_summary(frame, schema, index):
+    # coerce_numeric's report for the whole file as one row: the count and first few originals
+    # of every text column. None when every column is numeric, as nothing can be unparsed.
+    text = [(col, name) for col, name in value_columns(schema, index) if not schema[col].is_numeric()]
+    if not text:
+        return None
+    return frame.select(
+        [unparsed_cells(col).sum().alias(f"{name}_count") for col, name in text]
+        + [pl.col(col).filter(unparsed_cells(col)).cast(pl.String).head(5).implode().alias(f"{name}_examples")
+           for col, name in text]
+    )
+
+
+def unparsed_dict(summary):
+    # {column: (count, examples)} from an unparsed_summary row, as coerce_numeric returns it
+    if summary is None:
+        return {}
+    row = summary.row(0, named=True)
+    return {
+        col[:-len("_count")]: (int(count), [str(v) for v in row[col[:-len("_count")] + "_examples"]])
+        for col, count in row.items() if col.endswith("_count") and count
+    }
+
+
+def keyed_frame(files, names, duplicate_policy="Keep first"):
+    # One row per spec key: the first row of each file's repeats (or its worst case), full-joined
+    # across files on the key, then presence, ordering and Pass/Fail
+    keyed = None
+    for i, (frame, name) in enumerate(zip(files, names)):
+        if duplicate_policy == "Worst case":
+            # Lowest Minimum and highest Maximum over the repeats, the rest from the first row
+            frame = frame.group_by(KEY_COLUMNS, maintain_order=True).agg(
+                pl.all().exclude(KEY_COLUMNS + ["Minimum", "Maximum"]).first(),
+                pl.col("Minimum").min(), pl.col("Maximum").max(),
+            )
+        else:
+            frame = frame.unique(KEY_COLUMNS, keep="first", maintain_order=True)
+        frame = frame.select(
+            KEY_COLUMNS + (LIMIT_COLUMNS if i == 0 else [])
+            + [(pl.col("r") + i * FILE_STRIDE).alias(f"seen_{i}")]
+            + [pl.col(value_type).alias(f"{value_type}_{name}") for value_type in VALUE_TYPES]
+        )
+        keyed = frame if keyed is None else keyed.join(frame, on=KEY_COLUMNS, how="full", coalesce=True, nulls_equal=True)
+
+    seen = [pl.col(f"seen_{i}") for i in range(len(names))]
+    keyed = keyed.with_columns(
+        [pl.min_horizontal(seen).alias("seen")] + [col.is_not_null().alias(f"present_{i}") for i, col in enumerate(seen)]
+    )
+    # Blank expansion first within each spec_number, then the numbered ones, as sort_order
+    keyed = keyed.sort(
+        [pl.col("spec_number"), pl.col("spec_id_expansion") != "", pl.col("spec_id_expansion"), pl.col("seen")],
+        nulls_last=True,
+    )
+    return keyed.with_columns(presence_label(len(names)), *pass_fail(names))
+
+
+def presence_label(n_files):
+    # presence_labels as an expression
+    present = [pl.col(f"present_{i}") for i in range(n_files)]
+    listed = [pl.when(p).then(pl.lit(str(i + 1))) for i, p in enumerate(present)]
+    return (
+        pl.when(pl.all_horizontal(present)).then(pl.lit("Found in all files"))
+        .when(pl.sum_horizontal([p.cast(pl.Int32) for p in present]) == 1)
+        .then(pl.lit("Only found in uploaded file ") + pl.concat_str(listed, ignore_nulls=True))
+        .otherwise(pl.lit("Found in files: ") + pl.concat_str(listed, separator=", ", ignore_nulls=True))
+        .alias("File Presence")
+    )
+
+
+def pass_fail(names):
+    # cube.evaluate as expressions; reasons per file in the same order
+    minimum_limit, maximum_limit = pl.col("Minimum_Limits1"), pl.col("Maximum_Limits1")
+    checks = []
+    for name in names:
+        minimum, typical, maximum = (pl.col(f"{value_type}_{name}") for value_type in VALUE_TYPES)
+        checks += [
+            ((minimum < minimum_limit).fill_null(False), f"Minimum_{name} < Minimum_Limits1"),
+            ((maximum > maximum_limit).fill_null(False), f"Maximum_{name} > Maximum_Limits1"),
+            (((typical < minimum_limit) & (typical > maximum_limit)).fill_null(False), f"Typical_{name} outside both limit bounds"),
+        ]
+    failed = pl.any_horizontal([check for check, _ in checks])
+    return [
+        pl.when(failed).then(pl.lit("Fail")).otherwise(pl.lit("Pass")).alias("Pass or Fail"),
+        pl.concat_str([pl.when(check).then(pl.lit(reason)) for check, reason in checks], separator=", ", ignore_nulls=True)
+        .alias("Why Failed"),
+    ]
+
+
+def polars_comparison(sources, custom_names, duplicate_policy="Keep first", expansion_filter="All", categories=None,
+                      max_rows=None):
+    # The load -> align -> join -> normalize -> evaluate pipeline as LazyFrame plans. Returns
+    # (cube, base_df, unparsed) as join_files, prepare_base and prepare_file would, so
+    # build_merged_output, unparsed_report and every cube view work unchanged. expansion_filter
+    # and categories are applied in the scans, so rows of other expansions or categories are
+    # never materialized; unparsed covers the whole files, as the pandas engine reports them.
+    if pl is None:
+        raise RuntimeError("polars is not installed; pip install polars or use the pandas engine")
+    try:
+        return _compare(sources, list(custom_names), duplicate_policy, expansion_filter, categories, max_rows,
+                        SCHEMA_SAMPLE_ROWS)
+    except pl.exceptions.ComputeError:
+        # A cell past the sampled rows did not fit its column's type
+        return _compare(sources, list(custom_names), duplicate_policy, expansion_filter, categories, max_rows, None)
+
+
+def key_options(sources):
+    # The normalized expansions and the categories of all files, from a scan of those two columns,
+    # so the filters polars_comparison pushes down can be chosen before it runs
+    if pl is None:
+        raise RuntimeError("polars is not installed; pip install polars or use the pandas engine")
+    try:
+        try:
+            keys = _key_values(sources, SCHEMA_SAMPLE_ROWS)
+        except pl.exceptions.ComputeError:
+            keys = _key_values(sources, None)
+    except pl.exceptions.ColumnNotFoundError:
+        # polars_comparison reports the missing column
+        return pd.Series([], dtype=object), []
+    categories = keys["spec_item_category"].drop_nulls().unique().sort().to_list()
+    return pd.Series(keys["spec_id_expansion"].unique().to_list(), dtype=object), categories
+
+
+def _key_values(sources, infer_schema_length):
+    return pl.concat(pl.collect_all([
+        scan_source(source, infer_schema_length).select(normalize_expansion(), pl.col("spec_item_category").cast(pl.String)).unique()
+        for source in sources
+    ]))
+
+
+def to_pandas(frame):
+    # Missing text as NaN rather than None, and empty columns as float, as read_csv gives them
+    df = frame.to_pandas()
+    for col in df.columns[(df.dtypes == object).to_numpy()]:
+        missing = df[col].isna()
+        df[col] = np.nan if missing.all() else df[col].where(~missing, np.nan)
+    return df
+
+
+def _compare(sources, names, duplicate_policy, expansion_filter, categories, max_rows, infer_schema_length):
+    frames = [scan_source(source, infer_schema_length) for source in sources]
+    schemas = [frame.collect_schema() for frame in frames]
+    for schema in schemas:
+        missing = [col for col in REQUIRED_COLUMNS if col not in schema]
+        if missing:
+            raise ComparisonError(f'Missing column "{missing[0]}" in one of the files.')
+
+    types = key_types(schemas)
+    files = [file_frame(frame, schema, i, types) for i, (frame, schema) in enumerate(zip(frames, schemas))]
+    max_rows = max_rows_from_env() if max_rows is None else max_rows
+    if max_rows:
+        # Counting rows only splits lines, nothing is parsed
+        check_row_limit(sum(count.item() for count in pl.collect_all([frame.select(pl.len()) for frame in frames])), max_rows)
+    if duplicate_policy == "Reject":
+        # Whole files, as the pandas engine checks them
+        duplicates = pl.collect_all([frame.group_by(KEY_COLUMNS).len().select((pl.col("len") - 1).sum()) for frame in files])
+        check_duplicates([int(count.item()) for count in duplicates], names, duplicate_policy)
+
+    predicate = key_filter(expansion_filter, categories)
+    if predicate is not None:
+        files = [frame.filter(predicate) for frame in files]
+
+    # prepare_base: every row of the first file with its keys normalized
+    base = frames[0].with_columns(key_expressions(types))
+    if predicate is not None:
+        base = base.filter(predicate)
+    summaries = [unparsed_summary(frame, schema, i) for i, (frame, schema) in enumerate(zip(frames, schemas))]
+    # read_csv reads an integer column with a blank anywhere in the file as float. base_df keeps
+    # the first file's own key types, as prepare_base does, so its own integer columns count too.
+    base_types = key_types(schemas[:1])
+    integer_keys = [col for col, key_type in types.items() if key_type == pl.Int64]
+    counted = [[col for col, key_type in (base_types if i == 0 else types).items() if key_type == pl.Int64] for i in range(len(frames))]
+    null_counts = [frame.select([pl.col(col).null_count() for col in cols]) for frame, cols in zip(frames, counted)]
+    keyed, base_df, *collected = pl.collect_all(
+        [keyed_frame(files, names, duplicate_policy).with_row_index("position"), base]
+        + null_counts + [summary for summary in summaries if summary is not None]
+    )
+    blanks = [counts.row(0, named=True) if counts.width else {} for counts in collected[:len(null_counts)]]
+    collected = iter(collected[len(null_counts):])
+    unparsed = [unparsed_dict(None if summary is None else next(collected)) for summary in summaries]
+    base_index = base_df.select(KEY_COLUMNS).join(
+        keyed.select(KEY_COLUMNS + ["position"]), on=KEY_COLUMNS, how="left", nulls_equal=True, maintain_order="left"
+    )["position"].to_numpy().astype(np.int64)
+
+    values = np.stack([
+        np.stack([keyed[f"{value_type}_{name}"].to_numpy().astype(float) for value_type in VALUE_TYPES], axis=1)
+        for name in names
+    ], axis=1) if names else np.empty((keyed.height, 0, 3))
+    float_keys = [col for col in integer_keys if any(counts[col] for counts in blanks)]
+    cube = CLCube(
+        keys=to_pandas(keyed.select(KEY_COLUMNS)).astype({col: float for col in float_keys}),
+        values=values,
+        limits=np.stack([keyed[limit].to_numpy().astype(float) for limit in LIMIT_COLUMNS], axis=1),
+        present=np.stack([keyed[f"present_{i}"].to_numpy() for i in range(len(names))], axis=1),
+        names=names,
+        base_index=base_index,
+        columns={col: keyed[col].to_numpy().astype(object) for col in ["File Presence", "Pass or Fail", "Why Failed"]},
+    )
+    base_df = base_df.with_columns([pl.col(col).cast(key_type) for col, key_type in base_types.items() if key_type != types[col]])
+    return cube, to_pandas(base_df).astype({col: float for col in counted[0] if blanks[0][col]}), unparsed
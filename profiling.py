@@ -0,0 +1,82 @@
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_ENV = "CL_COMPARE_PROFILE"
+PROFILE_DIR_ENV = "CL_COMPARE_PROFILE_DIR"
+PROFILERS = ["cprofile", "pyinstrument"]
+
+
+def profiler_from_env():
+    # CL_COMPARE_PROFILE=cprofile|pyinstrument (1/true mean cprofile); unset or 0 disables profiling
+    value = os.environ.get(PROFILE_ENV, "").strip().lower()
+    if value in ("", "0", "false", "off", "no"):
+        return None
+    if value in ("1", "true", "on", "yes"):
+        return "cprofile"
+    if value not in PROFILERS:
+        raise ValueError(f'{PROFILE_ENV} must be one of {", ".join(PROFILERS)}, got "{value}"')
+    return value
+
+
+class RunProfiler:
+    # The profiler module is imported in start(), so nothing is loaded unless profiling was asked for
+
+    def __init__(self, kind, output_stem):
+        self.kind = kind
+        self.output_stem = output_stem
+        self.path = None
+        self._profiler = None
+
+    @classmethod
+    def from_env(cls, output_dir=None, name="cl_comparison"):
+        kind = profiler_from_env()
+        if kind is None:
+            return None
+        output_dir = output_dir or os.environ.get(PROFILE_DIR_ENV) or os.getcwd()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return cls(kind, os.path.join(output_dir, f"{name}-{stamp}"))
+
+    def start(self):
+        # The output directory is made now, so a bad one fails before the run rather than after it
+        os.makedirs(os.path.dirname(self.output_stem) or ".", exist_ok=True)
+        if self.kind == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError as e:
+                raise RuntimeError("pyinstrument is not installed; pip install pyinstrument or use cprofile") from e
+            self._profiler = Profiler()
+            self._profiler.start()
+        else:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        if self._profiler is None:
+            return self.path
+        if self.kind == "pyinstrument":
+            self._profiler.stop()
+            self.path = self.output_stem + ".html"
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(self._profiler.output_html())
+        else:
+            self._profiler.disable()
+            self.path = self.output_stem + ".prof"
+            self._profiler.dump_stats(self.path)
+        self._profiler = None
+        return self.path
+
+
+@contextmanager
+def profile_run(kind, output_stem):
+    # Yields the RunProfiler (or None when kind is None); its .path is set on exit
+    if kind is None:
+        yield None
+        return
+    profiler = RunProfiler(kind, output_stem).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
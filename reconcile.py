@@ -0,0 +1,90 @@
+import re
+from collections import defaultdict
+
+import pandas as pd
+
+from comparison import key_hashes
+
+BLOCK_COLUMNS = ["spec_number", "spec_id_expansion", "spec_item_category"]
+PROPOSAL_COLUMNS = BLOCK_COLUMNS + ["File", "Name in file", "Matched name", "Similarity"]
+DEFAULT_SIMILARITY = 0.6
+
+
+def ngrams(text, n=2):
+    # Case, spacing and punctuation differences do not count as renames
+    padded = f" {re.sub(r'[^0-9a-z]+', ' ', text.lower()).strip()} "
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+def _unmatched(df, other):
+    # Rows of df whose full key does not occur in other, one per block + name
+    rows = df[~key_hashes(df).isin(key_hashes(other)).to_numpy()]
+    rows = rows[rows["spec_item_old_name"].map(lambda name: isinstance(name, str))]
+    return rows.drop_duplicates(BLOCK_COLUMNS + ["spec_item_old_name"])
+
+
+def propose_renames(aligned, custom_names, min_similarity=DEFAULT_SIMILARITY, n=2):
+    # For every later file, pair spec_item_old_name values that only it has with names only the
+    # first file has, within the same spec_number/expansion/category. Candidates come from an
+    # n-gram inverted index per block, so only names sharing an n-gram are ever scored (Jaccard).
+    # Each name is used at most once per file, best scores first.
+    base = aligned[0]
+    proposals = []
+    for f in range(1, len(aligned)):
+        only_base = _unmatched(base, aligned[f])
+        only_file = _unmatched(aligned[f], base)
+        if only_base.empty or only_file.empty:
+            continue
+
+        index = defaultdict(list)
+        base_grams = {}
+        for block, name in zip(zip(*(only_base[col] for col in BLOCK_COLUMNS)), only_base["spec_item_old_name"]):
+            grams = ngrams(name, n)
+            base_grams[block, name] = grams
+            for gram in grams:
+                index[block, gram].append(name)
+
+        scored = []
+        for block, name in zip(zip(*(only_file[col] for col in BLOCK_COLUMNS)), only_file["spec_item_old_name"]):
+            grams = ngrams(name, n)
+            shared = defaultdict(int)
+            for gram in grams:
+                for candidate in index.get((block, gram), ()):
+                    shared[candidate] += 1
+            for candidate, count in shared.items():
+                similarity = count / (len(grams) + len(base_grams[block, candidate]) - count)
+                if similarity >= min_similarity:
+                    scored.append((similarity, block, name, candidate))
+
+        used_names, used_candidates = set(), set()
+        for similarity, block, name, candidate in sorted(scored, key=lambda item: -item[0]):
+            if (block, name) in used_names or (block, candidate) in used_candidates:
+                continue
+            used_names.add((block, name))
+            used_candidates.add((block, candidate))
+            proposals.append(list(block) + [custom_names[f], name, candidate, round(similarity, 3)])
+    return pd.DataFrame(proposals, columns=PROPOSAL_COLUMNS)
+
+
+def rename_mapping(proposals, custom_names):
+    # Hashable form of the accepted proposals: (file index, *block, old name, new name)
+    columns = [proposals["File"].map(custom_names.index)] + [proposals[col] for col in BLOCK_COLUMNS]
+    return tuple(zip(*columns, proposals["Name in file"], proposals["Matched name"]))
+
+
+def apply_renames(aligned, mapping):
+    # Returns the aligned frames with accepted names replaced; untouched files are not copied
+    aligned = list(aligned)
+    for f in sorted({rename[0] for rename in mapping}):
+        renames = pd.DataFrame(
+            [rename[1:] for rename in mapping if rename[0] == f],
+            columns=BLOCK_COLUMNS + ["spec_item_old_name", "renamed"],
+        )
+        df = aligned[f].copy()
+        renames = renames.astype({col: df[col].dtype for col in BLOCK_COLUMNS + ["spec_item_old_name"]})
+        renamed = df[BLOCK_COLUMNS + ["spec_item_old_name"]].merge(
+            renames, how="left", on=BLOCK_COLUMNS + ["spec_item_old_name"]
+        )["renamed"].to_numpy()
+        df["spec_item_old_name"] = df["spec_item_old_name"].where(pd.isna(renamed), renamed)
+        aligned[f] = df
+    return aligned
@@ -0,0 +1,384 @@
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import pandas as pd
+
+from comparison import (
+    REQUIRED_COLUMNS, ComparisonError, check_row_limit, check_duplicates, reorder_output_columns, unparsed_report
+)
+from cube import KEY_COLUMNS, LIMIT_COLUMNS, VALUE_TYPES, GROUP_COLUMNS, WORST_CASE
+from parsing import VALUE_PATTERN, SI_PREFIXES, BASE_UNITS, CSV_NULLS
+
+SQL_MEMORY_ENV = "CL_COMPARE_SQL_MEMORY"
+SQL_TEMP_DIR_ENV = "CL_COMPARE_SQL_TEMP_DIR"
+BATCH_ROWS = 50_000
+# Spec keys are numbered across files as file * FILE_STRIDE + row, so first appearance orders them
+FILE_STRIDE = 1 << 40
+
+
+def _ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+def _macros():
+    # SQL versions of parse_numeric and normalize_expansion. NaN is read as missing, like pandas.
+    pattern = _literal(VALUE_PATTERN.pattern)
+    scale = " ".join(
+        f"WHEN substr(unit, 1, 1) = {_literal(prefix)} THEN {factor!r}" for prefix, factor in SI_PREFIXES.items()
+    )
+    base_units = ", ".join(_literal(unit) for unit in BASE_UNITS)
+    return [
+        f"""CREATE OR REPLACE MACRO cl_unit_scale(unit) AS CASE
+            WHEN length(unit) > 1 AND substr(unit, 2) IN ({base_units}) THEN (CASE {scale} ELSE 1.0 END)
+            ELSE 1.0 END""",
+        f"""CREATE OR REPLACE MACRO cl_value(x) AS coalesce(
+            CASE WHEN NOT isnan(TRY_CAST(x AS DOUBLE)) THEN TRY_CAST(x AS DOUBLE) END,
+            CASE WHEN regexp_matches(x, '\\d') THEN
+                TRY_CAST(replace(replace(regexp_extract(trim(x), {pattern}, 1), ',', ''), '−', '-') AS DOUBLE)
+                * cl_unit_scale(regexp_extract(trim(x), {pattern}, 2))
+            END)""",
+        """CREATE OR REPLACE MACRO cl_expansion(x) AS CASE
+            WHEN x IS NULL OR trim(x) IN ('', 'nan') THEN ''
+            WHEN TRY_CAST(trim(x) AS DOUBLE) IS NULL THEN trim(x)
+            WHEN TRY_CAST(trim(x) AS DOUBLE) = round(TRY_CAST(trim(x) AS DOUBLE))
+                THEN CAST(CAST(TRY_CAST(trim(x) AS DOUBLE) AS HUGEINT) AS VARCHAR)
+            ELSE CAST(TRY_CAST(trim(x) AS DOUBLE) AS VARCHAR) END""",
+    ]
+
+
+def connect(database, memory_limit=None, temp_directory=None, threads=None):
+    # duckdb is only needed for this engine, so it is imported here
+    try:
+        import duckdb
+    except ImportError as e:
+        raise RuntimeError("duckdb is not installed; pip install duckdb or use the pandas engine") from e
+    con = duckdb.connect(database)
+    memory_limit = memory_limit or os.environ.get(SQL_MEMORY_ENV)
+    if memory_limit:
+        con.execute(f"SET memory_limit = {_literal(memory_limit)}")
+    if temp_directory:
+        con.execute(f"SET temp_directory = {_literal(temp_directory)}")
+    con.execute(f"SET threads = {int(threads or os.cpu_count() or 1)}")
+    con.execute("SET preserve_insertion_order = true")
+    for macro in _macros():
+        con.execute(macro)
+    return con
+
+
+class SQLComparison:
+    # The comparison as SQL in an embedded DuckDB database kept in a temporary directory, so
+    # inputs larger than memory spill to disk. Same keys, presence labels, ordering and
+    # Pass/Fail as join_files and build_merged_output; results stay in the database and are
+    # read back a page or a batch at a time.
+    #   sources  one path (.csv or .parquet) or bytes per file; the first supplies limits and base rows
+
+    def __init__(self, sources, custom_names, duplicate_policy="Keep first", max_rows=0,
+                 memory_limit=None, temp_directory=None, threads=None):
+        self.names = list(custom_names)
+        self.duplicate_policy = duplicate_policy
+        self.max_rows = max_rows
+        self.directory = tempfile.mkdtemp(prefix="cl-compare-", dir=temp_directory or os.environ.get(SQL_TEMP_DIR_ENV))
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        # One query at a time on the connection, its rows fetched before the next one runs
+        self._lock = threading.RLock()
+        self._results = {}
+        self.unparsed = unparsed_report([], self.names)
+        self.con = connect(os.path.join(self.directory, "comparison.duckdb"), memory_limit,
+                           os.path.join(self.directory, "spill"), threads)
+        self.columns = [self._load(i, source) for i, source in enumerate(sources)]
+
+    def close(self):
+        self.con.close()
+        self._cleanup()
+
+    def _sql(self, query, fetch=None):
+        # fetch names the method reading the rows ("fetchall", "fetchone", "df"), called under the lock
+        with self._lock:
+            result = self.con.execute(query)
+            return getattr(result, fetch)() if fetch else None
+
+    def _load(self, index, source):
+        # Raw copy of the file as table cl_raw_<index>; rowid keeps the file order
+        if isinstance(source, bytes):
+            suffix = ".parquet" if source[:4] == b"PAR1" else ".csv"
+            path = os.path.join(self.directory, f"input_{index}{suffix}")
+            with open(path, "wb") as f:
+                f.write(source)
+            source = path
+        if source.lower().endswith(".parquet"):
+            reader = f"read_parquet({_literal(source)})"
+        else:
+            # Header names as pandas reads them ("Unnamed: 6", "x.1"), every cell as text for now
+            names = pd.read_csv(source, nrows=0).columns.tolist()
+            reader = (
+                f"read_csv({_literal(source)}, header = true, all_varchar = true, "
+                f"names = [{', '.join(map(_literal, names))}], nullstr = [{', '.join(map(_literal, CSV_NULLS))}])"
+            )
+        self._sql(f"CREATE TABLE cl_raw_{index} AS SELECT * FROM {reader}")
+        columns = [row[0] for row in self._sql(f"DESCRIBE cl_raw_{index}", "fetchall")]
+        missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+        if missing:
+            raise ComparisonError(f'Missing column "{missing[0]}" in one of the files.')
+        return columns
+
+    def _column_types(self, index):
+        # Numeric text columns become BIGINT/DOUBLE the way read_csv would type them
+        columns = self.columns[index]
+        types = dict(self._sql(f"SELECT column_name, column_type FROM (DESCRIBE cl_raw_{index})", "fetchall"))
+        text = [col for col in columns if types[col] == "VARCHAR"]
+        if not text:
+            return types
+        checks = []
+        for col in text:
+            c = _ident(col)
+            checks.append(f"count({c}) = count(TRY_CAST({c} AS DOUBLE))")
+            checks.append(f"count({c}) = count(*) AND bool_and(regexp_full_match(trim({c}), '[+-]?\\d+'))")
+        flags = self._sql(f"SELECT {', '.join(checks)} FROM cl_raw_{index}", "fetchone")
+        for i, col in enumerate(text):
+            is_double, is_int = flags[2 * i], flags[2 * i + 1]
+            types[col] = "BIGINT" if is_int else "DOUBLE" if is_double else "VARCHAR"
+        return types
+
+    def run(self):
+        n_files = len(self.columns)
+        rows = [self._sql(f"SELECT count(*) FROM cl_raw_{i}", "fetchone")[0] for i in range(n_files)]
+        check_row_limit(sum(rows), self.max_rows)
+
+        types = [self._column_types(i) for i in range(n_files)]
+        # A key column is numeric only if it is numeric in every file, as the keys have to match,
+        # and integer only if it is integer in every file, as read_csv and the pandas merge keep it
+        key_types = {
+            col: "BIGINT" if all(t[col] == "BIGINT" for t in types)
+            else "DOUBLE" if all(t[col] in ("BIGINT", "DOUBLE") for t in types) else "VARCHAR"
+            for col in KEY_COLUMNS if col != "spec_id_expansion"
+        }
+        # The output rows keep the first file's own types, as prepare_base does; a numeric key is
+        # only widened to DOUBLE for the join
+        self.base_columns = [
+            (col, "VARCHAR" if col == "spec_id_expansion" or key_types.get(col) == "VARCHAR" else types[0][col])
+            for col in self.columns[0]
+        ]
+        for i in range(n_files):
+            self._sql(f"CREATE VIEW cl_file_{i} AS {self._file_query(i, key_types)}")
+
+        keys = ", ".join(map(_ident, KEY_COLUMNS))
+        duplicates = [
+            int(self._sql(
+                f"SELECT coalesce(sum(n - 1), 0) FROM (SELECT count(*) AS n FROM cl_file_{i} GROUP BY {keys} HAVING n > 1)",
+                "fetchone",
+            )[0])
+            for i in range(n_files)
+        ]
+        check_duplicates(duplicates, self.names, self.duplicate_policy)
+        self.duplicates = duplicates
+        self.unparsed = unparsed_report([self._unparsed(i, types[i]) for i in range(n_files)], self.names)
+        self._sql(f"CREATE TABLE cl_keys AS {self._keys_query()}")
+        return self
+
+    def _value_columns(self, index):
+        # align_file's [(column in the file, name)]: for the first file the limits from `limits` on,
+        # then the three CL columns from cm_summary on
+        columns = self.columns[index]
+        pairs = []
+        if index == 0:
+            limit_start = columns.index("limits")
+            pairs += zip(columns[limit_start: limit_start + 3], LIMIT_COLUMNS)
+        cl_start = columns.index("cm_summary")
+        return pairs + list(zip(columns[cl_start: cl_start + 3], VALUE_TYPES))
+
+    def _file_query(self, index, key_types):
+        # Normalized keys and parsed values of one file; r is the row in the file
+        keys = [
+            f"cl_expansion(CAST({_ident(col)} AS VARCHAR)) AS {_ident(col)}" if col == "spec_id_expansion"
+            else f"TRY_CAST({_ident(col)} AS {key_types[col]}) AS {_ident(col)}"
+            for col in KEY_COLUMNS
+        ]
+        values = [f"cl_value(CAST({_ident(col)} AS VARCHAR)) AS {name}" for col, name in self._value_columns(index)]
+        return f"SELECT {index} AS f, rowid AS r, {', '.join(keys + values)} FROM cl_raw_{index}"
+
+    def _unparsed(self, index, types):
+        # coerce_numeric's report of one file, {column: (count, first few originals)}: text cells
+        # holding a digit that cl_value leaves missing. Columns typed as numbers have none.
+        text = [(col, name) for col, name in self._value_columns(index) if types[col] == "VARCHAR"]
+        if not text:
+            return {}
+        unreadable = {
+            name: f"regexp_matches(trim({_ident(col)}), '\\d') AND cl_value({_ident(col)}) IS NULL" for col, name in text
+        }
+        counts = self._sql(
+            f"SELECT {', '.join(f'count(*) FILTER (WHERE {check})' for check in unreadable.values())} FROM cl_raw_{index}",
+            "fetchone",
+        )
+        unparsed = {}
+        for (col, name), count in zip(text, counts):
+            if count:
+                examples = self._sql(
+                    f"SELECT {_ident(col)} FROM cl_raw_{index} WHERE {unreadable[name]} ORDER BY rowid LIMIT 5", "fetchall"
+                )
+                unparsed[name] = (int(count), [row[0] for row in examples])
+        return unparsed
+
+    def _keys_query(self):
+        # One row per spec key: presence and CL values per file, limits from the first file,
+        # the first appearance and the position in the sorted comparison
+        keys = ", ".join(map(_ident, KEY_COLUMNS))
+        partition = f"PARTITION BY {keys}"
+        firsts = []
+        for i in range(len(self.names)):
+            value_columns = VALUE_TYPES + (LIMIT_COLUMNS if i == 0 else [])
+            if self.duplicate_policy == "Worst case":
+                # Lowest Minimum and highest Maximum over the repeats, the rest from the first row
+                value_columns = [f"min(Minimum) OVER ({partition}) AS Minimum", f"max(Maximum) OVER ({partition}) AS Maximum"] + [
+                    col for col in value_columns if col not in ("Minimum", "Maximum")
+                ]
+            firsts.append(
+                f"SELECT f, r, {keys}, {', '.join(value_columns)} FROM cl_file_{i} "
+                f"QUALIFY row_number() OVER ({partition} ORDER BY r) = 1"
+            )
+        per_file = []
+        for i, name in enumerate(self.names):
+            per_file.append(f"bool_or(f = {i}) AS present_{i}")
+            per_file += [
+                f"any_value({value_type}) FILTER (WHERE f = {i}) AS {_ident(f'{value_type}_{name}')}"
+                for value_type in VALUE_TYPES
+            ]
+        grouped = (
+            f"SELECT {keys}, min(f * {FILE_STRIDE} + r) AS seen, "
+            + ", ".join(f"any_value({limit}) FILTER (WHERE f = 0) AS {limit}" for limit in LIMIT_COLUMNS) + ", "
+            + ", ".join(per_file)
+            + f" FROM ({' UNION ALL BY NAME '.join(firsts)}) GROUP BY {keys}"
+        )
+        # Blank expansion first within each spec_number, then the numbered ones, as sort_order
+        return (
+            f"SELECT *, row_number() OVER (ORDER BY spec_number, spec_id_expansion <> '', spec_id_expansion, seen) - 1 AS position "
+            f"FROM ({grouped})"
+        )
+
+    def _result_columns(self, source):
+        # File Presence, Pass or Fail and Why Failed of every row of `source`, as in presence_labels and evaluate
+        n_files = len(self.names)
+        present = [f"present_{i}" for i in range(n_files)]
+        listed = ", ".join(f"CASE WHEN present_{i} THEN '{i + 1}' END" for i in range(n_files))
+        presence = (
+            f"CASE WHEN {' AND '.join(present)} THEN 'Found in all files' "
+            f"WHEN {' + '.join(f'{p}::INTEGER' for p in present)} = 1 THEN 'Only found in uploaded file ' || concat_ws('', {listed}) "
+            f"ELSE 'Found in files: ' || concat_ws(', ', {listed}) END"
+        )
+        checks = []
+        for name in self.names:
+            minimum, typical, maximum = (_ident(f"{value_type}_{name}") for value_type in VALUE_TYPES)
+            checks += [
+                (f"coalesce({minimum} < Minimum_Limits1, false)", f"Minimum_{name} < Minimum_Limits1"),
+                (f"coalesce({maximum} > Maximum_Limits1, false)", f"Maximum_{name} > Maximum_Limits1"),
+                (f"coalesce({typical} < Minimum_Limits1 AND {typical} > Maximum_Limits1, false)",
+                 f"Typical_{name} outside both limit bounds"),
+            ]
+        failed = " OR ".join(check for check, _ in checks)
+        why = ", ".join(f"CASE WHEN {check} THEN {_literal(reason)} END" for check, reason in checks)
+        return (
+            f"SELECT *, {presence} AS \"File Presence\", CASE WHEN {failed} THEN 'Fail' ELSE 'Pass' END AS \"Pass or Fail\", "
+            f"concat_ws(', ', {why}) AS \"Why Failed\" FROM ({source})"
+        )
+
+    def _worst_case_query(self):
+        # collapse_expansions: per spec_number/category/old name the lowest Minimum and highest
+        # Maximum per file; Typical and the limits from the group's first key in sorted order
+        group = ", ".join(map(_ident, GROUP_COLUMNS))
+        columns = [f"arg_min_null({limit}, position) AS {limit}" for limit in LIMIT_COLUMNS]
+        for i, name in enumerate(self.names):
+            minimum, typical, maximum = (_ident(f"{value_type}_{name}") for value_type in VALUE_TYPES)
+            columns += [
+                f"min({minimum}) AS {minimum}", f"arg_min_null({typical}, position) AS {typical}",
+                f"max({maximum}) AS {maximum}", f"bool_or(present_{i}) AS present_{i}",
+            ]
+        return f"SELECT {group}, min(position) AS position, {', '.join(columns)} FROM cl_keys GROUP BY {group}"
+
+    def _output_query(self, expansion_filter):
+        cl_columns = [_ident(f"{value_type}_{name}") for name in self.names for value_type in VALUE_TYPES]
+        results = ['"File Presence"'] + LIMIT_COLUMNS + cl_columns + ['"Pass or Fail"', '"Why Failed"']
+        if expansion_filter == WORST_CASE:
+            keyed = self._result_columns(self._worst_case_query())
+            select = [
+                "spec_number", f"{_literal(WORST_CASE)} AS spec_id_expansion", '"File Presence"',
+                "spec_item_category", "spec_item_old_name",
+            ] + LIMIT_COLUMNS + cl_columns + ['"Pass or Fail"', '"Why Failed"']
+            return f"SELECT {', '.join(select)} FROM ({keyed}) ORDER BY position"
+
+        # build_merged_output: every row of the first file, in file order, with its key's results
+        base = ", ".join(
+            f"CAST(b.{_ident(col)} AS {col_type}) AS {_ident(col)}" if col in KEY_COLUMNS
+            else f"TRY_CAST(raw.{_ident(col)} AS {col_type}) AS {_ident(col)}"
+            for col, col_type in self.base_columns
+        )
+        on = " AND ".join(f"b.{_ident(col)} IS NOT DISTINCT FROM k.{_ident(col)}" for col in KEY_COLUMNS)
+        where = ""
+        if expansion_filter != "All":
+            where = f"WHERE b.spec_id_expansion = {_literal('' if expansion_filter == 'Blank' else expansion_filter)} "
+        return (
+            f"SELECT {base}, {', '.join('k.' + col for col in results)} "
+            f"FROM cl_file_0 b JOIN cl_raw_0 raw ON raw.rowid = b.r "
+            f"JOIN ({self._result_columns('SELECT * FROM cl_keys')}) k ON {on} {where}ORDER BY b.r"
+        )
+
+    def result(self, expansion_filter="All"):
+        # Materialized once per filter as its own table; returns (table, columns in display order)
+        with self._lock:
+            if expansion_filter not in self._results:
+                table = f"cl_result_{len(self._results)}"
+                self._sql(f"CREATE TABLE {table} AS {self._output_query(expansion_filter)}")
+                columns = [row[0] for row in self._sql(f"DESCRIBE {table}", "fetchall")]
+                first_row = self._sql(f"SELECT * FROM {table} WHERE rowid = 0", "df")
+                if len(first_row):
+                    columns = reorder_output_columns(first_row, self.names, marker="compliance").columns.tolist()
+                self._results[expansion_filter] = (table, columns)
+            return self._results[expansion_filter]
+
+    def expansions(self):
+        return self._sql("SELECT DISTINCT spec_id_expansion FROM cl_keys ORDER BY 1", "df")["spec_id_expansion"]
+
+    def row_count(self, expansion_filter="All"):
+        table, _ = self.result(expansion_filter)
+        return self._sql(f"SELECT count(*) FROM {table}", "fetchone")[0]
+
+    def failed_count(self, expansion_filter="All"):
+        table, _ = self.result(expansion_filter)
+        return self._sql(f"SELECT count(*) FROM {table} WHERE \"Pass or Fail\" = 'Fail'", "fetchone")[0]
+
+    def _select(self, expansion_filter, where=""):
+        table, columns = self.result(expansion_filter)
+        return f"SELECT {', '.join(map(_ident, columns))} FROM {table} {where}ORDER BY rowid"
+
+    def page(self, expansion_filter="All", offset=0, limit=1000, fail_only=False):
+        if fail_only:
+            query = self._select(expansion_filter, "WHERE \"Pass or Fail\" = 'Fail' ")
+            return self._sql(f"{query} LIMIT {int(limit)} OFFSET {int(offset)}", "df")
+        where = f"WHERE rowid >= {int(offset)} AND rowid < {int(offset + limit)} "
+        return self._sql(self._select(expansion_filter, where), "df")
+
+    def batches(self, expansion_filter="All", rows=BATCH_ROWS):
+        # The result as DataFrames of about `rows` rows, fetched one after the other
+        start = 0
+        while True:
+            frame = self.page(expansion_filter, start, rows)
+            if frame.empty:
+                return
+            yield frame
+            start += rows
+
+    def column_widths(self, expansion_filter="All"):
+        # excel_export.column_widths computed in the database
+        table, columns = self.result(expansion_filter)
+        lengths = ", ".join(f"max(length(CAST({_ident(col)} AS VARCHAR)))" for col in columns)
+        longest = self._sql(f"SELECT {lengths} FROM {table}", "fetchone")
+        return [max(length or 0, len(str(col))) + 2 for length, col in zip(longest, columns)]
+
+    def write_parquet(self, path, expansion_filter="All"):
+        self._sql(f"COPY ({self._select(expansion_filter)}) TO {_literal(path)} (FORMAT parquet)")
+        return path
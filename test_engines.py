@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+
+from comparison import key_text
+from compare_cli import compare_files
+from partitioned import PartitionedComparison
+from sql_engine import SQLComparison
+
+HEADER = (
+    "spec_number,spec_id_expansion,spec_item_category,spec_item_old_name,parameter,"
+    "cm_summary,Unnamed: 6,Unnamed: 7,limits,Unnamed: 9,Unnamed: 10\n"
+)
+# spec_number is read as int64 in the first file and as object in the second, where a dotted
+# spec number follows; Maximum of spec 2 fails in the second file only
+FILE_A = HEADER + "1,,Gain,item 1,p,-1,0,1,-2,0,2\n2,,Gain,item 2,p,-1,0,1,-2,0,2\n"
+FILE_B = HEADER + "1,,Gain,item 1,p,-1,0,1,-2,0,2\n2,,Gain,item 2,p,-1,0,3,-2,0,2\n4.2.1,,Gain,item 3,p,-1,0,1,-2,0,2\n"
+NAMES = ["A", "B"]
+
+
+@pytest.fixture
+def mixed_files(tmp_path):
+    paths = []
+    for name, text in [("a.csv", FILE_A), ("b.csv", FILE_B)]:
+        path = tmp_path / name
+        path.write_text(text)
+        paths.append(str(path))
+    return paths
+
+
+def comparable(output):
+    # Key text, presence, Pass/Fail and CL values, in a row order every engine can be held to
+    values = [col for col in output.columns if col.startswith(("Minimum_", "Typical_", "Maximum_"))]
+    frame = pd.concat([key_text(output), output[["File Presence", "Pass or Fail"] + values].reset_index(drop=True)], axis=1)
+    return frame.sort_values(list(key_text(output).columns)).reset_index(drop=True)
+
+
+def engine_outputs(paths, expansion_filter):
+    outputs = {"pandas": compare_files(paths, NAMES, expansion_filter)[0]}
+    comparison = PartitionedComparison(paths, NAMES, partitions=2)
+    outputs["Partitioned"] = pd.concat(list(comparison.batches(expansion_filter)), ignore_index=True)
+    comparison.close()
+    outputs["Polars"] = compare_files(paths, NAMES, expansion_filter, engine="Polars")[0]
+    comparison = SQLComparison(paths, NAMES).run()
+    outputs["DuckDB"] = pd.concat(list(comparison.batches(expansion_filter)), ignore_index=True)
+    comparison.close()
+    return outputs
+
+
+@pytest.mark.parametrize("expansion_filter", ["All", "Worst case"])
+def test_mixed_key_dtypes_match_across_engines(mixed_files, expansion_filter):
+    outputs = engine_outputs(mixed_files, expansion_filter)
+    expected = comparable(outputs["pandas"])
+    # "All" lists the rows of the first file, the worst case also the key only the second file has
+    presence = ["Found in all files", "Found in all files"] + (["Only found in uploaded file 2"] if expansion_filter == "Worst case" else [])
+    assert expected["File Presence"].tolist() == presence
+    assert expected["Pass or Fail"].tolist()[:2] == ["Pass", "Fail"]
+    for engine, output in outputs.items():
+        pd.testing.assert_frame_equal(comparable(output), expected, check_dtype=False, obj=engine)
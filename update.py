@@ -1,254 +1,516 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from io import BytesIO
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font
-from openpyxl.utils import get_column_letter
-from openpyxl.cell.cell import Cell
 import matplotlib.pyplot as plt
 import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
+from functools import cache, partial
+from comparison import (
+    prepare_upload, join_files, build_merged_output, filter_expansion, filter_cube_expansion,
+    reorder_output_columns, attach_key_columns, delta_flags, untimed, ComparisonError, DUPLICATE_POLICIES,
+    expansion_options, worst_case_view, cube_output, unparsed_report, spec_number_index, spec_range_mask,
+    spec_prefix_mask, check_memory_budget, memory_budget_from_env, ENGINES
+)
+from reconcile import PROPOSAL_COLUMNS, DEFAULT_SIMILARITY, propose_renames, rename_mapping, apply_renames
+from cube import VALUE_TYPES, LOT_STAT_COLUMNS, OUTLIER_THRESHOLDS, WORST_CASE, lot_statistics, delta_columns
+from data_grid import render_data_grid, render_sql_grid
+from diagnostics import StageRecorder, configure_logging, peak_rss_bytes
+from excel_export import write_comparison_workbook, write_comparison_stream, write_changes_workbook
+from profiling import RunProfiler
+from uploads import submit_upload, forget_uploads, upload_key, upload_status, merge_upload_stages
+from jobs import submit_comparison, run_inline, render_job, merge_job_stages
+from golden import UPLOAD_OPTION, PinnedReference, pinned_references
+from limits import FILE_1_LIMITS, UPLOAD_LIMITS, NO_MATCH_WARNING, prepare_limits, apply_limits
+from history import ResultsStore, key_summary, run_changes
+from history_view import render_trend
+from plots import build_plot_frame, build_cl_figure, typical_deviation, typical_deviation_summary
+from sql_engine import SQLComparison
+from polars_engine import polars_comparison, key_options
+from partitioned import PartitionedComparison
 
 st.set_page_config(page_title="CL Comparison Tool", layout="centered")
 st.title("📊 CL Comparison Tool")
 
+show_diagnostics = st.sidebar.checkbox("Record pipeline diagnostics", value=False, help="Wall time, peak memory and row counts per stage. Tracing memory slows the run down.")
+recorder = StageRecorder(trace_memory=True) if show_diagnostics else None
+if recorder is not None:
+    configure_logging()
+engine = st.sidebar.selectbox(
+    "Comparison engine", ENGINES, index=0,
+    help="pandas compares in memory with every view. Polars runs the same comparison as a lazy query, usually faster on large files. DuckDB runs the comparison as SQL on disk, and Partitioned compares the files one spec_number range at a time, both for files larger than memory; they show the compared rows and the Excel export only."
+)
+duplicate_policy = st.sidebar.selectbox(
+    "Repeated spec keys", DUPLICATE_POLICIES, index=0,
+    help="Keep the first row of a repeated key, combine repeats into the worst case (lowest Minimum, highest Maximum), or refuse files that repeat keys."
+)
+reconcile_names = st.sidebar.checkbox(
+    "Reconcile renamed spec items", value=False, disabled=engine != "pandas",
+    help="Propose matches between spec_item_old_name values found in only one file, within the same spec_number, expansion and category."
+) and engine == "pandas"
+min_similarity = st.sidebar.slider("Name similarity", 0.3, 1.0, DEFAULT_SIMILARITY, 0.05, disabled=not reconcile_names)
+compact_values = st.sidebar.checkbox(
+    "Store CL values as float32", value=False, disabled=engine != "pandas",
+    help="Halves the memory the CL values take. Values keep 7 significant digits."
+) and engine == "pandas"
+
+
+@st.cache_data(show_spinner="Looking for renamed spec items...", max_entries=4)
+def rename_proposals(file_keys, custom_names, min_similarity, _aligned):
+    return propose_renames(_aligned, list(custom_names), min_similarity)
+
+
+def compute_comparison(file_keys, custom_names, duplicate_policy, renames, compact_values, _sources, _timer=untimed):
+    # file_keys identifies the uploads for the cache. _sources holds one callable per upload
+    # returning its prepare_upload() result, normally the finished background job.
+    prepared = [source() for source in _sources]
+    missing = [col for p in prepared for col in p["missing"]]
+    if missing:
+        return None, None, None, missing
+    unparsed = unparsed_report([p["unparsed"] for p in prepared], custom_names)
+    aligned = [p["aligned"] for p in prepared]
+    if renames:
+        with _timer("reconcile") as stage:
+            aligned = apply_renames(aligned, renames)
+            stage["rows"] = len(renames)
+    dtype = np.float32 if compact_values else np.float64
+    check_memory_budget(aligned, len(prepared[0]["base"]), dtype)
+    cube = join_files(aligned, list(custom_names), timer=_timer, duplicate_policy=duplicate_policy, dtype=dtype)
+    merged_output = build_merged_output(prepared[0]["base"], cube, timer=_timer)
+    return cube, merged_output, unparsed, []
+
+
+# Stages of each engine's run, for the progress bar of its background job
+COMPARISON_STAGES = ["duplicates", "outer_merge", "presence", "sort", "pass_fail", "base_merge"]
+POLARS_STAGES = ["polars", "base_merge"]
+
+
+def compute_polars_comparison(file_keys, custom_names, duplicate_policy, expansion_filter, categories, _uploaded_files,
+                              _timer=untimed):
+    # expansion_filter and categories are pushed into the scans, see polars_comparison
+    with _timer("polars") as stage:
+        cube, base_df, unparsed = polars_comparison(
+            [f.getvalue() for f in _uploaded_files], custom_names, duplicate_policy, expansion_filter, categories
+        )
+        stage["rows"] = cube.n_keys
+    merged_output = build_merged_output(base_df, cube, timer=_timer)
+    return cube, merged_output, unparsed_report(unparsed, custom_names), []
+
+
+@st.cache_data(show_spinner="Reading the expansions and categories...", max_entries=4)
+def polars_key_options(file_keys, _uploaded_files):
+    return key_options([f.getvalue() for f in _uploaded_files])
+
+
+@st.cache_resource(show_spinner="Comparing CL files with DuckDB...", max_entries=2)
+def sql_comparison(file_keys, custom_names, duplicate_policy, _uploaded_files):
+    # Kept across reruns as the database holds the result; the uploads are copied to its directory
+    return SQLComparison([f.getvalue() for f in _uploaded_files], list(custom_names), duplicate_policy).run()
+
+
+@st.cache_resource(show_spinner="Splitting the CL files by spec number...", max_entries=2)
+def partitioned_comparison(file_keys, custom_names, duplicate_policy, _uploaded_files):
+    # Kept across reruns as the partitions and their results stay in its temporary directory
+    return PartitionedComparison([f.getvalue() for f in _uploaded_files], list(custom_names), duplicate_policy)
+
+
+@st.cache_resource(show_spinner="Indexing the limits file...", max_entries=4)
+def uploaded_limits(limits_key, _uploaded_file):
+    return prepare_limits(_uploaded_file)
+
+
+@st.cache_data(show_spinner="Applying the limits...", max_entries=4)
+def limits_comparison(job_key, limits_key, _cube, _table):
+    # Only this step reruns for a new limits revision; the comparison job for the CL files is reused
+    cube, matched = apply_limits(_cube, _table)
+    return cube, build_merged_output(_table.base, cube), matched
+
+
+@st.cache_resource
+def results_store():
+    # The SQLite history at CL_COMPARE_HISTORY_DB, shared by every session
+    return ResultsStore()
+
+
+@st.cache_data(show_spinner="Reading the saved run...", max_entries=4)
+def stored_run_summary(path, run_id):
+    # A saved run never changes, so its summary is kept
+    return results_store().run_summary(run_id)
+
+
+@st.cache_data(show_spinner="Summarizing the comparison per spec...", max_entries=4)
+def comparison_summary(job_key, limits_key, _cube):
+    return key_summary(_cube)
+
+
+@st.cache_data(show_spinner="Collapsing expansions to the worst case...", max_entries=4)
+def worst_case_comparison(job_key, limits_key, _cube):
+    # Keyed by the comparison job and the limits; _cube is the cube they produced
+    view = worst_case_view(_cube)
+    return view, cube_output(view)
+
+if st.sidebar.checkbox("Show the trend of saved runs", value=False, help="Plot one spec or category across the comparisons saved to the history."):
+    render_trend(results_store())
+    st.header("Compare CL Files", divider=True)
+
 num_files = st.selectbox("Select number of files to compare", [2, 3, 4], index=0)
 
 uploaded_files = []
 custom_names = []
 
+references = pinned_references()
+limits_choice = st.selectbox(
+    "Limits and output rows from", [FILE_1_LIMITS, UPLOAD_LIMITS] + list(references), index=0,
+    help="A separate limits file (key columns and the three columns starting at limits) is indexed by spec key once and "
+         "checked against the CL files without comparing them again. Its rows become the rows of the output."
+) if engine in ["pandas", "Polars"] else FILE_1_LIMITS
+limits_source = None
+if limits_choice == UPLOAD_LIMITS:
+    limits_upload = st.file_uploader("Upload the limits .csv file", type="csv")
+    if limits_upload:
+        limits_key = ("upload",) + upload_key(limits_upload)
+        limits_source = uploaded_limits(limits_key, limits_upload)
+elif limits_choice != FILE_1_LIMITS:
+    pinned_limits = PinnedReference(limits_choice, references[limits_choice])
+    limits_key = ("pinned", pinned_limits.file_id)
+    limits_source = pinned_limits.limits()
+if limits_source is not None:
+    if limits_source["missing"]:
+        st.error(f'Missing column "{limits_source["missing"][0]}" in the limits file.')
+        st.stop()
+    limits_table = limits_source["table"]
+    st.caption(
+        f"🎯 {limits_source['rows']:,} limits rows, {len(limits_table.index):,} spec keys indexed"
+        + (f" · ⚠️ {limits_table.duplicates:,} rows repeat an earlier spec key; the first one's limits apply" if limits_table.duplicates else "")
+    )
+else:
+    limits_key = limits_table = None
+
 for i in range(num_files):
-    uploaded_file = st.file_uploader(f"Upload .csv file {i+1}", type="csv")
+    reference_choice = UPLOAD_OPTION
+    if i == 0 and references:
+        reference_choice = st.selectbox(
+            "File 1 (supplies the limits)" if limits_choice == FILE_1_LIMITS else "File 1", [UPLOAD_OPTION] + list(references),
+            help="Pinned reference files are kept on the server, parsed once and shared by every session."
+        )
+    if reference_choice != UPLOAD_OPTION:
+        uploaded_file = PinnedReference(reference_choice, references[reference_choice])
+    else:
+        uploaded_file = st.file_uploader(f"Upload .csv file {i+1}", type="csv")
     uploaded_files.append(uploaded_file)
-    
-    if uploaded_file:
+
+    if isinstance(uploaded_file, PinnedReference):
+        if engine == "pandas":
+            pinned = uploaded_file.prepared()
+            st.caption(f"📌 Pinned reference, {pinned['rows']:,} rows, already parsed and aligned")
+        else:
+            st.caption(f"📌 Pinned reference, {uploaded_file.size / 1024 / 1024:,.1f} MB, read by {engine} once all files are in")
+        custom_name = st.text_input(f"Enter a name for File {i+1}", value=f"File {i+1}")
+    elif uploaded_file and engine != "pandas":
+        st.caption(f"{uploaded_file.size / 1024 / 1024:,.1f} MB, read by {engine} once all files are in")
+        custom_name = st.text_input(f"Enter a name for File {i+1}", value=f"File {i+1}")
+    elif uploaded_file:
+        # Parsing and alignment start now, while the remaining files are still being chosen
+        st.caption(upload_status(submit_upload(i, uploaded_file)))
         custom_name = st.text_input(f"Enter a name for File {i+1}", value=f"File {i+1}")
     else:
         custom_name = f"File {i+1}"
     custom_names.append(custom_name)
+forget_uploads([i for i, f in enumerate(uploaded_files) if f and engine == "pandas" and not isinstance(f, PinnedReference)])
+
+repeated_names = sorted({name for name in custom_names if custom_names.count(name) > 1})
+if all(uploaded_files) and repeated_names:
+    # Every file's columns, plot lines and history lots are told apart by its name
+    st.error(f'Give each file its own name; {", ".join(repeated_names)} is used more than once.')
+    st.stop()
+
+if all(uploaded_files) and limits_choice == UPLOAD_LIMITS and limits_table is None:
+    st.info("Upload the limits file to compare the CL files against it.")
+    st.stop()
+
+if all(uploaded_files) and engine in ["DuckDB", "Partitioned"]:
+    file_keys = tuple(upload_key(f) for f in uploaded_files)
+    try:
+        comparison = (sql_comparison if engine == "DuckDB" else partitioned_comparison)(
+            file_keys, tuple(custom_names), duplicate_policy, uploaded_files
+        )
+    except (ComparisonError, RuntimeError) as error:
+        st.error(str(error))
+        st.stop()
 
-if all(uploaded_files):
-    dataframes = [pd.read_csv(file) for file in uploaded_files]
-    base_df = dataframes[0].copy()
-    base_df["spec_id_expansion"] = base_df["spec_id_expansion"].astype(str).str.strip().replace("nan", "")
-    required_cols = ["spec_number", "cm_summary", "limits", "spec_item_category", "spec_item_old_name"]
-    for df in dataframes:
-        for col in required_cols:
-            if col not in df.columns:
-                st.error(f'Missing column "{col}" in one of the files.')
-                st.stop()
-
-    combined_columns = []
-    for i, df in enumerate(dataframes):
-        idx_cm_summary = df.columns.tolist().index("cm_summary")
-        idx_limits = df.columns.tolist().index("limits")
-
-        cl_columns = df.columns[idx_cm_summary: idx_cm_summary + 3].tolist()
-
-        if i == 0:
-            limit_columns = df.columns[idx_limits: idx_limits + 3].tolist()
-            limit_data = df[limit_columns]
-            limit_data.columns = ["Minimum_Limits1", "Typical_Limits1", "Maximum_Limits1"]
-            columns = pd.concat([df[["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"]], limit_data, df[cl_columns]], axis=1)
-            columns.columns = [
-                "spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name",
-                "Minimum_Limits1", "Typical_Limits1", "Maximum_Limits1",
-                f"Minimum_{custom_names[i]}", f"Typical_{custom_names[i]}", f"Maximum_{custom_names[i]}"
-            ]
-        else:
-            columns = df[["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"] + cl_columns]
-            columns.columns = ["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name",
-                               f"Minimum_{custom_names[i]}", f"Typical_{custom_names[i]}", f"Maximum_{custom_names[i]}"]
-
-        combined_columns.append(columns)
-
-    df_combined = combined_columns[0]
-    for df in combined_columns[1:]:
-        df_combined = pd.merge(df_combined, df, on=["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"], how="outer")
-
-    for col in df_combined.columns:
-        if any(prefix in col for prefix in ["Minimum_", "Typical_", "Maximum_"]):
-            df_combined[col] = pd.to_numeric(df_combined[col], errors='coerce')
-
-    limits_columns = ["Minimum_Limits1", "Typical_Limits1", "Maximum_Limits1"]
-    cl_columns = [col for name in custom_names for col in df_combined.columns if any(prefix in col for prefix in [f"Minimum_{name}", f"Maximum_{name}"])]
-    st.write("CL Columns Used in Plot", cl_columns)
-    df_combined = df_combined[["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"] + limits_columns + cl_columns]
-
-    file_keys_list = [set(zip(df["spec_number"], df["spec_id_expansion"], df["spec_item_category"], df["spec_item_old_name"])) for df in combined_columns]
-
-    def check_file_presence(row):
-        key = (row["spec_number"], row["spec_id_expansion"], row["spec_item_category"], row["spec_item_old_name"])
-        found_in_files = [str(i + 1) for i, file_keys in enumerate(file_keys_list) if key in file_keys]
-        if len(found_in_files) == num_files:
-            return "Found in all files"
-        elif len(found_in_files) == 1:
-            return f"Only found in uploaded file {found_in_files[0]}"
-        else:
-            return f"Found in files: {', '.join(found_in_files)}"
-
-    df_combined["File Presence"] = df_combined.apply(check_file_presence, axis=1)
-    df_combined["spec_id_expansion"] = df_combined["spec_id_expansion"].astype(str).str.strip().replace("nan", "")
-    df_combined["spec_id_expansion_sort"] = df_combined["spec_id_expansion"].fillna("").apply(lambda x: (0, "") if x == "" else (1, x))
-    df_combined = df_combined.sort_values(by=["spec_number", "spec_id_expansion_sort"]).drop(columns=["spec_id_expansion_sort"])
-    def clean_spec_id(val):
-        try:
-            f = float(val)
-            if f.is_integer():
-                return str(int(f))
-            else:
-                return str(f)
-        except:
-            return "" if pd.isna(val) or str(val).strip().lower() == "nan" else str(val).strip()
-
-    df_combined["spec_id_expansion"] = df_combined["spec_id_expansion"].apply(clean_spec_id)
-    base_df["spec_id_expansion"] = base_df["spec_id_expansion"].apply(clean_spec_id)
-
-    result_columns = ["spec_number", "spec_id_expansion", "File Presence", "spec_item_category", "spec_item_old_name"] + limits_columns + cl_columns
-    df_combined["Pass or Fail"] = None
-    df_combined["Why Failed"] = None
-    result_columns += ["Pass or Fail", "Why Failed"]
     st.header("Select Spec ID Expansion to Filter CLs", divider=True)
     expansion_filter = st.radio(
         "Choose which spec_id_expansion to include for CL comparison:",
-        options=["All", "Blank", "1", "2"],
+        options=expansion_options(comparison.expansions()),
         index=0,
-        horizontal=True
+        horizontal=True,
+        help="Worst case collapses the expansions of each spec into one row: lowest Minimum and highest Maximum per file, checked against the blank expansion's limits."
+    )
+    try:
+        with st.spinner("Comparing CL files..."):
+            comparison.result(expansion_filter)
+    except ComparisonError as error:
+        st.error(str(error))
+        st.stop()
+    if len(comparison.unparsed):
+        st.warning(
+            f"{comparison.unparsed['Unparseable cells'].sum():,} CL or limit cells look numeric but could not be read. "
+            "They are treated as missing, so their Pass/Fail checks are skipped."
+        )
+    st.header("Compared Rows", divider=True)
+    st.caption("Statistics, delta mode, name reconciliation and the graph need the pandas engine.")
+    render_sql_grid(comparison, expansion_filter, key="sql_output")
+
+    export_key = (engine, file_keys, tuple(custom_names), duplicate_policy, expansion_filter)
+    if st.button("Prepare Excel export"):
+        with st.spinner("Writing the Excel file..."):
+            _, columns = comparison.result(expansion_filter)
+            st.session_state["sql_export"] = (export_key, write_comparison_stream(
+                comparison.batches(expansion_filter), columns, comparison.column_widths(expansion_filter), custom_names
+            ))
+    export = st.session_state.get("sql_export")
+    if export is not None and export[0] == export_key:
+        st.download_button(
+            label="Download Excel (Grouped with Original Columns)",
+            data=export[1],
+            file_name=export[1].name,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+    st.stop()
+
+if all(uploaded_files):
+    file_keys = tuple(upload_key(f) for f in uploaded_files)
+    categories = None
+    if engine == "Polars":
+        # Chosen before the run, so the Polars scans skip the rows of other expansions and categories
+        try:
+            expansions, category_options = polars_key_options(file_keys, uploaded_files)
+        except RuntimeError as error:
+            st.error(str(error))
+            st.stop()
+        st.header("Select Spec ID Expansion to Filter CLs", divider=True)
+        expansion_filter = st.radio(
+            "Choose which spec_id_expansion to include for CL comparison:",
+            options=expansion_options(expansions),
+            index=0,
+            horizontal=True,
+            help="Worst case collapses the expansions of each spec into one row: lowest Minimum and highest Maximum per file, checked against the blank expansion's limits."
+        )
+        # Limits rows of other categories would read as missing from every file
+        selected_categories = st.sidebar.multiselect(
+            "Only compare these spec item categories", category_options, disabled=limits_table is not None,
+            help="Empty compares every category. Not available with a separate limits file."
+        )
+        if selected_categories and limits_table is None:
+            categories = tuple(selected_categories)
+    # CL_COMPARE_PROFILE=cprofile|pyinstrument profiles the first run for each set of inputs
+    # (see profiling.py); reruns reuse its result like a finished background job
+    profiled_inputs = st.session_state.setdefault("profiled_inputs", set())
+    profile_key = (engine, file_keys, tuple(custom_names), duplicate_policy, compact_values) + (
+        (expansion_filter, categories) if engine == "Polars" else ()
+    )
+    try:
+        run_profiler = None if profile_key in profiled_inputs else RunProfiler.from_env(name="cl_comparison")
+        if run_profiler is not None:
+            run_profiler.start()
+    except (ValueError, RuntimeError, OSError) as error:
+        st.error(str(error))
+        st.stop()
+    if run_profiler is not None:
+        profiled_inputs.add(profile_key)
+    if engine == "Polars":
+        sources = []
+    elif run_profiler is not None:
+        # Prepared inline so the trace covers parsing too, and only once for reconcile and the comparison
+        sources = [
+            f.prepared if isinstance(f, PinnedReference) else cache(partial(prepare_upload, f, i, recorder or untimed))
+            for i, f in enumerate(uploaded_files)
+        ]
+    else:
+        sources = [
+            f.prepared if isinstance(f, PinnedReference) else submit_upload(i, f).result
+            for i, f in enumerate(uploaded_files)
+        ]
+    renames = ()
+    if reconcile_names:
+        prepared = [source() for source in sources]
+        if not any(p["missing"] for p in prepared):
+            proposals = rename_proposals(file_keys, tuple(custom_names), min_similarity, [p["aligned"] for p in prepared])
+            st.header("Renamed Spec Items", divider=True)
+            if proposals.empty:
+                st.caption("No likely renames between files at this similarity.")
+            else:
+                st.caption("Accepted matches are compared as the same spec item, under the first file's name.")
+                edited = st.data_editor(
+                    proposals.assign(Accept=True), disabled=PROPOSAL_COLUMNS, hide_index=True,
+                    key=f"renames_{abs(hash((file_keys, tuple(custom_names), min_similarity)))}"
+                )
+                renames = rename_mapping(edited[edited["Accept"]], custom_names)
+
+    if engine == "Polars":
+        compute, stages, args = compute_polars_comparison, POLARS_STAGES, (
+            file_keys, tuple(custom_names), duplicate_policy, expansion_filter, categories, uploaded_files
+        )
+    else:
+        compute, stages, args = compute_comparison, (["reconcile"] if renames else []) + COMPARISON_STAGES, (
+            file_keys, tuple(custom_names), duplicate_policy, renames, compact_values, sources
+        )
+    try:
+        if run_profiler is not None:
+            job = run_inline((engine,) + args[:-1], stages, compute, *args)
+        else:
+            # In the background, so the page stays usable; the same inputs reuse the finished job
+            job = submit_comparison((engine,) + args[:-1], stages, compute, *args)
+            if not job.ready():
+                render_job(job)
+                st.stop()
+        cube, merged_output, unparsed, missing = job.future.result()
+    except (ComparisonError, RuntimeError) as error:
+        if run_profiler is not None:
+            run_profiler.stop()
+        st.error(str(error))
+        st.stop()
+    if recorder is not None:
+        merge_job_stages(recorder, job)
+        if not recorder.cache_hit and run_profiler is None:
+            # A profiled run prepared its uploads inline, straight into the recorder
+            merge_upload_stages(recorder, [source() for source in sources])
+    for col in missing:
+        if run_profiler is not None:
+            run_profiler.stop()
+        st.error(f'Missing column "{col}" in one of the files.')
+        st.stop()
+    if limits_table is not None:
+        cube, merged_output, matched = limits_comparison((engine,) + args[:-1], limits_key, cube, limits_table)
+        if not matched:
+            st.warning(NO_MATCH_WARNING)
+        unparsed = pd.concat([unparsed, unparsed_report([limits_table.unparsed], ["Limits"])], ignore_index=True)
+    # Every key and expansion, for the history, before the views below narrow the cube down
+    full_cube = cube
+
+    if len(unparsed):
+        st.warning(
+            f"{unparsed['Unparseable cells'].sum():,} CL or limit cells look numeric but could not be read. "
+            "They are treated as missing, so their Pass/Fail checks are skipped."
+        )
+        with st.expander("Unparseable cells per file and column"):
+            st.dataframe(unparsed, hide_index=True)
+
+    st.write("CL Columns Used in Plot", cube.cl_columns())
+
+    if engine != "Polars":
+        st.header("Select Spec ID Expansion to Filter CLs", divider=True)
+        expansion_filter = st.radio(
+            "Choose which spec_id_expansion to include for CL comparison:",
+            options=expansion_options(cube.keys["spec_id_expansion"]),
+            index=0,
+            horizontal=True,
+            help="Worst case collapses the expansions of each spec into one row: lowest Minimum and highest Maximum per file, checked against the blank expansion's limits."
+        )
+    if expansion_filter == WORST_CASE:
+        # The collapsed view stands in for the per-expansion rows in the grid, graph and export
+        cube, merged_output = worst_case_comparison((engine,) + args[:-1], limits_key, cube)
+
+    st.header("Cross-lot Statistics", divider=True)
+    stat_controls = st.columns(3)
+    lot_value_type = stat_controls[0].selectbox("Value compared across files", VALUE_TYPES, index=1)
+    outlier_method = stat_controls[1].radio("Flag outlier lots by", list(OUTLIER_THRESHOLDS), horizontal=True)
+    outlier_threshold = stat_controls[2].number_input(
+        "Outlier threshold", min_value=0.5, value=OUTLIER_THRESHOLDS[outlier_method], step=0.5,
+        key=f"outlier_threshold_{outlier_method}"
     )
-    results_only_df = df_combined[result_columns]
-    merged_output = pd.merge(
-        base_df,
-        results_only_df,
-        on=["spec_number", "spec_id_expansion", "spec_item_category", "spec_item_old_name"],
-        how="left"
+    # Computed on the full cube so the columns can be attached to every row of merged_output
+    with (recorder or untimed)("lot_stats") as stage:
+        lot_stats, _ = lot_statistics(cube, lot_value_type, outlier_method, outlier_threshold)
+        cube = cube.with_columns(lot_stats)
+        merged_output = attach_key_columns(merged_output, cube, lot_stats)
+        stage["rows"] = cube.n_keys
+
+    st.header("Delta Mode", divider=True)
+    delta_mode = st.checkbox("Report each file as the change from a reference file", value=False)
+    delta_thresholds = None
+    if delta_mode:
+        delta_controls = st.columns(3)
+        reference_name = delta_controls[0].selectbox("Reference file", custom_names)
+        abs_threshold = delta_controls[1].number_input("Highlight |change| above (0 = off)", min_value=0.0, value=0.0, step=0.1)
+        pct_threshold = delta_controls[2].number_input("Highlight |change| % above (0 = off)", min_value=0.0, value=10.0, step=1.0)
+        delta_thresholds = (abs_threshold, pct_threshold)
+        with (recorder or untimed)("delta") as stage:
+            merged_output = attach_key_columns(merged_output, cube, delta_columns(cube, reference_name))
+            stage["rows"] = cube.n_keys
+
+    merged_output = filter_expansion(merged_output, expansion_filter)
+    cube = filter_cube_expansion(cube, expansion_filter)
+    merged_output = reorder_output_columns(merged_output, custom_names, marker="compliance")
+    view_token = (
+        file_keys, tuple(custom_names), duplicate_policy, renames, compact_values, limits_key, expansion_filter, lot_value_type,
+        outlier_method, outlier_threshold, delta_mode and reference_name, categories
+    )
+
+    st.caption(f"{lot_value_type} values across all files per spec. Cpk is against Minimum_Limits1/Maximum_Limits1 and needs at least two files with a value.")
+    render_data_grid(cube.to_frame(extra_columns=["Pass or Fail"] + LOT_STAT_COLUMNS, values=False), key="lot_stats", token=view_token)
+
+    st.write("You can review your data below. Pass/Fail is colour-coded in the Excel download" + ("; changes beyond the delta thresholds are highlighted." if delta_mode else "."))
+    render_data_grid(
+        merged_output, key="merged_output", token=view_token,
+        highlight=(lambda page: delta_flags(page, custom_names, *delta_thresholds)) if delta_mode else None
     )
-    if expansion_filter == "Blank":
-        merged_output = merged_output[merged_output["spec_id_expansion"] == ""]
-        df_combined = df_combined[df_combined["spec_id_expansion"] == ""]
-    elif expansion_filter in ["1", "2"]:
-        merged_output = merged_output[merged_output["spec_id_expansion"] == expansion_filter]
-        df_combined = df_combined[df_combined["spec_id_expansion"] == expansion_filter]
-
-    columns_to_move = [col for col in [
-        "File Presence", "Minimum_Limits1", "Typical_Limits1", "Maximum_Limits1"
-    ] if col in merged_output.columns]
-
-    for name in custom_names:
-        for col in [f"Minimum_{name}", f"Typical_{name}", f"Maximum_{name}"]:
-            if col in merged_output.columns:
-                columns_to_move.append(col)
-
-    for col in ["Pass or Fail", "Why Failed"]:
-        if col in merged_output.columns:
-            columns_to_move.append(col)
-
-    second_row = merged_output.iloc[0] if len(merged_output) > 0 else None
-    compliance_column_name = None
-    if second_row is not None:
-        for col in merged_output.columns:
-            if str(second_row[col]).strip().lower() == "compliance":
-                compliance_column_name = col
-                break
-
-    if compliance_column_name:
-        col_list = merged_output.columns.tolist()
-        idx = col_list.index(compliance_column_name) + 1
-
-        for col in columns_to_move:
-            if col in col_list:
-                col_list.remove(col)
-
-        reordered_cols = col_list[:idx] + columns_to_move + col_list[idx:]
-        merged_output = merged_output[reordered_cols]
-
-    st.write("You can review your data below. Pass/Fail will be calculated in Excel.")
-    st.dataframe(merged_output)
     st.header("Choose way of grouping to graph (Default is Spec Item Category)", divider=True)
     group_by_old_name = st.checkbox("Group by Spec Item Old Name", value=False)
 
+    # The graph selection works on the cube's key table; values are gathered once at the end
+    keys = cube.keys
     if group_by_old_name:
-        unique_spec_item_names = df_combined["spec_item_old_name"].drop_duplicates().tolist()
+        unique_spec_item_names = keys["spec_item_old_name"].drop_duplicates().tolist()
         selected_spec_item_name = st.selectbox("Select Spec Item Old Name", unique_spec_item_names)
-        filtered_data = df_combined[df_combined["spec_item_old_name"] == selected_spec_item_name]
+        mask = (keys["spec_item_old_name"] == selected_spec_item_name).to_numpy()
     else:
-        unique_spec_item_categorys = df_combined["spec_item_category"].drop_duplicates().tolist()
+        unique_spec_item_categorys = keys["spec_item_category"].drop_duplicates().tolist()
         selected_spec_item_category = st.selectbox("Select Spec Item Category", unique_spec_item_categorys)
-        filtered_data = df_combined[df_combined["spec_item_category"] == selected_spec_item_category]
-
-    unique_spec_numbers = filtered_data["spec_number"].dropna().unique()
-    unique_spec_numbers.sort()
-    selected_spec_numbers = st.multiselect("Filter by Spec Number(s)", unique_spec_numbers, default=unique_spec_numbers)
-    filtered_data = filtered_data[filtered_data["spec_number"].isin(selected_spec_numbers)]
+        mask = (keys["spec_item_category"] == selected_spec_item_category).to_numpy()
+
+    # Spec numbers in natural order ("1.9" before "1.10"); only the bounds go to the browser
+    spec_labels, _, spec_ranks = spec_index = spec_number_index(keys["spec_number"])
+    in_group = np.unique(spec_ranks[mask & (spec_ranks >= 0)])
+    spec_filter = st.radio("Filter by Spec Number", ["Range", "Prefix"], horizontal=True)
+    if spec_filter == "Range":
+        range_inputs = st.columns(2)
+        first_spec = range_inputs[0].text_input("From spec number", value=spec_labels[in_group[0]] if len(in_group) else "")
+        last_spec = range_inputs[1].text_input("To spec number", value=spec_labels[in_group[-1]] if len(in_group) else "")
+        mask &= spec_range_mask(spec_index, first_spec, last_spec)
+    else:
+        spec_prefix = st.text_input("Spec number prefix", value="", help='"1.1" matches 1.1 and 1.1.x but not 1.10')
+        mask &= spec_prefix_mask(spec_index, spec_prefix)
+    filtered_cube = cube.take(np.flatnonzero(mask))
 
     st.header("Check boxes to Show/Hide Limits", divider=True)
     show_min_limit = st.checkbox("Show Minimum Limit", value=True)
+    show_typ_limit = st.checkbox("Show Typical Limit", value=True)
     show_max_limit = st.checkbox("Show Maximum Limit", value=True)
+    show_typ_values = st.checkbox("Show Typical CL Values", value=True)
 
-    if not filtered_data.empty:
-        # Keep only Minimum and Maximum CL values from all uploaded files
-        cl_columns = [col for name in custom_names for col in filtered_data.columns
-                    if any(prefix in col for prefix in [f"Minimum_{name}", f"Maximum_{name}"])]
-        
-        cl_data = filtered_data[["spec_number", "spec_item_category", "spec_item_old_name"] + cl_columns]
-        cl_data_melted = cl_data.melt(
-            id_vars=["spec_number", "spec_item_category", "spec_item_old_name"],
-            var_name="CL Type", value_name="Value"
-        )
+    if filtered_cube.n_keys:
+        value_types = ["Minimum", "Typical", "Maximum"] if show_typ_values else ["Minimum", "Maximum"]
+        with (recorder or untimed)("plot_build") as stage:
+            cl_data_melted = build_plot_frame(filtered_cube, value_types)
+            stage["rows"] = len(cl_data_melted)
 
-        # Extract file name and value type from column names like "Minimum_CL1"
-        cl_data_melted["File"] = cl_data_melted["CL Type"].apply(
-            lambda x: next((name for name in custom_names if name in x), "Unknown")
-        )
-        cl_data_melted["Value Type"] = cl_data_melted["CL Type"].apply(
-            lambda x: "Minimum" if "Minimum_" in x else "Maximum"
-        )
-
-                # Check if there's any data to plot
-        if cl_data_melted["Value"].dropna().empty and not (show_min_limit or show_max_limit):
+        # Check if there's any data to plot
+        if cl_data_melted["Value"].dropna().empty and not (show_min_limit or show_typ_limit or show_max_limit):
             st.warning("No data available to plot. Please check your filters or enable at least one Limit to show.")
         else:
-            # Base interactive line plot
-            fig = px.line(
+            fig = build_cl_figure(
                 cl_data_melted,
-                x="spec_number",
-                y="Value",
-                color="File",
-                line_dash="Value Type",
-                markers=True,
-                hover_data=["spec_number", "Value", "File", "Value Type"],
-                title=f"CL Comparison for {'Spec Item Old Name ' + selected_spec_item_name if group_by_old_name else 'Spec Item Category ' + selected_spec_item_category}"
-            )
-
-            # Add limit lines if selected
-            if show_min_limit and "Minimum_Limits1" in filtered_data.columns:
-                fig.add_trace(go.Scatter(
-                    x=filtered_data["spec_number"],
-                    y=filtered_data["Minimum_Limits1"],
-                    mode='lines+markers',
-                    name='Minimum Limit',
-                    line=dict(color='purple', dash='dash')
-                ))
-
-            if show_max_limit and "Maximum_Limits1" in filtered_data.columns:
-                fig.add_trace(go.Scatter(
-                    x=filtered_data["spec_number"],
-                    y=filtered_data["Maximum_Limits1"],
-                    mode='lines+markers',
-                    name='Maximum Limit',
-                    line=dict(color='brown', dash='dash')
-                ))
-
-            fig.update_layout(
-                xaxis_title="Spec Number",
-                yaxis_title="CL Value",
-                legend_title="File / Value Type",
-                xaxis_tickangle=45,
-                height=600
+                filtered_cube,
+                title=f"CL Comparison for {'Spec Item Old Name ' + selected_spec_item_name if group_by_old_name else 'Spec Item Category ' + selected_spec_item_category}",
+                show_limits={"Minimum": show_min_limit, "Typical": show_typ_limit, "Maximum": show_max_limit}
             )
 
             st.plotly_chart(fig, use_container_width=True)
 
+            if show_typ_values:
+                st.write("Deviation from Typical Limit")
+                st.dataframe(typical_deviation_summary(typical_deviation(filtered_cube), custom_names))
+
             # Save graph to download
             img_buffer = BytesIO()
             plt.savefig(img_buffer, format='png', bbox_inches='tight')
@@ -260,129 +522,69 @@ if all(uploaded_files):
                 mime="image/png"
             )
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Comparison"
-    ws.freeze_panes = "A2"
-    ws.append(merged_output.columns.tolist())
-    green_fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-    red_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-    green_font = Font(color="006100")
-    red_font = Font(color="9C0006")
-
-    for row_idx, row in merged_output.iterrows():
-        ws.append(row.tolist())
-        current_row = ws.max_row
-        failures = []
-
-        for i in range(1, num_files + 1):
-            name = custom_names[i - 1]
-            min_limit_val = row.get("Minimum_Limits1")
-            max_limit_val = row.get("Maximum_Limits1")
-            min_cl_val = row.get(f"Minimum_{name}")
-            max_cl_val = row.get(f"Maximum_{name}")
-            typ_col_name = f"Typical_{name}"
-            typ_cl_val = row.get(typ_col_name) if typ_col_name in row else None
-
-            failed_min = False
-            failed_max = False
-
-            if min_limit_val is not None:
-                if min_cl_val is not None and min_cl_val < min_limit_val:
-                    failures.append(f"Minimum_{name} < Minimum_Limits1")
-                if typ_cl_val is not None and typ_cl_val < min_limit_val:
-                    failed_min = True
-
-            if max_limit_val is not None:
-                if max_cl_val is not None and max_cl_val > max_limit_val:
-                    failures.append(f"Maximum_{name} > Maximum_Limits1")
-                if typ_cl_val is not None and typ_cl_val > max_limit_val:
-                    failed_max = True
-
-            if typ_cl_val is not None and failed_min and failed_max:
-                failures.append(f"Typical_{name} outside both limit bounds")
-
-        # Write pass/fail result
-        pass_col = merged_output.columns.get_loc("Pass or Fail") + 1
-        why_col = merged_output.columns.get_loc("Why Failed") + 1
-        pass_val = "Pass" if not failures else "Fail"
-        ws.cell(row=current_row, column=pass_col).value = pass_val
-        ws.cell(row=current_row, column=why_col).value = ", ".join(failures)
-        pass_cell = ws.cell(row=current_row, column=pass_col)
-
-        if pass_val == "Pass":
-            pass_cell.fill = green_fill
-            pass_cell.font = green_font
-        else:
-            pass_cell.fill = red_fill
-            pass_cell.font = red_font
-
-        # Apply formatting for CL values
-        for i in range(1, num_files + 1):
-            name = custom_names[i - 1]
-            min_col = merged_output.columns.get_loc(f"Minimum_{name}") + 1 if f"Minimum_{name}" in merged_output.columns else None
-            max_col = merged_output.columns.get_loc(f"Maximum_{name}") + 1 if f"Maximum_{name}" in merged_output.columns else None
-            typ_col = merged_output.columns.get_loc(f"Typical_{name}") + 1 if f"Typical_{name}" in merged_output.columns else None
-
-            if min_col is not None:
-                cl_val = row.get(f"Minimum_{name}")
-                cell = ws.cell(row=current_row, column=min_col)
-                if pd.notna(cl_val) and pd.notna(min_limit_val):
-                    if cl_val >= min_limit_val:
-                        cell.fill = green_fill
-                        cell.font = green_font
-                    else:
-                        cell.fill = red_fill
-                        cell.font = red_font
-                elif pd.notna(cl_val):
-                    cell.fill = green_fill
-                    cell.font = green_font
-
-            if max_col is not None:
-                cl_val = row.get(f"Maximum_{name}")
-                cell = ws.cell(row=current_row, column=max_col)
-                if pd.notna(cl_val) and pd.notna(max_limit_val):
-                    if cl_val <= max_limit_val:
-                        cell.fill = green_fill
-                        cell.font = green_font
-                    else:
-                        cell.fill = red_fill
-                        cell.font = red_font
-                elif pd.notna(cl_val):
-                    cell.fill = green_fill
-                    cell.font = green_font
-
-            # Safe formatting for Typical column
-            if typ_col is not None:
-                typ_val = row.get(f"Typical_{name}")
-                typ_cell = ws.cell(row=current_row, column=typ_col)
-                fail_min = min_limit_val is not None and typ_val is not None and typ_val < min_limit_val
-                fail_max = max_limit_val is not None and typ_val is not None and typ_val > max_limit_val
-
-                if typ_val is not None:
-                    if fail_min and fail_max:
-                        typ_cell.fill = red_fill
-                        typ_cell.font = red_font
-                    else:
-                        typ_cell.fill = green_fill
-                        typ_cell.font = green_font
-
-    for col in ws.columns:
-        max_length = 0
-        column_letter = get_column_letter(col[0].column)
-        for cell in col:
-            if isinstance(cell, Cell) and cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        ws.column_dimensions[column_letter].width = max_length + 2
-
-    final_output = BytesIO()
-    wb.save(final_output)
-    final_output.seek(0)
-    final_output.name = "comparison_grouped.xlsx"
+    st.header("Comparison History", divider=True)
+    store = results_store()
+    saved_runs = st.session_state.setdefault("saved_runs", {})
+    run_key = ((engine,) + args[:-1], limits_key)
+    if run_key in saved_runs:
+        st.caption(f"✅ Saved as run {saved_runs[run_key]} in {store.path}")
+    else:
+        history_note = st.text_input("Note for the saved run", value="", help="Stored with the run, e.g. the lot or wafer IDs.")
+        if st.button("Save this comparison to the history", help="Appends every file as a lot: CL values, limits, margins and Pass/Fail per spec."):
+            with st.spinner("Saving the comparison..."):
+                saved_runs[run_key] = store.save_run(full_cube, [f.name for f in uploaded_files], history_note)
+            st.rerun()
+    saved = store.runs()
+    with st.expander("Saved runs"):
+        st.dataframe(saved, hide_index=True)
+
+    st.header("Changes Since a Previous Run", divider=True)
+    baselines = saved[saved["Run"] != saved_runs.get(run_key)]
+    if baselines.empty:
+        st.caption("Save a comparison to the history first; later comparisons can then be checked against it.")
+    elif st.checkbox("Only show the specs that changed since a saved run", value=False):
+        change_controls = st.columns(3)
+        baseline = change_controls[0].selectbox(
+            "Saved run", baselines["Run"].tolist(),
+            format_func=lambda run: f"Run {run} · {baselines.set_index('Run').at[run, 'Saved (UTC)']}"
+        )
+        change_abs = change_controls[1].number_input("Flag |change| above (0 = off)", min_value=0.0, value=0.0, step=0.1, key="change_abs")
+        change_pct = change_controls[2].number_input("Flag |change| % above (0 = off)", min_value=0.0, value=10.0, step=1.0, key="change_pct")
+        current_summary = comparison_summary(run_key[0], limits_key, full_cube)
+        changes = run_changes(current_summary, stored_run_summary(store.path, baseline), change_abs, change_pct)
+        st.caption(
+            f"{len(changes):,} of {len(current_summary):,} specs changed since run {baseline}: Pass/Fail flips, new or "
+            "dropped specs, and the lowest Minimum, mean Typical, highest Maximum or worst margins across the files "
+            "moving beyond either threshold."
+        )
+        st.dataframe(changes, hide_index=True)
+        changes_output = write_changes_workbook(changes, f"Changes since run {baseline}")
+        st.download_button(
+            label="Download the changes (Excel)",
+            data=changes_output,
+            file_name=changes_output.name,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+    with (recorder or untimed)("excel_write") as stage:
+        final_output = write_comparison_workbook(merged_output, custom_names, delta_thresholds)
+        stage["rows"] = len(merged_output)
     st.download_button(
         label="Download Excel (Grouped with Original Columns)",
         data=final_output,
         file_name=final_output.name,
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
-
+    if run_profiler is not None:
+        st.caption(f"Profile of this run written to {run_profiler.stop()}")
+
+    peak = peak_rss_bytes()
+    budget = memory_budget_from_env()
+    if peak:
+        st.sidebar.caption(f"Process peak RSS: {peak / 1024 / 1024:,.0f} MB" + (f" · budget per run: {budget:,} MB" if budget else ""))
+
+    if recorder is not None:
+        with st.expander("Pipeline diagnostics", expanded=True):
+            st.write(f"Run `{recorder.run_id}` — {'cache hit, comparison not recomputed' if recorder.cache_hit else 'cache miss, full comparison'}")
+            st.dataframe(recorder.to_frame(), hide_index=True)
+            st.write(f"Total recorded time: {recorder.total_seconds():.2f} s" + (f" · Process peak RSS: {peak / 1024 / 1024:.0f} MB" if peak else ""))
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import streamlit as st
+
+from comparison import prepare_upload
+from diagnostics import StageRecorder
+
+SESSION_KEY = "prepared_uploads"
+
+
+@st.cache_resource
+def _executor():
+    # Shared by all sessions; parsing is mostly pandas C code so threads overlap well
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="cl-upload")
+
+
+def _prepare(data, index):
+    recorder = StageRecorder(log=False)
+    prepared = prepare_upload(BytesIO(data), index, timer=recorder)
+    prepared["stages"] = recorder.stages
+    return prepared
+
+
+def upload_key(uploaded_file):
+    return (getattr(uploaded_file, "file_id", None), uploaded_file.name, uploaded_file.size)
+
+
+def submit_upload(index, uploaded_file):
+    # Start parsing/aligning this upload in the background the first time it is seen.
+    # One entry per uploader slot; replacing the file drops the previous result.
+    jobs = st.session_state.setdefault(SESSION_KEY, {})
+    key = upload_key(uploaded_file)
+    current = jobs.get(index)
+    if current is None or current[0] != key:
+        if current is not None:
+            current[1].cancel()
+        jobs[index] = (key, _executor().submit(_prepare, uploaded_file.getvalue(), index))
+    return jobs[index][1]
+
+
+def forget_uploads(active_indexes):
+    jobs = st.session_state.get(SESSION_KEY, {})
+    for index in [i for i in jobs if i not in active_indexes]:
+        jobs.pop(index)[1].cancel()
+
+
+def upload_status(future):
+    if not future.done():
+        return "⏳ Processing in the background..."
+    error = future.exception()
+    if error is not None:
+        return f"⚠️ Could not read file: {error}"
+    prepared = future.result()
+    if prepared["missing"]:
+        return f'⚠️ Missing column "{prepared["missing"][0]}"'
+    seconds = sum(record["seconds"] for record in prepared["stages"].values())
+    status = f"✅ {prepared['rows']:,} rows parsed and aligned in {seconds:.2f} s"
+    unparsed = sum(count for count, _ in prepared["unparsed"].values())
+    if unparsed:
+        status += f" · ⚠️ {unparsed:,} cells could not be read as numbers"
+    if prepared["duplicates"]:
+        status += f" · ⚠️ {prepared['duplicates']:,} rows repeat an earlier spec key"
+    return status
+
+
+def merge_upload_stages(recorder, prepared_uploads):
+    # Fold the background timings into the run's recorder so the diagnostics table stays complete
+    for prepared in prepared_uploads:
+        for stage, record in prepared["stages"].items():
+            recorder.add(f"{stage} (background)", record["seconds"], rows=record["rows"])